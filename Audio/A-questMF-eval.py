@@ -8,6 +8,20 @@ import random
 import librosa
 import argparse
 import os
+import sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from questmf.instrument import stage_timer
+from questmf.profiling import make_profiler, profile_range
+from questmf.corpus import scan_corpus
+from questmf.feature_cache import egemaps_cache, open_features, segment_means
+from questmf.records import session, memory_report
+from questmf.threads import set_thread_budget
+from questmf.precision import autocast, check_bf16, parity_report
+from questmf.compile import compile_model, warm_up
+from questmf.config import parse_args
+from questmf.heads import HEADS, make_head, apply_head
+from questmf.prune import load_checkpoint
+from questmf.logits_store import save_logits
 
 def cmdline_args():
     # Make parser object
@@ -17,8 +31,27 @@ def cmdline_args():
     p.add_argument("-l_path", "--label_path", type=str, help="Path to labels, i.e., PHQ-8 scores")
     p.add_argument("-a_ckpt", "--audio_checkpoint_path", type=str, help="Path to checkpoint for the audio model")
     p.add_argument("-m_files", "--missing_video_files",nargs='+', type=int, help="List of file numbers for incomplete video files")
+    p.add_argument("-metrics", "--metrics_path", type=str, help="JSONL file for per-stage timing metrics")
+    p.add_argument("-profile", "--profile", action='store_true', help="Profile a window of steps with torch.profiler")
+    p.add_argument("-profile_dir", "--profile_dir", type=str, default='profile', help="Directory for profiler traces and the top-ops table")
+    p.add_argument("-profile_steps", "--profile_steps", nargs=3, type=int, default=[1,1,5], help="Number of steps to skip, warm up and record")
+    p.add_argument("-workers", "--workers", type=int, default=8, help="Number of workers for reading the participant files")
+    p.add_argument("-pool", "--pool", type=str, default='thread', choices=['thread','process'], help="Use a thread or a process pool for reading the participant files")
+    p.add_argument("-cache_dir", "--cache_dir", type=str, default='cache', help="Directory for the float32 copies of the eGeMAPS features")
+    p.add_argument("-threads", "--threads", type=int, help="Number of intra-op threads (default: one per core in -cores, else all cores)")
+    p.add_argument("-interop_threads", "--interop_threads", type=int, help="Number of inter-op threads")
+    p.add_argument("-cores", "--cores", type=str, help="Cores for this process, e.g. 0-7")
+    p.add_argument("-pin", "--pin", action='store_true', help="Pin the process to the cores given in -cores")
+    p.add_argument("-bf16", "--bf16", action='store_true', help="Run the forward passes under bf16 autocast, the weights stay float32")
+    p.add_argument("-bf16_parity", "--bf16_parity", action='store_true', help="Evaluate in float32 and in bf16 and compare the metrics")
+    p.add_argument("-compile", "--compile", action='store_true', help="Compile the model with torch.compile, the kernels are cached in <cache_dir>/inductor")
+    p.add_argument("-bs", "--batch_size", type=int, default=10, help="Batch size for evaluation")
+    p.add_argument("-config", "--config", type=str, help="JSON or YAML file with defaults for any of these options, e.g. {\"bs\": 32}")
+    p.add_argument("-head", "--head", type=str, default='flatten', choices=HEADS, help="Classification head of every model: the flattened MLP of the paper, or masked mean+max or attention pooling over the turns")
+    p.add_argument("-logits_store", "--logits_store", type=str, help="SQLite file to store the per-question logits of every participant in, see questmf.logits_store")
+    p.add_argument("-store_splits", "--store_splits", nargs='+', default=['test'], choices=['train','val','test'], help="Splits whose logits go to -logits_store")
     
-    return (p.parse_args())
+    return (parse_args(p))
 
 def set_seed(seed_value=42):
     """Set seed for reproducibility.
@@ -28,8 +61,44 @@ def set_seed(seed_value=42):
     torch.manual_seed(seed_value)
     torch.cuda.manual_seed_all(seed_value)
 
+def load_participant(p_id_int,data_path,score,cache_dir):
+    """Read the transcript and features of one participant.
+    """
+    p_id = str(p_id_int)
+    df_txt = pd.read_csv(data_path + p_id + '_P/' + p_id + '_Transcript.csv')
+    speech_file = data_path + p_id + '_P/' + p_id + '_AUDIO.wav'
+    aud_dur = librosa.get_duration(path=speech_file)
+    # Sampling-rate = 100
+    # Preprocessing start and end times
+    max_times = aud_dur*100
+    # float32 copy of the eGeMAPS features, memory mapped in the preprocessing
+    egemaps_file = egemaps_cache(data_path + p_id + '_P/features/' + p_id + '_OpenSMILE2.3.0_egemaps.csv',cache_dir)
+    start_times = (df_txt['Start_Time'].values*100).tolist()
+    end_times = (df_txt['End_Time'].values*100).tolist()
+
+    x = 1
+    y = len(start_times)
+    
+    while x < y:
+        if start_times[x-1]>start_times[x] or start_times[x]>max_times:
+            del start_times[x]
+            del end_times[x]
+            x = x-1
+            y = y-1
+        if end_times[x-1]>end_times[x] or end_times[x]>max_times:
+            del start_times[x]
+            del end_times[x]
+            x = x-1
+            y = y-1
+        x = x+1
+    
+    start_times = [round(z) for z in start_times]
+    end_times = [round(z) for z in end_times]      
+        
+    return session(p_id_int,float(score),aud_file=egemaps_file,aud_start=start_times,aud_end=end_times)
+
 class dds(Dataset):
-    def __init__(self,split,data_path,label_path,missing_files_list):
+    def __init__(self,split,data_path,label_path,missing_files_list,workers=1,pool='thread',cache_dir='cache'):
         super(dds,self).__init__()
         if split == 'train':
             df_data = pd.read_csv(label_path + 'train_split.csv')
@@ -39,57 +108,19 @@ class dds(Dataset):
             df_data = pd.read_csv(label_path + 'test_split.csv')
         else:
             raise Exception(f"wrong split: {split}")
-        self.data = []
         p_id_list = df_data['Participant_ID'].tolist()
         phq_score_list = df_data['PHQ_Score'].tolist()
-        for i in range(len(p_id_list)):
-            p_id = str(p_id_list[i])
-            # Files not complete for video
-            if p_id_list[i] in missing_files_list:
-                continue
-            df_txt = pd.read_csv(data_path + p_id + '_P/' + p_id + '_Transcript.csv')
-            speech_file = data_path + p_id + '_P/' + p_id + '_AUDIO.wav'
-            aud_dur = librosa.get_duration(path=speech_file)
-            # Sampling-rate = 100
-            # Preprocessing start and end times
-            max_times = aud_dur*100
-            df_speech = pd.read_csv(data_path + p_id + '_P/features/' + p_id + '_OpenSMILE2.3.0_egemaps.csv',sep=";")
-            start_times = (df_txt['Start_Time'].values*100).tolist()
-            end_times = (df_txt['End_Time'].values*100).tolist()
-
-            x = 1
-            y = len(start_times)
-            
-            while x < y:
-                if start_times[x-1]>start_times[x] or start_times[x]>max_times:
-                    del start_times[x]
-                    del end_times[x]
-                    x = x-1
-                    y = y-1
-                if end_times[x-1]>end_times[x] or end_times[x]>max_times:
-                    del start_times[x]
-                    del end_times[x]
-                    x = x-1
-                    y = y-1
-                x = x+1
-            
-            start_times = [round(z) for z in start_times]
-            end_times = [round(z) for z in end_times]      
-                
-            self.data.append([df_speech,start_times,end_times,float(phq_score_list[i])])
+        # Files not complete for video
+        jobs = [(p_id,data_path,score,cache_dir) for p_id,score in zip(p_id_list,phq_score_list) if p_id not in missing_files_list]
+        # Participants are read on a bounded pool, in split order
+        self.data = scan_corpus(load_participant, jobs, workers, pool)
+        memory_report(split,self.data)
     
-    def preprocess(self,df_speech,start_times,end_times):
-        df_mod = df_speech.iloc[:,2:]
-        speech= df_mod.values.tolist()
-        speech_0 = torch.tensor(speech[start_times[0]:end_times[0]]).unsqueeze(0)
-        out = torch.mean(speech_0, dim=1)
-        out = out.detach().cpu()
-
-        for i in range(1,len(start_times)):
-            speech_mod = torch.tensor(speech[start_times[i]:end_times[i]]).unsqueeze(0)
-            mean_i = torch.mean(speech_mod, dim=1)
-            mean_i = mean_i.detach().cpu()
-            out = torch.cat((out,mean_i),dim=0)
+    @profile_range('preprocess_aud')
+    def preprocess(self,egemaps_file,start_times,end_times):
+        speech = open_features(egemaps_file)
+        # Mean over the frames of every turn, only the first 120 turns are kept
+        out = torch.from_numpy(segment_means(speech,start_times[:120],end_times[:120]))
         
         l = len(start_times)
         if l > 120:
@@ -103,13 +134,14 @@ class dds(Dataset):
         # out = F.normalize(out, p=2, dim=1)
         return out,mask
     def __getitem__(self,index):
-        embedding, mask = self.preprocess(self.data[index][0],self.data[index][1],self.data[index][2])
-        return [embedding,mask,self.data[index][3]]
+        s = self.data[index]
+        embedding, mask = self.preprocess(s.aud_file,s.aud_start,s.aud_end)
+        return [embedding,mask,s.label]
     def __len__(self):
         return len(self.data)
 
 class lstm_regressor(nn.Module):
-    def __init__(self):
+    def __init__(self,head='flatten'):
         super(lstm_regressor, self).__init__()
         self.lstm_1 = nn.LSTM(23,50,batch_first=True,bidirectional=True)
         self.attention1 = nn.MultiheadAttention(100, 4,batch_first=True,dropout=0.2)
@@ -120,12 +152,14 @@ class lstm_regressor(nn.Module):
                                 nn.ReLU(),
                                 nn.Dropout(0.2),
                                 nn.Linear(256,4))
+        self.mlp = make_head(head,self.mlp)
 
+    @profile_range('aud_encoder')
     def forward(self,C,key_padding_mask):
         c_lstm,_ = self.lstm_1(C)
         c_att,_ = self.attention1(c_lstm,c_lstm,c_lstm,key_padding_mask=key_padding_mask)
         c_att2,_ = self.attention2(c_att,c_att,c_att,key_padding_mask=key_padding_mask)
-        logits = self.mlp(c_att2)
+        logits = apply_head(self.mlp,c_att2,key_padding_mask)
         return logits
 
 # CCC loss
@@ -152,7 +186,7 @@ class ccc_loss(nn.Module):
         ccc = numerator/denominator
         return 1-ccc
 
-def evaluate(model1,model2,model3,model4,model5,model6,model7,model8, val_dataloader):
+def evaluate(model1,model2,model3,model4,model5,model6,model7,model8, val_dataloader, metrics_path=None, profiler=None, bf16=False, logits_out=None):
     """After the completion of each training epoch, measure the model's performance
     on our validation set.
     """
@@ -166,18 +200,23 @@ def evaluate(model1,model2,model3,model4,model5,model6,model7,model8, val_datalo
     model6.eval()
     model7.eval()
     model8.eval()
+    timer = stage_timer(device, metrics_path, phase='eval')
+    profiler = profiler or make_profiler(None)
+    profiler.start()
 
     # Tracking variables
     preds_list = []
     labels_list = []
 
     # For each batch in our validation set...
-    for batch in val_dataloader:
+    for batch in timer.loader(val_dataloader):
         # Load batch to GPU
-        c, mask, phq_scores = tuple(t.to(device) for t in batch)
+        with timer.stage('h2d'):
+            c, mask, phq_scores = tuple(t.to(device) for t in batch)
+        timer.add_samples(phq_scores.shape[0])
 
         # Compute logits
-        with torch.no_grad():
+        with timer.stage('forward'), torch.no_grad(), autocast(device, bf16):
             logits1 = model1.forward(c,mask)
             logits2 = model2.forward(c,mask)
             logits3 = model3.forward(c,mask)
@@ -186,6 +225,8 @@ def evaluate(model1,model2,model3,model4,model5,model6,model7,model8, val_datalo
             logits6 = model6.forward(c,mask)
             logits7 = model7.forward(c,mask)
             logits8 = model8.forward(c,mask)
+        if logits_out is not None:
+            logits_out.append(torch.stack([logits1,logits2,logits3,logits4,logits5,logits6,logits7,logits8], dim=1).float().cpu())
 
         # Compute preds
         preds1 = torch.argmax(logits1, dim=1).flatten()
@@ -200,6 +241,7 @@ def evaluate(model1,model2,model3,model4,model5,model6,model7,model8, val_datalo
         preds = preds1+preds2+preds3+preds4+preds5+preds6+preds7+preds8
         preds_list.append(preds)
         labels_list.append(phq_scores)
+        profiler.step()
 
         preds = preds.detach().cpu()
         phq_scores = phq_scores.detach().cpu()
@@ -207,6 +249,8 @@ def evaluate(model1,model2,model3,model4,model5,model6,model7,model8, val_datalo
     # Compute the CCC, RMSE and MAE
     preds_all = torch.cat(preds_list, dim=0)
     labels_all = torch.cat(labels_list, dim=0)
+    profiler.stop()
+    timer.report()
     val_loss_ccc = 1 - ccc_loss_fn(preds_all.float(), labels_all.float())
     val_loss_rmse = torch.sqrt(loss_fn_mse(preds_all.float(), labels_all.float()))
     val_loss_mae = mae_loss_fn(preds_all.float(),labels_all.float())
@@ -216,6 +260,7 @@ def evaluate(model1,model2,model3,model4,model5,model6,model7,model8, val_datalo
 if __name__ == '__main__':
 
     args = cmdline_args()
+    set_thread_budget(args.threads, args.interop_threads, args.cores, args.pin)
 
     set_seed(args.seed)    # Set seed for reproducibility
 
@@ -226,31 +271,33 @@ if __name__ == '__main__':
     else:
         device = torch.device("cpu")
     print(f"# Using device: {device}")
+    if args.bf16 or args.bf16_parity:
+        check_bf16(device)
     
     # Datasets
-    data_train = dds('train',args.data_path,args.label_path,args.missing_video_files)
-    data_val = dds('val',args.data_path,args.label_path,args.missing_video_files)
-    data_test = dds('test',args.data_path,args.label_path,args.missing_video_files)
+    data_train = dds('train',args.data_path,args.label_path,args.missing_video_files,args.workers,args.pool,args.cache_dir)
+    data_val = dds('val',args.data_path,args.label_path,args.missing_video_files,args.workers,args.pool,args.cache_dir)
+    data_test = dds('test',args.data_path,args.label_path,args.missing_video_files,args.workers,args.pool,args.cache_dir)
     
     # Define Audio Encoder for each Question
-    r1 = lstm_regressor()
-    r2 = lstm_regressor()
-    r3 = lstm_regressor()
-    r4 = lstm_regressor()
-    r5 = lstm_regressor()
-    r6 = lstm_regressor()
-    r7 = lstm_regressor()
-    r8 = lstm_regressor()
+    r1 = lstm_regressor(head=args.head)
+    r2 = lstm_regressor(head=args.head)
+    r3 = lstm_regressor(head=args.head)
+    r4 = lstm_regressor(head=args.head)
+    r5 = lstm_regressor(head=args.head)
+    r6 = lstm_regressor(head=args.head)
+    r7 = lstm_regressor(head=args.head)
+    r8 = lstm_regressor(head=args.head)
     
     ## Load pretrained weights
-    r1.load_state_dict(torch.load(args.audio_checkpoint_path + '-phq1-seed-' + str(args.seed) + '-ccc.pt'))
-    r2.load_state_dict(torch.load(args.audio_checkpoint_path + '-phq2-seed-' + str(args.seed) + '-ccc.pt'))
-    r3.load_state_dict(torch.load(args.audio_checkpoint_path + '-phq3-seed-' + str(args.seed) + '-ccc.pt'))
-    r4.load_state_dict(torch.load(args.audio_checkpoint_path + '-phq4-seed-' + str(args.seed) + '-ccc.pt'))
-    r5.load_state_dict(torch.load(args.audio_checkpoint_path + '-phq5-seed-' + str(args.seed) + '-ccc.pt'))
-    r6.load_state_dict(torch.load(args.audio_checkpoint_path + '-phq6-seed-' + str(args.seed) + '-ccc.pt'))
-    r7.load_state_dict(torch.load(args.audio_checkpoint_path + '-phq7-seed-' + str(args.seed) + '-ccc.pt'))
-    r8.load_state_dict(torch.load(args.audio_checkpoint_path + '-phq8-seed-' + str(args.seed) + '-ccc.pt'))
+    load_checkpoint(r1, args.audio_checkpoint_path + '-phq1-seed-' + str(args.seed) + '-ccc.pt')
+    load_checkpoint(r2, args.audio_checkpoint_path + '-phq2-seed-' + str(args.seed) + '-ccc.pt')
+    load_checkpoint(r3, args.audio_checkpoint_path + '-phq3-seed-' + str(args.seed) + '-ccc.pt')
+    load_checkpoint(r4, args.audio_checkpoint_path + '-phq4-seed-' + str(args.seed) + '-ccc.pt')
+    load_checkpoint(r5, args.audio_checkpoint_path + '-phq5-seed-' + str(args.seed) + '-ccc.pt')
+    load_checkpoint(r6, args.audio_checkpoint_path + '-phq6-seed-' + str(args.seed) + '-ccc.pt')
+    load_checkpoint(r7, args.audio_checkpoint_path + '-phq7-seed-' + str(args.seed) + '-ccc.pt')
+    load_checkpoint(r8, args.audio_checkpoint_path + '-phq8-seed-' + str(args.seed) + '-ccc.pt')
     
     r1.to(device)
     r2.to(device)
@@ -262,14 +309,38 @@ if __name__ == '__main__':
     r8.to(device)
     
     # Dataloaders
-    train_dataloader = DataLoader(data_train,  batch_size=10)
-    val_dataloader = DataLoader(data_val,  batch_size=10)
-    test_dataloader = DataLoader(data_test,  batch_size=10)
+    train_dataloader = DataLoader(data_train,  batch_size=args.batch_size)
+    val_dataloader = DataLoader(data_val,  batch_size=args.batch_size)
+    test_dataloader = DataLoader(data_test,  batch_size=args.batch_size)
 
     # Specify loss functions/Metrics
     loss_fn_mse = nn.MSELoss()
     ccc_loss_fn = ccc_loss()
     mae_loss_fn = nn.L1Loss()
     
+    # Compile the models and build their graphs on the first batch
+    if args.compile:
+        for model in (r1, r2, r3, r4, r5, r6, r7, r8):
+            compile_model(model, test_dataloader.batch_size, args.cache_dir)
+            warm_up(model, next(iter(test_dataloader)), device, train=False, bf16=args.bf16)
+
+    # Logits kept for -logits_store, per split
+    store_logits = {split: [] for split in args.store_splits} if args.logits_store else {}
+
+    # Profile a window of evaluation batches
+    profiler = make_profiler(args.profile_dir if args.profile else None, *args.profile_steps)
+
     # Evaluate trained model
-    print(evaluate(r1,r2,r3,r4,r5,r6,r7,r8,test_dataloader))
\ No newline at end of file
+    if args.bf16_parity:
+        parity_report(('CCC','RMSE','MAE'), evaluate(r1,r2,r3,r4,r5,r6,r7,r8,test_dataloader, args.metrics_path, profiler), evaluate(r1,r2,r3,r4,r5,r6,r7,r8,test_dataloader, args.metrics_path, bf16=True))
+    else:
+        print(evaluate(r1,r2,r3,r4,r5,r6,r7,r8,test_dataloader, args.metrics_path, profiler, args.bf16, logits_out=store_logits.get('test')))
+
+    # Store the logits of every participant, the test logits come from the evaluation above
+    if args.logits_store:
+        ckpt_files = [args.audio_checkpoint_path + '-phq' + str(q) + '-seed-' + str(args.seed) + '-ccc.pt' for q in range(1, 9)]
+        splits = {'train': (data_train, train_dataloader), 'val': (data_val, val_dataloader), 'test': (data_test, test_dataloader)}
+        for split, logits in store_logits.items():
+            if not logits:
+                evaluate(r1,r2,r3,r4,r5,r6,r7,r8,splits[split][1], bf16=args.bf16, logits_out=logits)
+            save_logits(args.logits_store, 'A', split, args.seed, splits[split][0], torch.cat(logits), ckpt_files, head=args.head, bf16=args.bf16)
@@ -10,6 +10,21 @@ import time
 import librosa
 import argparse
 import os
+import sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from questmf.instrument import stage_timer
+from questmf.profiling import make_profiler, profile_range
+from questmf.corpus import scan_corpus
+from questmf.feature_cache import egemaps_cache, open_features, segment_means
+from questmf.records import session, memory_report
+from questmf.distributed import init_distributed, is_main, barrier, main_first, wrap_model, unwrap, train_loader, set_epoch, n_samples, cleanup
+from questmf.threads import set_thread_budget
+from questmf.precision import autocast, check_bf16, parity_report
+from questmf.compile import compile_model, warm_up
+from questmf.config import parse_args, scale_lr
+from questmf.heads import HEADS, make_head, apply_head
+from questmf.labels import load_labels, class_weights
+from questmf.shards import shard_dataset
 
 EPS = 1e-12
 
@@ -27,8 +42,32 @@ def cmdline_args():
     p.add_argument("-ta_ckpt", "--ta_checkpoint_path", type=str, help="Path to checkpoint for the text+audio model")
     p.add_argument("-m_files", "--missing_video_files",nargs='+', type=int, help="List of file numbers for incomplete video files")
     p.add_argument("-train","--train_model", action='store_true',help="Wheather to train the model or not")
-
-    return (p.parse_args())
+    p.add_argument("-metrics", "--metrics_path", type=str, help="JSONL file for per-stage timing metrics")
+    p.add_argument("-profile", "--profile", action='store_true', help="Profile a window of steps with torch.profiler")
+    p.add_argument("-profile_dir", "--profile_dir", type=str, default='profile', help="Directory for profiler traces and the top-ops table")
+    p.add_argument("-profile_steps", "--profile_steps", nargs=3, type=int, default=[1,1,5], help="Number of steps to skip, warm up and record")
+    p.add_argument("-workers", "--workers", type=int, default=8, help="Number of workers for reading the participant files")
+    p.add_argument("-pool", "--pool", type=str, default='thread', choices=['thread','process'], help="Use a thread or a process pool for reading the participant files")
+    p.add_argument("-cache_dir", "--cache_dir", type=str, default='cache', help="Directory for the float32 copies of the eGeMAPS features")
+    p.add_argument("-ddp", "--ddp", action='store_true', help="Data parallel training, launch with torchrun")
+    p.add_argument("-threads", "--threads", type=int, help="Number of intra-op threads (default: one per core in -cores, else all cores)")
+    p.add_argument("-interop_threads", "--interop_threads", type=int, help="Number of inter-op threads")
+    p.add_argument("-cores", "--cores", type=str, help="Cores for this process, e.g. 0-7")
+    p.add_argument("-pin", "--pin", action='store_true', help="Pin the process to the cores given in -cores")
+    p.add_argument("-bf16", "--bf16", action='store_true', help="Run the forward passes under bf16 autocast, the weights stay float32")
+    p.add_argument("-bf16_parity", "--bf16_parity", action='store_true', help="Evaluate in float32 and in bf16 and compare the metrics")
+    p.add_argument("-compile", "--compile", action='store_true', help="Compile the model with torch.compile, the kernels are cached in <cache_dir>/inductor")
+    p.add_argument("-bs", "--batch_size", type=int, default=10, help="Batch size for training and evaluation, split across the ranks with -ddp")
+    p.add_argument("-epochs", "--epochs", type=int, default=50, help="Number of training epochs")
+    p.add_argument("-lr", "--lr", type=float, default=5e-4, help="Learning rate at batch size 10")
+    p.add_argument("-lr_scale", "--lr_scale", type=str, default='none', choices=['none','linear','sqrt'], help="Scale -lr with the batch size relative to 10")
+    p.add_argument("-config", "--config", type=str, help="JSON or YAML file with defaults for any of these options, e.g. {\"bs\": 32, \"lr\": 1e-3}")
+    p.add_argument("-head", "--head", type=str, default='flatten', choices=HEADS, help="Classification head of every model: the flattened MLP of the paper, or masked mean+max or attention pooling over the turns")
+    p.add_argument("-shards", "--shards", type=str, help="index.json of training shards written by questmf.shards, streamed instead of building the training set")
+    p.add_argument("-shuffle_buffer", "--shuffle_buffer", type=int, default=256, help="Samples held for shuffling the streamed training set")
+    p.add_argument("-loader_workers", "--loader_workers", type=int, default=0, help="DataLoader worker processes for the training set")
+
+    return (parse_args(p))
 
 def set_seed(seed_value=42):
     """Set seed for reproducibility.
@@ -38,8 +77,43 @@ def set_seed(seed_value=42):
     torch.manual_seed(seed_value)
     torch.cuda.manual_seed_all(seed_value)
 
+def load_participant(p_id_int,data_path,score,cache_dir):
+    """Read the transcript and features of one participant.
+    """
+    p_id = str(p_id_int)
+    df_txt = pd.read_csv(data_path + p_id + '_P/' + p_id + '_Transcript.csv')
+    speech_file = data_path + p_id + '_P/' + p_id + '_AUDIO.wav'
+    aud_dur = librosa.get_duration(path=speech_file)
+    # Sampling-rate = 100
+    # Preprocessing start and end times
+    max_times = aud_dur*100
+    # float32 copy of the eGeMAPS features, memory mapped in the preprocessing
+    egemaps_file = egemaps_cache(data_path + p_id + '_P/features/' + p_id + '_OpenSMILE2.3.0_egemaps.csv',cache_dir)
+    start_times = (df_txt['Start_Time'].values*100).tolist()
+    end_times = (df_txt['End_Time'].values*100).tolist()
+
+    x = 1
+    y = len(start_times)
+    
+    while x < y:
+        if start_times[x-1]>start_times[x] or start_times[x]>max_times:
+            del start_times[x]
+            del end_times[x]
+            x = x-1
+            y = y-1
+        if end_times[x-1]>end_times[x] or end_times[x]>max_times:
+            del start_times[x]
+            del end_times[x]
+            x = x-1
+            y = y-1
+        x = x+1
+    
+    start_times = [round(z) for z in start_times]
+    end_times = [round(z) for z in end_times]      
+    return session(p_id_int,score,aud_file=egemaps_file,aud_start=start_times,aud_end=end_times)
+
 class dds(Dataset):
-    def __init__(self,split,data_path,label_path,q_no,missing_files_list):
+    def __init__(self,split,data_path,label_path,q_no,missing_files_list,workers=1,pool='thread',cache_dir='cache'):
         super(dds,self).__init__()
         if split == 'train':
             df_data = pd.read_csv(label_path + 'train_split.csv')
@@ -47,63 +121,19 @@ class dds(Dataset):
             df_data = pd.read_csv(label_path + 'dev_split.csv')
         else:
             raise Exception(f"wrong split: {split}")
-        self.data = []
-        df_scores = pd.read_csv(label_path + 'Detailed_PHQ8_Labels.csv')
+        labels = load_labels(label_path,cache_dir)
         p_id_list = df_data['Participant_ID'].tolist()
-        for i in range(len(p_id_list)):
-            p_id = str(p_id_list[i])
-            # Files not complete for video
-            if p_id_list[i] in missing_files_list:
-                continue
-            p_id_int = p_id_list[i]
-            df_txt = pd.read_csv(data_path + p_id + '_P/' + p_id + '_Transcript.csv')
-            speech_file = data_path + p_id + '_P/' + p_id + '_AUDIO.wav'
-            aud_dur = librosa.get_duration(path=speech_file)
-            # Sampling-rate = 100
-            # Preprocessing start and end times
-            max_times = aud_dur*100
-            df_speech = pd.read_csv(data_path + p_id + '_P/features/' + p_id + '_OpenSMILE2.3.0_egemaps.csv',sep=";")
-            start_times = (df_txt['Start_Time'].values*100).tolist()
-            end_times = (df_txt['End_Time'].values*100).tolist()
-
-            x = 1
-            y = len(start_times)
-            
-            while x < y:
-                if start_times[x-1]>start_times[x] or start_times[x]>max_times:
-                    del start_times[x]
-                    del end_times[x]
-                    x = x-1
-                    y = y-1
-                if end_times[x-1]>end_times[x] or end_times[x]>max_times:
-                    del start_times[x]
-                    del end_times[x]
-                    x = x-1
-                    y = y-1
-                x = x+1
-            
-            start_times = [round(z) for z in start_times]
-            end_times = [round(z) for z in end_times]      
-            q_list = ['PHQ_8NoInterest','PHQ_8Depressed','PHQ_8Sleep','PHQ_8Tired','PHQ_8Appetite','PHQ_8Failure','PHQ_8Concentrating','PHQ_8Moving']
-            score = int(df_scores[df_scores['Participant_ID']==p_id_int][q_list[q_no-1]].iloc[0])
-            self.data.append([df_speech,start_times,end_times,score])
-    
-    def preprocess(self,df_speech,start_times,end_times):
-        df_mod = df_speech.iloc[:,2:]
-        speech= df_mod.values.tolist()
-        speech_0 = torch.tensor(speech[start_times[0]:end_times[0]]).unsqueeze(0)
-        # input_values = processor(speech_0, sampling_rate=16000, return_tensors="pt").to(device)
-        # hidden_states = embedder(input_values.input_values).last_hidden_state
-        out = torch.mean(speech_0, dim=1)
-        out = out.detach().cpu()
+        # Files not complete for video
+        jobs = [(p_id,data_path,labels.item(p_id,q_no),cache_dir) for p_id in p_id_list if p_id not in missing_files_list]
+        # Participants are read on a bounded pool, in split order
+        self.data = scan_corpus(load_participant, jobs, workers, pool)
+        memory_report(split,self.data)
     
-        for i in range(1,len(start_times)):
-            speech_mod = torch.tensor(speech[start_times[i]:end_times[i]]).unsqueeze(0)
-            # input_values_i = processor(speech_mod, sampling_rate=16000, return_tensors="pt").to(device)
-            # hidden_states_i = embedder(input_values_i.input_values).last_hidden_state
-            mean_i = torch.mean(speech_mod, dim=1)
-            mean_i = mean_i.detach().cpu()
-            out = torch.cat((out,mean_i),dim=0)
+    @profile_range('preprocess_aud')
+    def preprocess(self,egemaps_file,start_times,end_times):
+        speech = open_features(egemaps_file)
+        # Mean over the frames of every turn, only the first 120 turns are kept
+        out = torch.from_numpy(segment_means(speech,start_times[:120],end_times[:120]))
         
         l = len(start_times)
         if l > 120:
@@ -117,13 +147,14 @@ class dds(Dataset):
         # out = F.normalize(out, p=2, dim=1)
         return out,mask
     def __getitem__(self,index):
-        embedding, mask = self.preprocess(self.data[index][0],self.data[index][1],self.data[index][2])
-        return [embedding,mask,self.data[index][3]]
+        s = self.data[index]
+        embedding, mask = self.preprocess(s.aud_file,s.aud_start,s.aud_end)
+        return [embedding,mask,s.label]
     def __len__(self):
         return len(self.data)
 
 class lstm_regressor(nn.Module):
-    def __init__(self):
+    def __init__(self,head='flatten'):
         super(lstm_regressor, self).__init__()
         self.lstm_1 = nn.LSTM(23,50,batch_first=True,bidirectional=True)
         self.attention1 = nn.MultiheadAttention(100, 4,batch_first=True,dropout=0.2)
@@ -134,12 +165,14 @@ class lstm_regressor(nn.Module):
                                 nn.ReLU(),
                                 nn.Dropout(0.2),
                                 nn.Linear(256,4))
+        self.mlp = make_head(head,self.mlp)
 
+    @profile_range('aud_encoder')
     def forward(self,C,key_padding_mask):
         c_lstm,_ = self.lstm_1(C)
         c_att,_ = self.attention1(c_lstm,c_lstm,c_lstm,key_padding_mask=key_padding_mask)
         c_att2,_ = self.attention2(c_att,c_att,c_att,key_padding_mask=key_padding_mask)
-        logits = self.mlp(c_att2)
+        logits = apply_head(self.mlp,c_att2,key_padding_mask)
         return logits
 
 # CCC loss
@@ -168,40 +201,15 @@ class ccc_loss(nn.Module):
 
 # Get weights for ImbOLL function
 
-def get_weights(q_no,label_path, beta):
-    df_data_x = pd.read_csv(label_path + 'train_split.csv')
-    p_id_list_x = df_data_x['Participant_ID'].tolist()
-    df_scores = pd.read_csv(label_path + 'Detailed_PHQ8_Labels.csv')
-    q_list = ['PHQ_8NoInterest','PHQ_8Depressed','PHQ_8Sleep','PHQ_8Tired','PHQ_8Appetite','PHQ_8Failure','PHQ_8Concentrating','PHQ_8Moving']
-    x0 = 0
-    x1 = 0
-    x2 = 0
-    x3 = 0
-    for i in range(len(p_id_list_x)):
-        p_id_int_x = p_id_list_x[i]
-        score = int(df_scores[df_scores['Participant_ID']==p_id_int_x][q_list[q_no-1]].iloc[0])
-        if score ==0:
-            x0 = x0+1
-        elif score ==1:
-            x1 = x1+1
-        elif score ==2:
-            x2 = x2+1
-        elif score ==3:
-            x3 = x3+1
-
-    x_total = x0+x1+x2+x3
-    w0 = x_total/x0
-    w1 = x_total/x1
-    w2 = x_total/x2
-    w3 = x_total/x3
-    w_total = torch.tensor([w0,w1,w2,w3])
-
-    w = w_total**(beta)
+def get_weights(q_no,label_path, beta, cache_dir=None):
+    # Weights of all eight questions in one bincount, see questmf.labels
+    w = class_weights(label_path,beta,cache_dir)[q_no-1]
 
     return w
 
 #ImbOLL
 
+@profile_range('ImbOLL')
 def ImbOLL(logits,w,labels,alpha):
     num_classes = 4
     dist_matrix = [[w[0].item()*0,w[0].item()*1,w[0].item()*2,w[0].item()*3],[w[1].item()*1,w[1].item()*0,w[1].item()*1,w[1].item()*2],[w[2].item()*2,w[2].item()*1,w[2].item()*0,w[2].item()*1],[w[3].item()*3,w[3].item()*2,w[3].item()*1,w[3].item()*0]]
@@ -214,10 +222,13 @@ def ImbOLL(logits,w,labels,alpha):
     loss = torch.sum(err,axis=1).mean()
     return loss
 
-def train(model, train_dataloader, data_train, data_val, a_ckpt_name, seed, w, alpha, val_dataloader, epochs=10, evaluation=False):
+def train(model, train_dataloader, data_train, data_val, a_ckpt_name, seed, w, alpha, val_dataloader, epochs=10, evaluation=False, metrics_path=None, profiler=None, bf16=False):
 
     # Start training loop
     print("Start training...\n")
+    timer = stage_timer(device, metrics_path, phase='train')
+    profiler = profiler or make_profiler(None)
+    profiler.start()
     best_val_loss_ccc=-100
     best_val_loss = 10000
     for epoch_i in range(epochs):
@@ -236,30 +247,40 @@ def train(model, train_dataloader, data_train, data_val, a_ckpt_name, seed, w, a
 
         # Put the model into the training mode
         model.train()
+        timer.reset()
+        set_epoch(train_dataloader, epoch_i)
 
         # For each batch of training data...
-        for step, batch in enumerate(train_dataloader):
+        for step, batch in enumerate(timer.loader(train_dataloader)):
             batch_counts +=1
             # Load batch to GPU
-            c, mask, phq_scores = tuple(t.to(device) for t in batch)
+            with timer.stage('h2d'):
+                c, mask, phq_scores = tuple(t.to(device) for t in batch)
+            timer.add_samples(phq_scores.shape[0])
 
             # Zero out any previously calculated gradients
             model.zero_grad()
 
             # Perform a forward pass. This will return predictions.
-            logits = model.forward(c,mask)
-            loss = ImbOLL(logits,w,phq_scores,alpha)
+            with timer.stage('forward'), autocast(device, bf16):
+                logits = model.forward(c,mask).float()
+            with timer.stage('loss'):
+                loss = ImbOLL(logits,w,phq_scores,alpha)
             batch_loss += loss.item()
             total_loss += (loss.item() * float(c.shape[0]))
 
             # Perform a backward pass to calculate gradients
-            loss.backward()
+            with timer.stage('backward'):
+                loss.backward()
 
             # Clip the norm of the gradients to 1.0 to prevent "exploding gradients"
-            torch.nn.utils.clip_grad_norm_(model.parameters(), 1.0)
+            with timer.stage('clip_grad'):
+                torch.nn.utils.clip_grad_norm_(model.parameters(), 1.0)
 
             # Update parameters and the learning rate
-            optimizer.step()
+            with timer.stage('optimizer_step'):
+                optimizer.step()
+            profiler.step()
             # scheduler.step()
 
             # Print the loss values and time elapsed for every 20 batches
@@ -273,45 +294,51 @@ def train(model, train_dataloader, data_train, data_val, a_ckpt_name, seed, w, a
                 # Reset batch tracking variables
                 batch_loss, batch_counts = 0, 0
                 t0_batch = time.time()
-            preds = preds.detach().cpu()
-            phq_scores = phq_scores.detach().cpu()
+
+        timer.end_loop()
         # Calculate the average loss over the entire training data
-        avg_train_loss = total_loss / len(data_train)
+        # Average over the samples of this rank
+        avg_train_loss = total_loss / n_samples(train_dataloader)
 
         print("-"*70)
         # =======================================
         #               Evaluation
         # =======================================
-        if evaluation == True:
+        if evaluation == True and is_main():
             # After the completion of each training epoch, measure the model's performance
             # on our validation set.
-            val_loss,val_acc,val_mi_f1,val_ma_f1,val_weight_f1,val_loss_ccc,val_rmse,val_mae = evaluate(model, data_val, val_dataloader, w, alpha)
+            val_loss,val_acc,val_mi_f1,val_ma_f1,val_weight_f1,val_loss_ccc,val_rmse,val_mae = evaluate(unwrap(model), data_val, val_dataloader, w, alpha, metrics_path, bf16)
 
             if(val_loss < best_val_loss):
                 best_val_loss = val_loss
-                torch.save(model.state_dict(), a_ckpt_name + '-seed-' + str(seed) + '.pt')
+                with timer.stage('checkpoint'):
+                    torch.save(unwrap(model).state_dict(), a_ckpt_name + '-seed-' + str(seed) + '.pt')
             
             if(val_loss_ccc > best_val_loss_ccc):
                 best_val_loss_ccc = val_loss_ccc
-                torch.save(model.state_dict(), a_ckpt_name + '-seed-' + str(seed) + '-ccc.pt')
+                with timer.stage('checkpoint'):
+                    torch.save(unwrap(model).state_dict(), a_ckpt_name + '-seed-' + str(seed) + '-ccc.pt')
 
             # Print performance over the entire training data
             time_elapsed = time.time() - t0_epoch
             
             print(f"{epoch_i + 1:^7} | {'-':^7} | {avg_train_loss:^12.6f} | {val_loss:^10.6f} | {time_elapsed:^9.2f}")
             print("-"*70)
+        timer.report(epoch_i + 1, train_loss=avg_train_loss)
         print("\n")
     
+    profiler.stop()
     print("Training complete!")
 
 
-def evaluate(model, data_val, val_dataloader, w, alpha):
+def evaluate(model, data_val, val_dataloader, w, alpha, metrics_path=None, bf16=False):
     """After the completion of each training epoch, measure the model's performance
     on our validation set.
     """
     # Put the model into the evaluation mode. The dropout layers are disabled during
     # the test time.
     model.eval()
+    timer = stage_timer(device, metrics_path, phase='eval')
     total_val_loss = 0
 
     # Tracking variables
@@ -320,14 +347,17 @@ def evaluate(model, data_val, val_dataloader, w, alpha):
     labels_list = []
 
     # For each batch in our validation set...
-    for batch in val_dataloader:
+    for batch in timer.loader(val_dataloader):
         # Load batch to GPU
-        c, mask, phq_scores = tuple(t.to(device) for t in batch)
+        with timer.stage('h2d'):
+            c, mask, phq_scores = tuple(t.to(device) for t in batch)
+        timer.add_samples(phq_scores.shape[0])
 
         # Compute predictions
-        with torch.no_grad():
-            logits = model.forward(c,mask)
-        val_loss = ImbOLL(logits,w,phq_scores,alpha)
+        with timer.stage('forward'), torch.no_grad(), autocast(device, bf16):
+            logits = model.forward(c,mask).float()
+        with timer.stage('loss'):
+            val_loss = ImbOLL(logits,w,phq_scores,alpha)
         total_val_loss += (val_loss.item()* float(c.shape[0]))
         preds = torch.argmax(logits, dim=1).flatten()
         accuracy = (preds == phq_scores).cpu().numpy().mean() * 100
@@ -353,12 +383,15 @@ def evaluate(model, data_val, val_dataloader, w, alpha):
     val_mae = mae_loss_fn(preds_all.float(),labels_all.float())
 
     avg_val_loss = total_val_loss / len(data_val)
+    timer.report(val_loss=avg_val_loss)
 
     return avg_val_loss,val_accuracy,val_mi_f1,val_ma_f1,val_weight_f1,val_loss_ccc,val_loss_rmse,val_mae
 
 if __name__ == '__main__':
 
     args = cmdline_args()
+    set_thread_budget(args.threads, args.interop_threads, args.cores, args.pin)
+    init_distributed(args.ddp)
     
     set_seed(args.seed)    # Set seed for reproducibility
     
@@ -369,23 +402,30 @@ if __name__ == '__main__':
     else:
         device = torch.device("cpu")
     print(f"# Using device: {device}")
+    if args.bf16 or args.bf16_parity:
+        check_bf16(device)
     
-    # Datasets
-    data_train = dds('train',args.data_path,args.label_path,args.question_number,args.missing_video_files)
-    data_val = dds('val',args.data_path,args.label_path,args.question_number,args.missing_video_files)
+    # Datasets, rank 0 fills the caches before the other ranks read them
+    with main_first():
+        # Stream the training set from shards written by questmf.shards, or build it
+        if args.shards:
+            data_train = shard_dataset(args.shards,args.question_number,['aud'],args.shuffle_buffer,args.seed)
+        else:
+            data_train = dds('train',args.data_path,args.label_path,args.question_number,args.missing_video_files,args.workers,args.pool,args.cache_dir)
+        data_val = dds('val',args.data_path,args.label_path,args.question_number,args.missing_video_files,args.workers,args.pool,args.cache_dir)
     
     # Define Model
-    model = lstm_regressor()
+    model = lstm_regressor(head=args.head)
     model.to(device)
     
     # Dataloaders
-    train_dataloader = DataLoader(data_train,  batch_size=10,shuffle=True)
-    val_dataloader = DataLoader(data_val,  batch_size=10)
+    train_dataloader = train_loader(data_train, args.batch_size, args.seed, args.loader_workers)
+    val_dataloader = DataLoader(data_val,  batch_size=args.batch_size)
     
-    num_epochs = 50
+    num_epochs = args.epochs
     
     optimizer = torch.optim.AdamW(model.parameters(),
-                      lr=5e-4,    # Default learning rate
+                      lr=scale_lr(args.lr, args.batch_size, args.lr_scale),    # 5e-4 at batch size 10 by default
                       eps=1e-8,    # Default epsilon value
                       weight_decay=1e-3)
     
@@ -397,15 +437,30 @@ if __name__ == '__main__':
     ccc_loss_fn = ccc_loss()
     mae_loss_fn = nn.L1Loss()
 
-    w = get_weights(args.question_number,args.label_path,args.beta)
+    w = get_weights(args.question_number,args.label_path,args.beta,args.cache_dir)
     
+    # Profile a window of training steps
+    profiler = make_profiler(args.profile_dir if args.profile and is_main() else None, *args.profile_steps)
+
+    # Compile for the per-rank batch size, the graphs are built on the first batch before training
+    if args.compile and args.train_model:
+        compile_model(model, train_dataloader.batch_size, args.cache_dir)
+        warm_up(model, next(iter(DataLoader(data_train, batch_size=train_dataloader.batch_size))), device, bf16=args.bf16)
+
     if args.train_model:
-        train(model, train_dataloader, data_train, data_val, args.audio_checkpoint_path + '-phq' + str(args.question_number), args.seed, w, args.alpha, val_dataloader, epochs=num_epochs, evaluation=True)
+        train(wrap_model(model), train_dataloader, data_train, data_val, args.audio_checkpoint_path + '-phq' + str(args.question_number), args.seed, w, args.alpha, val_dataloader, epochs=num_epochs, evaluation=True, metrics_path=args.metrics_path if is_main() else None, profiler=profiler, bf16=args.bf16)
+        # Wait for rank 0 to write the checkpoints
+        barrier()
     
     # Load trained model
-    best_lstm_regressor = lstm_regressor()
+    best_lstm_regressor = lstm_regressor(head=args.head)
     best_lstm_regressor.load_state_dict(torch.load(args.audio_checkpoint_path +'-phq' + str(args.question_number) + '-seed-' + str(args.seed) + '.pt'))
     best_lstm_regressor.to(device)
     
     # Evaluate trained model
-    print(evaluate(best_lstm_regressor,data_val,val_dataloader, w, args.alpha))
\ No newline at end of file
+    if args.bf16_parity:
+        names = ('Loss','Accuracy','Micro F1','Macro F1','Weighted F1','CCC','RMSE','MAE')
+        parity_report(names, evaluate(best_lstm_regressor,data_val,val_dataloader, w, args.alpha, args.metrics_path if is_main() else None), evaluate(best_lstm_regressor,data_val,val_dataloader, w, args.alpha, args.metrics_path if is_main() else None, bf16=True))
+    else:
+        print(evaluate(best_lstm_regressor,data_val,val_dataloader, w, args.alpha, args.metrics_path if is_main() else None, bf16=args.bf16))
+    cleanup()
\ No newline at end of file
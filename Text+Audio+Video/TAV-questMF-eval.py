@@ -10,6 +10,23 @@ import torch.nn.functional as F
 import librosa
 import os
 import argparse
+import sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from questmf.instrument import stage_timer
+from questmf.profiling import make_profiler, profile_range
+from torch.profiler import record_function
+from questmf.corpus import scan_corpus
+from questmf.feature_cache import egemaps_cache, resnet_cache, open_features, segment_means
+from questmf.records import session, memory_report
+from questmf.text_embed import precompute_text
+from questmf.threads import set_thread_budget
+from questmf.precision import autocast, check_bf16, parity_report
+from questmf.compile import compile_model, warm_up
+from questmf.attention import fused_attention
+from questmf.config import parse_args
+from questmf.heads import HEADS, make_head, apply_head
+from questmf.prune import load_checkpoint
+from questmf.logits_store import save_logits
 
 def cmdline_args():
     # Make parser object
@@ -22,8 +39,28 @@ def cmdline_args():
     p.add_argument("-v_ckpt", "--video_checkpoint_path", type=str, help="Path to checkpoint for the video model")
     p.add_argument("-tav_ckpt", "--tav_checkpoint_path", type=str, help="Path to checkpoint for the text+audio+video model")
     p.add_argument("-m_files", "--missing_video_files",nargs='+', type=int, help="List of file numbers for incomplete video files")
-
-    return (p.parse_args())
+    p.add_argument("-metrics", "--metrics_path", type=str, help="JSONL file for per-stage timing metrics")
+    p.add_argument("-profile", "--profile", action='store_true', help="Profile a window of steps with torch.profiler")
+    p.add_argument("-profile_dir", "--profile_dir", type=str, default='profile', help="Directory for profiler traces and the top-ops table")
+    p.add_argument("-profile_steps", "--profile_steps", nargs=3, type=int, default=[1,1,5], help="Number of steps to skip, warm up and record")
+    p.add_argument("-workers", "--workers", type=int, default=8, help="Number of workers for reading the participant files")
+    p.add_argument("-pool", "--pool", type=str, default='thread', choices=['thread','process'], help="Use a thread or a process pool for reading the participant files")
+    p.add_argument("-cache_dir", "--cache_dir", type=str, default='cache', help="Directory for the cached sentence embeddings and the float32 copies of the eGeMAPS and ResNet features")
+    p.add_argument("-threads", "--threads", type=int, help="Number of intra-op threads (default: one per core in -cores, else all cores)")
+    p.add_argument("-interop_threads", "--interop_threads", type=int, help="Number of inter-op threads")
+    p.add_argument("-cores", "--cores", type=str, help="Cores for this process, e.g. 0-7")
+    p.add_argument("-pin", "--pin", action='store_true', help="Pin the process to the cores given in -cores")
+    p.add_argument("-bf16", "--bf16", action='store_true', help="Run the forward passes under bf16 autocast, the weights stay float32")
+    p.add_argument("-bf16_parity", "--bf16_parity", action='store_true', help="Evaluate in float32 and in bf16 and compare the metrics")
+    p.add_argument("-compile", "--compile", action='store_true', help="Compile the model with torch.compile, the kernels are cached in <cache_dir>/inductor")
+    p.add_argument("-fused_attn", "--fused_attn", action='store_true', help="Run the cross and self attention blocks of the fusion model together, with packed projections and scaled dot product attention")
+    p.add_argument("-bs", "--batch_size", type=int, default=10, help="Batch size for evaluation")
+    p.add_argument("-config", "--config", type=str, help="JSON or YAML file with defaults for any of these options, e.g. {\"bs\": 32}")
+    p.add_argument("-head", "--head", type=str, default='flatten', choices=HEADS, help="Classification head of every model: the flattened MLP of the paper, or masked mean+max or attention pooling over the turns")
+    p.add_argument("-logits_store", "--logits_store", type=str, help="SQLite file to store the per-question logits of every participant in, see questmf.logits_store")
+    p.add_argument("-store_splits", "--store_splits", nargs='+', default=['test'], choices=['train','val','test'], help="Splits whose logits go to -logits_store")
+
+    return (parse_args(p))
 
 # Mean Pooling - Take attention mask into account for correct averaging
 def mean_pooling(model_output, attention_mask):
@@ -39,8 +76,75 @@ def set_seed(seed_value=42):
     torch.manual_seed(seed_value)
     torch.cuda.manual_seed_all(seed_value)
 
+def load_participant(p_id_int,data_path,score,cache_dir):
+    """Read the transcript and features of one participant.
+    """
+    p_id = str(p_id_int)
+    df_txt = pd.read_csv(data_path + p_id + '_P/' + p_id + '_Transcript.csv')
+    txt_list = df_txt['Text'].tolist()
+    vid_file = data_path + p_id + '_P/features/' + p_id + '_CNN_ResNet.mat'
+    speech_file = data_path + p_id + '_P/' + p_id + '_AUDIO.wav'
+    t = librosa.get_duration(path=speech_file)
+    # Sampling-rate = 100
+    # Preprocessing start and end times
+    max_times = t*100
+    # float32 copy of the eGeMAPS features, memory mapped in the preprocessing
+    egemaps_file = egemaps_cache(data_path + p_id + '_P/features/' + p_id + '_OpenSMILE2.3.0_egemaps.csv',cache_dir)
+    start_times_aud = (df_txt['Start_Time'].values*100).tolist()
+    end_times_aud = (df_txt['End_Time'].values*100).tolist()
+
+    x_aud = 1
+    y_aud = len(start_times_aud)
+    
+    while x_aud < y_aud:
+        if start_times_aud[x_aud-1]>start_times_aud[x_aud] or start_times_aud[x_aud]>max_times:
+            del start_times_aud[x_aud]
+            del end_times_aud[x_aud]
+            x_aud = x_aud-1
+            y_aud = y_aud-1
+        if end_times_aud[x_aud-1]>end_times_aud[x_aud] or end_times_aud[x_aud]>max_times:
+            del start_times_aud[x_aud]
+            del end_times_aud[x_aud]
+            x_aud = x_aud-1
+            y_aud = y_aud-1
+        x_aud = x_aud+1
+    
+    start_times_aud = [round(a) for a in start_times_aud]
+    end_times_aud = [round(b) for b in end_times_aud]
+    
+    # float32 copy of the ResNet features, memory mapped in the preprocessing
+    vid_feat_file = resnet_cache(vid_file,cache_dir)
+    vid_feat = open_features(vid_feat_file)
+    feat_len = len(vid_feat)
+    
+    # Sampling rate for video
+    m_factor = feat_len/t
+    
+    # Preprocessing start and end times for video
+    start_times_vid = (df_txt['Start_Time'].values*m_factor).tolist()
+    end_times_vid = (df_txt['End_Time'].values*m_factor).tolist()
+
+    x_vid = 1
+    y_vid = len(start_times_vid)
+    while x_vid < y_vid:
+        if start_times_vid[x_vid-1]>start_times_vid[x_vid] or start_times_vid[x_vid]>feat_len:
+            del start_times_vid[x_vid]
+            del end_times_vid[x_vid]
+            x_vid = x_vid-1
+            y_vid = y_vid-1
+        if end_times_vid[x_vid-1]>end_times_vid[x_vid] or end_times_vid[x_vid]>feat_len:
+            del start_times_vid[x_vid]
+            del end_times_vid[x_vid]
+            x_vid = x_vid-1
+            y_vid = y_vid-1
+        x_vid = x_vid+1
+    
+    start_times_vid = [round(a) for a in start_times_vid]
+    end_times_vid = [round(b) for b in end_times_vid]
+    return session(p_id_int,float(score),txt=txt_list,aud_file=egemaps_file,aud_start=start_times_aud,aud_end=end_times_aud,vid_file=vid_feat_file,vid_start=start_times_vid,vid_end=end_times_vid)
+
 class dds(Dataset):
-    def __init__(self,split,data_path,label_path,missing_files_list):
+    def __init__(self,split,data_path,label_path,missing_files_list,workers=1,pool='thread',cache_dir='cache'):
         super(dds,self).__init__()
         self.PAD = tokenizer_txt.pad_token_id
         if split == 'train':
@@ -51,81 +155,36 @@ class dds(Dataset):
             df_data = pd.read_csv(label_path + 'test_split.csv')
         else:
             raise Exception(f"wrong split: {split}")
-        self.data = []
         p_id_list = df_data['Participant_ID'].tolist()
         phq_score_list = df_data['PHQ_Score'].tolist()
-        for i in range(len(p_id_list)):
-            p_id = str(p_id_list[i])
-            # Files not complete for video
-            if p_id_list[i] in missing_files_list:
-                continue
-            df_txt = pd.read_csv(data_path + p_id + '_P/' + p_id + '_Transcript.csv')
-            txt_list = df_txt['Text'].tolist()
-            vid_file = data_path + p_id + '_P/features/' + p_id + '_CNN_ResNet.mat'
-            speech_file = data_path + p_id + '_P/' + p_id + '_AUDIO.wav'
-            t = librosa.get_duration(path=speech_file)
-            # Sampling-rate = 100
-            # Preprocessing start and end times
-            max_times = t*100
-            df_speech = pd.read_csv(data_path + p_id + '_P/features/' + p_id + '_OpenSMILE2.3.0_egemaps.csv',sep=";")
-            start_times_aud = (df_txt['Start_Time'].values*100).tolist()
-            end_times_aud = (df_txt['End_Time'].values*100).tolist()
-
-            x_aud = 1
-            y_aud = len(start_times_aud)
-            
-            while x_aud < y_aud:
-                if start_times_aud[x_aud-1]>start_times_aud[x_aud] or start_times_aud[x_aud]>max_times:
-                    del start_times_aud[x_aud]
-                    del end_times_aud[x_aud]
-                    x_aud = x_aud-1
-                    y_aud = y_aud-1
-                if end_times_aud[x_aud-1]>end_times_aud[x_aud] or end_times_aud[x_aud]>max_times:
-                    del start_times_aud[x_aud]
-                    del end_times_aud[x_aud]
-                    x_aud = x_aud-1
-                    y_aud = y_aud-1
-                x_aud = x_aud+1
-            
-            start_times_aud = [round(a) for a in start_times_aud]
-            end_times_aud = [round(b) for b in end_times_aud]
-            
-            self.data.append([txt_list,df_speech,start_times_aud,end_times_aud,vid_file,df_txt,t,float(phq_score_list[i])])
+        # Files not complete for video
+        jobs = [(p_id,data_path,score,cache_dir) for p_id,score in zip(p_id_list,phq_score_list) if p_id not in missing_files_list]
+        # Participants are read on a bounded pool, in split order
+        self.data = scan_corpus(load_participant, jobs, workers, pool)
+        # Embed the transcripts once, in length-sorted batches across sessions
+        precompute_text(self.data,cache_dir,tokenizer_txt,embedder_txt,device)
+        memory_report(split,self.data)
     
     # Text Preprocess
-    def preprocess_txt(self,txt_list):
-        encoded_input = tokenizer_txt(txt_list, padding=True, truncation=True, return_tensors='pt').to(device)
-        l = len(txt_list)
-        # Maximum number of turns
-        if l > 120:
-            l = 120
+    @profile_range('preprocess_txt')
+    def preprocess_txt(self,txt_file):
+        # Sentence embeddings of the first 120 turns, computed once in precompute_text
+        sentence_embeddings = torch.from_numpy(np.load(txt_file))
+        l = len(sentence_embeddings)
         # Mask for attention layer
         mask_txt = torch.tensor([False]*l)
-        # Compute token embeddings
-        with torch.no_grad():
-            embedder_output = embedder_txt(**encoded_input)
-        # Perform mean pooling
-        sentence_embeddings = mean_pooling(embedder_output, encoded_input['attention_mask'])[:l]
         if l < 120:
-            z = torch.zeros(120-l,768).to(device)
+            z = torch.zeros(120-l,768)
             sentence_embeddings = torch.cat((sentence_embeddings,z),dim=0)
             mask_txt = torch.cat((mask_txt,torch.tensor([True]*(120-l))))
-        sentence_embeddings = F.normalize(sentence_embeddings, p=2, dim=1)
-        return sentence_embeddings.detach().cpu(),mask_txt
+        return sentence_embeddings,mask_txt
 
     # Audio Preprocess
-    def preprocess_aud(self,df_speech,start_times_aud,end_times_aud):
-        df_mod = df_speech.iloc[:,2:]
-        speech= df_mod.values.tolist()
-        speech_0 = torch.tensor(speech[start_times_aud[0]:end_times_aud[0]]).unsqueeze(0)
-        out_aud = torch.mean(speech_0, dim=1)
-        out_aud = out_aud.detach().cpu()
-
-        for i in range(1,len(start_times_aud)):
-            speech_mod = torch.tensor(speech[start_times_aud[i]:end_times_aud[i]]).unsqueeze(0)
-            mean_i_aud = torch.mean(speech_mod, dim=1)
-            mean_i_aud = mean_i_aud.detach().cpu()
-            out_aud = torch.cat((out_aud,mean_i_aud),dim=0)
+    @profile_range('preprocess_aud')
+    def preprocess_aud(self,egemaps_file,start_times_aud,end_times_aud):
+        speech = open_features(egemaps_file)
+        # Mean over the frames of every turn, only the first 120 turns are kept
+        out_aud = torch.from_numpy(segment_means(speech,start_times_aud[:120],end_times_aud[:120]))
         
         l_aud = len(start_times_aud)
         if l_aud > 120:
@@ -140,47 +199,11 @@ class dds(Dataset):
         return out_aud,mask_aud
 
     # Video Preprocess
-    def preprocess_vid(self,vid_file,df_txt,t):
-        vid_data = sio.loadmat(vid_file)
-        vid_feat = vid_data['feature']
-        feat_len = len(vid_feat)
-        
-        # Sampling rate for video
-        m_factor = feat_len/t
-        
-        # Preprocessing start and end times for video
-        start_times_vid = (df_txt['Start_Time'].values*m_factor).tolist()
-        end_times_vid = (df_txt['End_Time'].values*m_factor).tolist()
-
-        x_vid = 1
-        y_vid = len(start_times_vid)
-        while x_vid < y_vid:
-            if start_times_vid[x_vid-1]>start_times_vid[x_vid] or start_times_vid[x_vid]>feat_len:
-                del start_times_vid[x_vid]
-                del end_times_vid[x_vid]
-                x_vid = x_vid-1
-                y_vid = y_vid-1
-            if end_times_vid[x_vid-1]>end_times_vid[x_vid] or end_times_vid[x_vid]>feat_len:
-                del start_times_vid[x_vid]
-                del end_times_vid[x_vid]
-                x_vid = x_vid-1
-                y_vid = y_vid-1
-            x_vid = x_vid+1
-        
-        start_times_vid = [round(a) for a in start_times_vid]
-        end_times_vid = [round(b) for b in end_times_vid]
-        
-        vid_feat_0 = torch.tensor(vid_feat[start_times_vid[0]:end_times_vid[0]]).unsqueeze(0)
-        # Mean pooling
-        out_vid = torch.mean(vid_feat_0,dim=1)
-        out_vid = out_vid.detach().cpu()
-
-        for i in range(1,len(start_times_vid)):
-            vid_feat_i = torch.tensor(vid_feat[start_times_vid[i]:end_times_vid[i]]).unsqueeze(0)
-            # Mean pooling
-            vid_mean_i = torch.mean(vid_feat_i,dim=1)
-            vid_mean_i = vid_mean_i.detach().cpu()
-            out_vid = torch.cat((out_vid,vid_mean_i),dim=0)
+    @profile_range('preprocess_vid')
+    def preprocess_vid(self,vid_feat_file,start_times_vid,end_times_vid):
+        vid_feat = open_features(vid_feat_file)
+        # Mean pooling over the frames of every turn, only the first 120 turns are kept
+        out_vid = torch.from_numpy(segment_means(vid_feat,start_times_vid[:120],end_times_vid[:120]))
         l_vid = len(start_times_vid)
         # Maximum number of turns
         if l_vid > 120:
@@ -196,15 +219,16 @@ class dds(Dataset):
         return out_vid,mask_vid
         
     def __getitem__(self,index):
-        embedding_txt, mask_txt = self.preprocess_txt(self.data[index][0])
-        embedding_aud, mask_aud = self.preprocess_aud(self.data[index][1],self.data[index][2],self.data[index][3])
-        embedding_vid, mask_vid = self.preprocess_vid(self.data[index][4],self.data[index][5],self.data[index][6])
-        return [embedding_txt,mask_txt,embedding_aud,mask_aud,embedding_vid,mask_vid,self.data[index][7]]
+        s = self.data[index]
+        embedding_txt, mask_txt = self.preprocess_txt(s.txt_file)
+        embedding_aud, mask_aud = self.preprocess_aud(s.aud_file,s.aud_start,s.aud_end)
+        embedding_vid, mask_vid = self.preprocess_vid(s.vid_file,s.vid_start,s.vid_end)
+        return [embedding_txt,mask_txt,embedding_aud,mask_aud,embedding_vid,mask_vid,s.label]
     def __len__(self):
         return len(self.data)
 
 class lstm_regressor_txt(nn.Module):
-    def __init__(self):
+    def __init__(self,head='flatten'):
         super(lstm_regressor_txt, self).__init__()
         self.lstm_1 = nn.LSTM(768,50,batch_first=True,bidirectional=True)
         self.attention = nn.MultiheadAttention(100, 4,batch_first=True,dropout=0.5)
@@ -214,15 +238,17 @@ class lstm_regressor_txt(nn.Module):
                                 nn.ReLU(),
                                 nn.Dropout(0.2),
                                 nn.Linear(256,4))
+        self.mlp = make_head(head,self.mlp)
 
+    @profile_range('txt_encoder')
     def forward(self,C,key_padding_mask):
         c_lstm,_ = self.lstm_1(C)
         c_att,_ = self.attention(c_lstm,c_lstm,c_lstm,key_padding_mask=key_padding_mask)
-        logits = self.mlp(c_att)
+        logits = apply_head(self.mlp,c_att,key_padding_mask)
         return logits,c_att
 
 class lstm_regressor_aud(nn.Module):
-    def __init__(self):
+    def __init__(self,head='flatten'):
         super(lstm_regressor_aud, self).__init__()
         self.lstm_1 = nn.LSTM(23,50,batch_first=True,bidirectional=True)
         self.attention1 = nn.MultiheadAttention(100, 4,batch_first=True,dropout=0.2)
@@ -233,16 +259,18 @@ class lstm_regressor_aud(nn.Module):
                                 nn.ReLU(),
                                 nn.Dropout(0.2),
                                 nn.Linear(256,4))
+        self.mlp = make_head(head,self.mlp)
 
+    @profile_range('aud_encoder')
     def forward(self,C,key_padding_mask):
         c_lstm,_ = self.lstm_1(C)
         c_att,_ = self.attention1(c_lstm,c_lstm,c_lstm,key_padding_mask=key_padding_mask)
         c_att2,_ = self.attention2(c_att,c_att,c_att,key_padding_mask=key_padding_mask)
-        logits = self.mlp(c_att2)
+        logits = apply_head(self.mlp,c_att2,key_padding_mask)
         return logits,c_att2
 
 class lstm_regressor_vid(nn.Module):
-    def __init__(self):
+    def __init__(self,head='flatten'):
         super(lstm_regressor_vid, self).__init__()
         self.lstm_1 = nn.LSTM(2048,50,batch_first=True,bidirectional=True)
         self.attention1 = nn.MultiheadAttention(100, 4,batch_first=True,dropout=0.2)
@@ -253,20 +281,23 @@ class lstm_regressor_vid(nn.Module):
                                 nn.ReLU(),
                                 nn.Dropout(0.2),
                                 nn.Linear(256,4))
+        self.mlp = make_head(head,self.mlp)
 
+    @profile_range('vid_encoder')
     def forward(self,C,key_padding_mask):
         c_lstm,_ = self.lstm_1(C)
         c_att,_ = self.attention1(c_lstm,c_lstm,c_lstm,key_padding_mask=key_padding_mask)
         c_att2,_ = self.attention2(c_att,c_att,c_att,key_padding_mask=key_padding_mask)
-        logits = self.mlp(c_att2)
+        logits = apply_head(self.mlp,c_att2,key_padding_mask)
         return logits,c_att2
 
 class lstm_regressor(nn.Module):
-    def __init__(self,txt_model,aud_model,vid_model):
+    def __init__(self,txt_model,aud_model,vid_model,fused_attn=False,head='flatten'):
         super(lstm_regressor, self).__init__()
         self.txt_model = txt_model
         self.aud_model = aud_model
         self.vid_model = vid_model
+        self.fused_attn = fused_attn
 
         self.cross_aud_txt = nn.MultiheadAttention(100, 4,batch_first=True,dropout=0.8)
         self.cross_txt_aud = nn.MultiheadAttention(100, 4,batch_first=True,dropout=0.8)
@@ -286,6 +317,7 @@ class lstm_regressor(nn.Module):
                                 nn.ReLU(),
                                 nn.Dropout(0.5),
                                 nn.Linear(256,4))
+        self.mlp = make_head(head,self.mlp,3)
 
 
         # Freeze Text Encoder
@@ -300,23 +332,39 @@ class lstm_regressor(nn.Module):
 
         _,c_att_vid = self.vid_model(C_vid,key_padding_mask_vid)
 
-        c_aud_txt,_ = self.cross_aud_txt(c_att_aud,c_att_txt,c_att_txt,key_padding_mask=key_padding_mask_txt)
-        c_txt_aud,_ = self.cross_txt_aud(c_att_txt,c_att_aud,c_att_aud,key_padding_mask=key_padding_mask_aud)
-        c_vid_aud,_ = self.cross_vid_aud(c_att_vid,c_att_aud,c_att_aud,key_padding_mask=key_padding_mask_aud)
-        c_aud_vid,_ = self.cross_aud_vid(c_att_aud,c_att_vid,c_att_vid,key_padding_mask=key_padding_mask_vid)
-        c_txt_vid,_ = self.cross_txt_vid(c_att_txt,c_att_vid,c_att_vid,key_padding_mask=key_padding_mask_vid)
-        c_vid_txt,_ = self.cross_vid_txt(c_att_vid,c_att_txt,c_att_txt,key_padding_mask=key_padding_mask_txt)
+        with record_function('cross_attention'):
+            if self.fused_attn:
+                c_aud_txt,c_txt_aud,c_vid_aud,c_aud_vid,c_txt_vid,c_vid_txt = fused_attention(
+                    (self.cross_aud_txt,self.cross_txt_aud,self.cross_vid_aud,self.cross_aud_vid,self.cross_txt_vid,self.cross_vid_txt),
+                    (c_att_aud,c_att_txt,c_att_vid,c_att_aud,c_att_txt,c_att_vid),
+                    (c_att_txt,c_att_aud,c_att_aud,c_att_vid,c_att_vid,c_att_txt),
+                    (key_padding_mask_txt,key_padding_mask_aud,key_padding_mask_aud,key_padding_mask_vid,key_padding_mask_vid,key_padding_mask_txt))
+            else:
+                c_aud_txt,_ = self.cross_aud_txt(c_att_aud,c_att_txt,c_att_txt,key_padding_mask=key_padding_mask_txt)
+                c_txt_aud,_ = self.cross_txt_aud(c_att_txt,c_att_aud,c_att_aud,key_padding_mask=key_padding_mask_aud)
+                c_vid_aud,_ = self.cross_vid_aud(c_att_vid,c_att_aud,c_att_aud,key_padding_mask=key_padding_mask_aud)
+                c_aud_vid,_ = self.cross_aud_vid(c_att_aud,c_att_vid,c_att_vid,key_padding_mask=key_padding_mask_vid)
+                c_txt_vid,_ = self.cross_txt_vid(c_att_txt,c_att_vid,c_att_vid,key_padding_mask=key_padding_mask_vid)
+                c_vid_txt,_ = self.cross_vid_txt(c_att_vid,c_att_txt,c_att_txt,key_padding_mask=key_padding_mask_txt)
 
         c_aud_txt_vid = torch.cat((c_aud_txt,c_aud_vid),dim=2)
         c_vid_txt_aud = torch.cat((c_vid_txt,c_vid_aud),dim=2)
         c_txt_aud_vid = torch.cat((c_txt_aud,c_txt_vid),dim=2)
 
-        c_att_aud_txt_vid,_ = self.self_aud_txt_vid(c_aud_txt_vid,c_aud_txt_vid,c_aud_txt_vid,key_padding_mask=key_padding_mask_aud)
-        c_att_vid_txt_aud,_ = self.self_vid_txt_aud(c_vid_txt_aud,c_vid_txt_aud,c_vid_txt_aud,key_padding_mask=key_padding_mask_vid)
-        c_att_txt_aud_vid,_ = self.self_txt_aud_vid(c_txt_aud_vid,c_txt_aud_vid,c_txt_aud_vid,key_padding_mask=key_padding_mask_txt)
+        with record_function('self_attention'):
+            if self.fused_attn:
+                c_att_aud_txt_vid,c_att_vid_txt_aud,c_att_txt_aud_vid = fused_attention(
+                    (self.self_aud_txt_vid,self.self_vid_txt_aud,self.self_txt_aud_vid),
+                    (c_aud_txt_vid,c_vid_txt_aud,c_txt_aud_vid),
+                    (c_aud_txt_vid,c_vid_txt_aud,c_txt_aud_vid),
+                    (key_padding_mask_aud,key_padding_mask_vid,key_padding_mask_txt))
+            else:
+                c_att_aud_txt_vid,_ = self.self_aud_txt_vid(c_aud_txt_vid,c_aud_txt_vid,c_aud_txt_vid,key_padding_mask=key_padding_mask_aud)
+                c_att_vid_txt_aud,_ = self.self_vid_txt_aud(c_vid_txt_aud,c_vid_txt_aud,c_vid_txt_aud,key_padding_mask=key_padding_mask_vid)
+                c_att_txt_aud_vid,_ = self.self_txt_aud_vid(c_txt_aud_vid,c_txt_aud_vid,c_txt_aud_vid,key_padding_mask=key_padding_mask_txt)
 
         c_comb = torch.cat((c_att_aud_txt_vid,c_att_vid_txt_aud,c_att_txt_aud_vid),dim=2)
-        pred = self.mlp(c_comb)
+        pred = apply_head(self.mlp,c_comb,(key_padding_mask_aud,key_padding_mask_vid,key_padding_mask_txt))
 
         return pred
 
@@ -344,7 +392,7 @@ class ccc_loss(nn.Module):
         ccc = numerator/denominator
         return 1-ccc
 
-def evaluate(model1,model2,model3,model4,model5,model6,model7,model8, val_dataloader):
+def evaluate(model1,model2,model3,model4,model5,model6,model7,model8, val_dataloader, metrics_path=None, profiler=None, bf16=False, logits_out=None):
     """After the completion of each training epoch, measure the model's performance
     on our validation set.
     """
@@ -358,18 +406,23 @@ def evaluate(model1,model2,model3,model4,model5,model6,model7,model8, val_datalo
     model6.eval()
     model7.eval()
     model8.eval()
+    timer = stage_timer(device, metrics_path, phase='eval')
+    profiler = profiler or make_profiler(None)
+    profiler.start()
 
     # Tracking variables
     preds_list = []
     labels_list = []
 
     # For each batch in our validation set...
-    for batch in val_dataloader:
+    for batch in timer.loader(val_dataloader):
         # Load batch to GPU
-        c_txt, mask_txt, c_aud, mask_aud, c_vid, mask_vid, phq_scores = tuple(t.to(device) for t in batch)
+        with timer.stage('h2d'):
+            c_txt, mask_txt, c_aud, mask_aud, c_vid, mask_vid, phq_scores = tuple(t.to(device) for t in batch)
+        timer.add_samples(phq_scores.shape[0])
 
         # Compute predictions
-        with torch.no_grad():
+        with timer.stage('forward'), torch.no_grad(), autocast(device, bf16):
             logits1 = model1.forward(c_txt,mask_txt,c_aud,mask_aud,c_vid,mask_vid)
             logits2 = model2.forward(c_txt,mask_txt,c_aud,mask_aud,c_vid,mask_vid)
             logits3 = model3.forward(c_txt,mask_txt,c_aud,mask_aud,c_vid,mask_vid)
@@ -378,6 +431,8 @@ def evaluate(model1,model2,model3,model4,model5,model6,model7,model8, val_datalo
             logits6 = model6.forward(c_txt,mask_txt,c_aud,mask_aud,c_vid,mask_vid)
             logits7 = model7.forward(c_txt,mask_txt,c_aud,mask_aud,c_vid,mask_vid)
             logits8 = model8.forward(c_txt,mask_txt,c_aud,mask_aud,c_vid,mask_vid)
+        if logits_out is not None:
+            logits_out.append(torch.stack([logits1,logits2,logits3,logits4,logits5,logits6,logits7,logits8], dim=1).float().cpu())
 
         # Compute preds
         preds1 = torch.argmax(logits1, dim=1).flatten()
@@ -392,10 +447,13 @@ def evaluate(model1,model2,model3,model4,model5,model6,model7,model8, val_datalo
         preds = preds1+preds2+preds3+preds4+preds5+preds6+preds7+preds8
         preds_list.append(preds)
         labels_list.append(phq_scores)
+        profiler.step()
 
     # Compute the CCC, RMSE and MAE
     preds_all = torch.cat(preds_list, dim=0)
     labels_all = torch.cat(labels_list, dim=0)
+    profiler.stop()
+    timer.report()
     val_loss_ccc = 1 - ccc_loss_fn(preds_all.float(), labels_all.float())
     val_loss_rmse = torch.sqrt(loss_fn_mse(preds_all.float(), labels_all.float()))
     val_loss_mae = mae_loss_fn(preds_all.float(),labels_all.float())
@@ -405,6 +463,7 @@ def evaluate(model1,model2,model3,model4,model5,model6,model7,model8, val_datalo
 if __name__ == '__main__':
 
     args = cmdline_args()
+    set_thread_budget(args.threads, args.interop_threads, args.cores, args.pin)
 
     set_seed(args.seed)    # Set seed for reproducibility
 
@@ -415,35 +474,37 @@ if __name__ == '__main__':
     else:
         device = torch.device("cpu")
     print(f"# Using device: {device}")
+    if args.bf16 or args.bf16_parity:
+        check_bf16(device)
 
     # Load model from HuggingFace Hub
     tokenizer_txt = AutoTokenizer.from_pretrained('sentence-transformers/all-distilroberta-v1')
     embedder_txt = AutoModel.from_pretrained('sentence-transformers/all-distilroberta-v1').to(device)
     
     # Datasets
-    data_train = dds('train',args.data_path,args.label_path,args.missing_video_files)
-    data_val = dds('val',args.data_path,args.label_path,args.missing_video_files)
-    data_test = dds('test',args.data_path,args.label_path,args.missing_video_files)
+    data_train = dds('train',args.data_path,args.label_path,args.missing_video_files,args.workers,args.pool,args.cache_dir)
+    data_val = dds('val',args.data_path,args.label_path,args.missing_video_files,args.workers,args.pool,args.cache_dir)
+    data_test = dds('test',args.data_path,args.label_path,args.missing_video_files,args.workers,args.pool,args.cache_dir)
     
     # Define Text Encoder for each Question
-    t1 = lstm_regressor_txt()
-    t2 = lstm_regressor_txt()
-    t3 = lstm_regressor_txt()
-    t4 = lstm_regressor_txt()
-    t5 = lstm_regressor_txt()
-    t6 = lstm_regressor_txt()
-    t7 = lstm_regressor_txt()
-    t8 = lstm_regressor_txt()
+    t1 = lstm_regressor_txt(head=args.head)
+    t2 = lstm_regressor_txt(head=args.head)
+    t3 = lstm_regressor_txt(head=args.head)
+    t4 = lstm_regressor_txt(head=args.head)
+    t5 = lstm_regressor_txt(head=args.head)
+    t6 = lstm_regressor_txt(head=args.head)
+    t7 = lstm_regressor_txt(head=args.head)
+    t8 = lstm_regressor_txt(head=args.head)
     
     # Load pretrained weights for text encoder
-    t1.load_state_dict(torch.load(args.text_checkpoint_path + '-phq1-seed-' + str(args.seed) + '.pt'))
-    t2.load_state_dict(torch.load(args.text_checkpoint_path + '-phq2-seed-' + str(args.seed) + '.pt'))
-    t3.load_state_dict(torch.load(args.text_checkpoint_path + '-phq3-seed-' + str(args.seed) + '.pt'))
-    t4.load_state_dict(torch.load(args.text_checkpoint_path + '-phq4-seed-' + str(args.seed) + '.pt'))
-    t5.load_state_dict(torch.load(args.text_checkpoint_path + '-phq5-seed-' + str(args.seed) + '.pt'))
-    t6.load_state_dict(torch.load(args.text_checkpoint_path + '-phq6-seed-' + str(args.seed) + '.pt'))
-    t7.load_state_dict(torch.load(args.text_checkpoint_path + '-phq7-seed-' + str(args.seed) + '.pt'))
-    t8.load_state_dict(torch.load(args.text_checkpoint_path + '-phq8-seed-' + str(args.seed) + '.pt'))
+    load_checkpoint(t1, args.text_checkpoint_path + '-phq1-seed-' + str(args.seed) + '.pt')
+    load_checkpoint(t2, args.text_checkpoint_path + '-phq2-seed-' + str(args.seed) + '.pt')
+    load_checkpoint(t3, args.text_checkpoint_path + '-phq3-seed-' + str(args.seed) + '.pt')
+    load_checkpoint(t4, args.text_checkpoint_path + '-phq4-seed-' + str(args.seed) + '.pt')
+    load_checkpoint(t5, args.text_checkpoint_path + '-phq5-seed-' + str(args.seed) + '.pt')
+    load_checkpoint(t6, args.text_checkpoint_path + '-phq6-seed-' + str(args.seed) + '.pt')
+    load_checkpoint(t7, args.text_checkpoint_path + '-phq7-seed-' + str(args.seed) + '.pt')
+    load_checkpoint(t8, args.text_checkpoint_path + '-phq8-seed-' + str(args.seed) + '.pt')
 
     t1.to(device)
     t2.to(device)
@@ -455,24 +516,24 @@ if __name__ == '__main__':
     t8.to(device)
 
     # Define Audio Encoder for each Question
-    a1 = lstm_regressor_aud()
-    a2 = lstm_regressor_aud()
-    a3 = lstm_regressor_aud()
-    a4 = lstm_regressor_aud()
-    a5 = lstm_regressor_aud()
-    a6 = lstm_regressor_aud()
-    a7 = lstm_regressor_aud()
-    a8 = lstm_regressor_aud()
+    a1 = lstm_regressor_aud(head=args.head)
+    a2 = lstm_regressor_aud(head=args.head)
+    a3 = lstm_regressor_aud(head=args.head)
+    a4 = lstm_regressor_aud(head=args.head)
+    a5 = lstm_regressor_aud(head=args.head)
+    a6 = lstm_regressor_aud(head=args.head)
+    a7 = lstm_regressor_aud(head=args.head)
+    a8 = lstm_regressor_aud(head=args.head)
     
     # Load pretrained weights for audio encoder
-    a1.load_state_dict(torch.load(args.audio_checkpoint_path + '-phq1-seed-' + str(args.seed) + '.pt'))
-    a2.load_state_dict(torch.load(args.audio_checkpoint_path + '-phq2-seed-' + str(args.seed) + '.pt'))
-    a3.load_state_dict(torch.load(args.audio_checkpoint_path + '-phq3-seed-' + str(args.seed) + '.pt'))
-    a4.load_state_dict(torch.load(args.audio_checkpoint_path + '-phq4-seed-' + str(args.seed) + '.pt'))
-    a5.load_state_dict(torch.load(args.audio_checkpoint_path + '-phq5-seed-' + str(args.seed) + '.pt'))
-    a6.load_state_dict(torch.load(args.audio_checkpoint_path + '-phq6-seed-' + str(args.seed) + '.pt'))
-    a7.load_state_dict(torch.load(args.audio_checkpoint_path + '-phq7-seed-' + str(args.seed) + '.pt'))
-    a8.load_state_dict(torch.load(args.audio_checkpoint_path + '-phq8-seed-' + str(args.seed) + '.pt'))
+    load_checkpoint(a1, args.audio_checkpoint_path + '-phq1-seed-' + str(args.seed) + '.pt')
+    load_checkpoint(a2, args.audio_checkpoint_path + '-phq2-seed-' + str(args.seed) + '.pt')
+    load_checkpoint(a3, args.audio_checkpoint_path + '-phq3-seed-' + str(args.seed) + '.pt')
+    load_checkpoint(a4, args.audio_checkpoint_path + '-phq4-seed-' + str(args.seed) + '.pt')
+    load_checkpoint(a5, args.audio_checkpoint_path + '-phq5-seed-' + str(args.seed) + '.pt')
+    load_checkpoint(a6, args.audio_checkpoint_path + '-phq6-seed-' + str(args.seed) + '.pt')
+    load_checkpoint(a7, args.audio_checkpoint_path + '-phq7-seed-' + str(args.seed) + '.pt')
+    load_checkpoint(a8, args.audio_checkpoint_path + '-phq8-seed-' + str(args.seed) + '.pt')
     
     a1.to(device)
     a2.to(device)
@@ -484,24 +545,24 @@ if __name__ == '__main__':
     a8.to(device)
 
     # Define Video Encoder for each Question
-    v1 = lstm_regressor_vid()
-    v2 = lstm_regressor_vid()
-    v3 = lstm_regressor_vid()
-    v4 = lstm_regressor_vid()
-    v5 = lstm_regressor_vid()
-    v6 = lstm_regressor_vid()
-    v7 = lstm_regressor_vid()
-    v8 = lstm_regressor_vid()
+    v1 = lstm_regressor_vid(head=args.head)
+    v2 = lstm_regressor_vid(head=args.head)
+    v3 = lstm_regressor_vid(head=args.head)
+    v4 = lstm_regressor_vid(head=args.head)
+    v5 = lstm_regressor_vid(head=args.head)
+    v6 = lstm_regressor_vid(head=args.head)
+    v7 = lstm_regressor_vid(head=args.head)
+    v8 = lstm_regressor_vid(head=args.head)
     
     # Load pretrained weights for video encoder
-    v1.load_state_dict(torch.load(args.video_checkpoint_path + '-phq1-seed-' + str(args.seed) + '.pt'))
-    v2.load_state_dict(torch.load(args.video_checkpoint_path + '-phq2-seed-' + str(args.seed) + '.pt'))
-    v3.load_state_dict(torch.load(args.video_checkpoint_path + '-phq3-seed-' + str(args.seed) + '.pt'))
-    v4.load_state_dict(torch.load(args.video_checkpoint_path + '-phq4-seed-' + str(args.seed) + '.pt'))
-    v5.load_state_dict(torch.load(args.video_checkpoint_path + '-phq5-seed-' + str(args.seed) + '.pt'))
-    v6.load_state_dict(torch.load(args.video_checkpoint_path + '-phq6-seed-' + str(args.seed) + '.pt'))
-    v7.load_state_dict(torch.load(args.video_checkpoint_path + '-phq7-seed-' + str(args.seed) + '.pt'))
-    v8.load_state_dict(torch.load(args.video_checkpoint_path + '-phq8-seed-' + str(args.seed) + '.pt'))
+    load_checkpoint(v1, args.video_checkpoint_path + '-phq1-seed-' + str(args.seed) + '.pt')
+    load_checkpoint(v2, args.video_checkpoint_path + '-phq2-seed-' + str(args.seed) + '.pt')
+    load_checkpoint(v3, args.video_checkpoint_path + '-phq3-seed-' + str(args.seed) + '.pt')
+    load_checkpoint(v4, args.video_checkpoint_path + '-phq4-seed-' + str(args.seed) + '.pt')
+    load_checkpoint(v5, args.video_checkpoint_path + '-phq5-seed-' + str(args.seed) + '.pt')
+    load_checkpoint(v6, args.video_checkpoint_path + '-phq6-seed-' + str(args.seed) + '.pt')
+    load_checkpoint(v7, args.video_checkpoint_path + '-phq7-seed-' + str(args.seed) + '.pt')
+    load_checkpoint(v8, args.video_checkpoint_path + '-phq8-seed-' + str(args.seed) + '.pt')
     
     v1.to(device)
     v2.to(device)
@@ -513,24 +574,24 @@ if __name__ == '__main__':
     v8.to(device)
     
     # Define T+A+V fusion models for each Question
-    m1 = lstm_regressor(t1,a1,v1)
-    m2 = lstm_regressor(t2,a2,v2)
-    m3 = lstm_regressor(t3,a3,v3)
-    m4 = lstm_regressor(t4,a4,v4)
-    m5 = lstm_regressor(t5,a5,v5)
-    m6 = lstm_regressor(t6,a6,v6)
-    m7 = lstm_regressor(t7,a7,v7)
-    m8 = lstm_regressor(t8,a8,v8)
+    m1 = lstm_regressor(t1,a1,v1,fused_attn=args.fused_attn, head=args.head)
+    m2 = lstm_regressor(t2,a2,v2,fused_attn=args.fused_attn, head=args.head)
+    m3 = lstm_regressor(t3,a3,v3,fused_attn=args.fused_attn, head=args.head)
+    m4 = lstm_regressor(t4,a4,v4,fused_attn=args.fused_attn, head=args.head)
+    m5 = lstm_regressor(t5,a5,v5,fused_attn=args.fused_attn, head=args.head)
+    m6 = lstm_regressor(t6,a6,v6,fused_attn=args.fused_attn, head=args.head)
+    m7 = lstm_regressor(t7,a7,v7,fused_attn=args.fused_attn, head=args.head)
+    m8 = lstm_regressor(t8,a8,v8,fused_attn=args.fused_attn, head=args.head)
     
     # Load pretrained weights for T+A+V fusion models
-    m1.load_state_dict(torch.load(args.tav_checkpoint_path + '-phq1-seed-' + str(args.seed) + '-ccc.pt'))
-    m2.load_state_dict(torch.load(args.tav_checkpoint_path + '-phq2-seed-' + str(args.seed) + '-ccc.pt'))
-    m3.load_state_dict(torch.load(args.tav_checkpoint_path + '-phq3-seed-' + str(args.seed) + '-ccc.pt'))
-    m4.load_state_dict(torch.load(args.tav_checkpoint_path + '-phq4-seed-' + str(args.seed) + '-ccc.pt'))
-    m5.load_state_dict(torch.load(args.tav_checkpoint_path + '-phq5-seed-' + str(args.seed) + '-ccc.pt'))
-    m6.load_state_dict(torch.load(args.tav_checkpoint_path + '-phq6-seed-' + str(args.seed) + '-ccc.pt'))
-    m7.load_state_dict(torch.load(args.tav_checkpoint_path + '-phq7-seed-' + str(args.seed) + '-ccc.pt'))
-    m8.load_state_dict(torch.load(args.tav_checkpoint_path + '-phq8-seed-' + str(args.seed) + '-ccc.pt'))
+    load_checkpoint(m1, args.tav_checkpoint_path + '-phq1-seed-' + str(args.seed) + '-ccc.pt')
+    load_checkpoint(m2, args.tav_checkpoint_path + '-phq2-seed-' + str(args.seed) + '-ccc.pt')
+    load_checkpoint(m3, args.tav_checkpoint_path + '-phq3-seed-' + str(args.seed) + '-ccc.pt')
+    load_checkpoint(m4, args.tav_checkpoint_path + '-phq4-seed-' + str(args.seed) + '-ccc.pt')
+    load_checkpoint(m5, args.tav_checkpoint_path + '-phq5-seed-' + str(args.seed) + '-ccc.pt')
+    load_checkpoint(m6, args.tav_checkpoint_path + '-phq6-seed-' + str(args.seed) + '-ccc.pt')
+    load_checkpoint(m7, args.tav_checkpoint_path + '-phq7-seed-' + str(args.seed) + '-ccc.pt')
+    load_checkpoint(m8, args.tav_checkpoint_path + '-phq8-seed-' + str(args.seed) + '-ccc.pt')
     
     m1.to(device)
     m2.to(device)
@@ -542,14 +603,38 @@ if __name__ == '__main__':
     m8.to(device)
 
     # Dataloaders
-    train_dataloader = DataLoader(data_train,  batch_size=10)
-    val_dataloader = DataLoader(data_val,  batch_size=10)
-    test_dataloader = DataLoader(data_test,  batch_size=10)
+    train_dataloader = DataLoader(data_train,  batch_size=args.batch_size)
+    val_dataloader = DataLoader(data_val,  batch_size=args.batch_size)
+    test_dataloader = DataLoader(data_test,  batch_size=args.batch_size)
     
     # Specify loss functions/Metrics
     loss_fn_mse = nn.MSELoss()
     ccc_loss_fn = ccc_loss()
     mae_loss_fn = nn.L1Loss()
 
+    # Compile the models and build their graphs on the first batch
+    if args.compile:
+        for model in (m1, m2, m3, m4, m5, m6, m7, m8):
+            compile_model(model, test_dataloader.batch_size, args.cache_dir)
+            warm_up(model, next(iter(test_dataloader)), device, train=False, bf16=args.bf16)
+
+    # Logits kept for -logits_store, per split
+    store_logits = {split: [] for split in args.store_splits} if args.logits_store else {}
+
+    # Profile a window of evaluation batches
+    profiler = make_profiler(args.profile_dir if args.profile else None, *args.profile_steps)
+
     # Evaluate trained T+A+V model
-    print(evaluate(m1,m2,m3,m4,m5,m6,m7,m8,test_dataloader))
\ No newline at end of file
+    if args.bf16_parity:
+        parity_report(('CCC','RMSE','MAE'), evaluate(m1,m2,m3,m4,m5,m6,m7,m8,test_dataloader, args.metrics_path, profiler), evaluate(m1,m2,m3,m4,m5,m6,m7,m8,test_dataloader, args.metrics_path, bf16=True))
+    else:
+        print(evaluate(m1,m2,m3,m4,m5,m6,m7,m8,test_dataloader, args.metrics_path, profiler, args.bf16, logits_out=store_logits.get('test')))
+
+    # Store the logits of every participant, the test logits come from the evaluation above
+    if args.logits_store:
+        ckpt_files = [args.tav_checkpoint_path + '-phq' + str(q) + '-seed-' + str(args.seed) + '-ccc.pt' for q in range(1, 9)]
+        splits = {'train': (data_train, train_dataloader), 'val': (data_val, val_dataloader), 'test': (data_test, test_dataloader)}
+        for split, logits in store_logits.items():
+            if not logits:
+                evaluate(m1,m2,m3,m4,m5,m6,m7,m8,splits[split][1], bf16=args.bf16, logits_out=logits)
+            save_logits(args.logits_store, 'TAV', split, args.seed, splits[split][0], torch.cat(logits), ckpt_files, head=args.head, bf16=args.bf16)
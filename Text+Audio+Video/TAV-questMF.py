@@ -13,6 +13,25 @@ import time
 import os
 import argparse
 from torcheval.metrics.functional import multiclass_f1_score
+import sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from questmf.instrument import stage_timer
+from questmf.profiling import make_profiler, profile_range
+from torch.profiler import record_function
+from questmf.corpus import scan_corpus
+from questmf.feature_cache import egemaps_cache, resnet_cache, open_features, segment_means
+from questmf.records import session, memory_report
+from questmf.text_embed import precompute_text
+from questmf.distributed import init_distributed, is_main, barrier, main_first, wrap_model, unwrap, train_loader, set_epoch, n_samples, cleanup
+from questmf.threads import set_thread_budget
+from questmf.precision import autocast, check_bf16, parity_report
+from questmf.compile import compile_model, warm_up
+from questmf.attention import fused_attention
+from questmf.checkpointing import checkpointed
+from questmf.config import parse_args, scale_lr
+from questmf.heads import HEADS, make_head, apply_head
+from questmf.labels import load_labels, class_weights
+from questmf.shards import shard_dataset
 
 EPS = 1e-12
 
@@ -31,8 +50,34 @@ def cmdline_args():
     p.add_argument("-tav_ckpt", "--tav_checkpoint_path", type=str, help="Path to checkpoint for the text+audio+video model")
     p.add_argument("-m_files", "--missing_video_files",nargs='+', type=int, help="List of file numbers for incomplete video files")
     p.add_argument("-train","--train_model", action='store_true',help="Wheather to train the model or not")
-
-    return (p.parse_args())
+    p.add_argument("-metrics", "--metrics_path", type=str, help="JSONL file for per-stage timing metrics")
+    p.add_argument("-profile", "--profile", action='store_true', help="Profile a window of steps with torch.profiler")
+    p.add_argument("-profile_dir", "--profile_dir", type=str, default='profile', help="Directory for profiler traces and the top-ops table")
+    p.add_argument("-profile_steps", "--profile_steps", nargs=3, type=int, default=[1,1,5], help="Number of steps to skip, warm up and record")
+    p.add_argument("-workers", "--workers", type=int, default=8, help="Number of workers for reading the participant files")
+    p.add_argument("-pool", "--pool", type=str, default='thread', choices=['thread','process'], help="Use a thread or a process pool for reading the participant files")
+    p.add_argument("-cache_dir", "--cache_dir", type=str, default='cache', help="Directory for the cached sentence embeddings and the float32 copies of the eGeMAPS and ResNet features")
+    p.add_argument("-ddp", "--ddp", action='store_true', help="Data parallel training, launch with torchrun")
+    p.add_argument("-threads", "--threads", type=int, help="Number of intra-op threads (default: one per core in -cores, else all cores)")
+    p.add_argument("-interop_threads", "--interop_threads", type=int, help="Number of inter-op threads")
+    p.add_argument("-cores", "--cores", type=str, help="Cores for this process, e.g. 0-7")
+    p.add_argument("-pin", "--pin", action='store_true', help="Pin the process to the cores given in -cores")
+    p.add_argument("-bf16", "--bf16", action='store_true', help="Run the forward passes under bf16 autocast, the weights stay float32")
+    p.add_argument("-bf16_parity", "--bf16_parity", action='store_true', help="Evaluate in float32 and in bf16 and compare the metrics")
+    p.add_argument("-compile", "--compile", action='store_true', help="Compile the model with torch.compile, the kernels are cached in <cache_dir>/inductor")
+    p.add_argument("-fused_attn", "--fused_attn", action='store_true', help="Run the cross and self attention blocks of the fusion model together, with packed projections and scaled dot product attention")
+    p.add_argument("-grad_ckpt", "--grad_ckpt", action='store_true', help="Recompute the activations of the encoders and fusion blocks in the backward pass to save memory")
+    p.add_argument("-bs", "--batch_size", type=int, default=10, help="Batch size for training and evaluation, split across the ranks with -ddp")
+    p.add_argument("-epochs", "--epochs", type=int, default=20, help="Number of training epochs")
+    p.add_argument("-lr", "--lr", type=float, default=5e-4, help="Learning rate at batch size 10")
+    p.add_argument("-lr_scale", "--lr_scale", type=str, default='none', choices=['none','linear','sqrt'], help="Scale -lr with the batch size relative to 10")
+    p.add_argument("-config", "--config", type=str, help="JSON or YAML file with defaults for any of these options, e.g. {\"bs\": 32, \"lr\": 1e-3}")
+    p.add_argument("-head", "--head", type=str, default='flatten', choices=HEADS, help="Classification head of every model: the flattened MLP of the paper, or masked mean+max or attention pooling over the turns")
+    p.add_argument("-shards", "--shards", type=str, help="index.json of training shards written by questmf.shards, streamed instead of building the training set")
+    p.add_argument("-shuffle_buffer", "--shuffle_buffer", type=int, default=256, help="Samples held for shuffling the streamed training set")
+    p.add_argument("-loader_workers", "--loader_workers", type=int, default=0, help="DataLoader worker processes for the training set")
+
+    return (parse_args(p))
 
 def set_seed(seed_value=42):
     """Set seed for reproducibility.
@@ -48,8 +93,74 @@ def mean_pooling(model_output, attention_mask):
     input_mask_expanded = attention_mask.unsqueeze(-1).expand(token_embeddings.size()).float()
     return torch.sum(token_embeddings * input_mask_expanded, 1) / torch.clamp(input_mask_expanded.sum(1), min=1e-9)
 
+def load_participant(p_id_int,data_path,score,cache_dir):
+    """Read the transcript and features of one participant.
+    """
+    p_id = str(p_id_int)
+    df_txt = pd.read_csv(data_path + p_id + '_P/' + p_id + '_Transcript.csv')
+    txt_list = df_txt['Text'].tolist()
+    vid_file = data_path + p_id + '_P/features/' + p_id + '_CNN_ResNet.mat'
+    speech_file = data_path + p_id + '_P/' + p_id + '_AUDIO.wav'
+    t = librosa.get_duration(path=speech_file)
+    # Sampling-rate = 100
+    # Preprocessing start and end times
+    max_times = t*100
+    # float32 copy of the eGeMAPS features, memory mapped in the preprocessing
+    egemaps_file = egemaps_cache(data_path + p_id + '_P/features/' + p_id + '_OpenSMILE2.3.0_egemaps.csv',cache_dir)
+    start_times_aud = (df_txt['Start_Time'].values*100).tolist()
+    end_times_aud = (df_txt['End_Time'].values*100).tolist()
+
+    x_aud = 1
+    y_aud = len(start_times_aud)
+    
+    while x_aud < y_aud:
+        if start_times_aud[x_aud-1]>start_times_aud[x_aud] or start_times_aud[x_aud]>max_times:
+            del start_times_aud[x_aud]
+            del end_times_aud[x_aud]
+            x_aud = x_aud-1
+            y_aud = y_aud-1
+        if end_times_aud[x_aud-1]>end_times_aud[x_aud] or end_times_aud[x_aud]>max_times:
+            del start_times_aud[x_aud]
+            del end_times_aud[x_aud]
+            x_aud = x_aud-1
+            y_aud = y_aud-1
+        x_aud = x_aud+1
+    
+    start_times_aud = [round(a) for a in start_times_aud]
+    end_times_aud = [round(b) for b in end_times_aud]
+    # float32 copy of the ResNet features, memory mapped in the preprocessing
+    vid_feat_file = resnet_cache(vid_file,cache_dir)
+    vid_feat = open_features(vid_feat_file)
+    feat_len = len(vid_feat)
+    
+    # Sampling rate for video
+    m_factor = feat_len/t
+    
+    # Preprocessing start and end times for video
+    start_times_vid = (df_txt['Start_Time'].values*m_factor).tolist()
+    end_times_vid = (df_txt['End_Time'].values*m_factor).tolist()
+
+    x_vid = 1
+    y_vid = len(start_times_vid)
+    while x_vid < y_vid:
+        if start_times_vid[x_vid-1]>start_times_vid[x_vid] or start_times_vid[x_vid]>feat_len:
+            del start_times_vid[x_vid]
+            del end_times_vid[x_vid]
+            x_vid = x_vid-1
+            y_vid = y_vid-1
+        if end_times_vid[x_vid-1]>end_times_vid[x_vid] or end_times_vid[x_vid]>feat_len:
+            del start_times_vid[x_vid]
+            del end_times_vid[x_vid]
+            x_vid = x_vid-1
+            y_vid = y_vid-1
+        x_vid = x_vid+1
+    
+    start_times_vid = [round(a) for a in start_times_vid]
+    end_times_vid = [round(b) for b in end_times_vid]
+    return session(p_id_int,score,txt=txt_list,aud_file=egemaps_file,aud_start=start_times_aud,aud_end=end_times_aud,vid_file=vid_feat_file,vid_start=start_times_vid,vid_end=end_times_vid)
+
 class dds(Dataset):
-    def __init__(self,split,data_path,label_path,q_no,missing_files_list):
+    def __init__(self,split,data_path,label_path,q_no,missing_files_list,workers=1,pool='thread',cache_dir='cache'):
         super(dds,self).__init__()
         if split == 'train':
             df_data = pd.read_csv(label_path + 'train_split.csv')
@@ -57,83 +168,36 @@ class dds(Dataset):
             df_data = pd.read_csv(label_path + 'dev_split.csv')
         else:
             raise Exception(f"wrong split: {split}")
-        self.data = []
-        df_scores = pd.read_csv(label_path + 'Detailed_PHQ8_Labels.csv')
+        labels = load_labels(label_path,cache_dir)
         p_id_list = df_data['Participant_ID'].tolist()
-        for i in range(len(p_id_list)):
-            p_id = str(p_id_list[i])
-            p_id_int = p_id_list[i]
-            # Files 402 and 609 not complete for video
-            if p_id_list[i] in missing_files_list:
-                continue
-            df_txt = pd.read_csv(data_path + p_id + '_P/' + p_id + '_Transcript.csv')
-            txt_list = df_txt['Text'].tolist()
-            vid_file = data_path + p_id + '_P/features/' + p_id + '_CNN_ResNet.mat'
-            speech_file = data_path + p_id + '_P/' + p_id + '_AUDIO.wav'
-            t = librosa.get_duration(path=speech_file)
-            # Sampling-rate = 100
-            # Preprocessing start and end times
-            max_times = t*100
-            df_speech = pd.read_csv(data_path + p_id + '_P/features/' + p_id + '_OpenSMILE2.3.0_egemaps.csv',sep=";")
-            start_times_aud = (df_txt['Start_Time'].values*100).tolist()
-            end_times_aud = (df_txt['End_Time'].values*100).tolist()
-
-            x_aud = 1
-            y_aud = len(start_times_aud)
-            
-            while x_aud < y_aud:
-                if start_times_aud[x_aud-1]>start_times_aud[x_aud] or start_times_aud[x_aud]>max_times:
-                    del start_times_aud[x_aud]
-                    del end_times_aud[x_aud]
-                    x_aud = x_aud-1
-                    y_aud = y_aud-1
-                if end_times_aud[x_aud-1]>end_times_aud[x_aud] or end_times_aud[x_aud]>max_times:
-                    del start_times_aud[x_aud]
-                    del end_times_aud[x_aud]
-                    x_aud = x_aud-1
-                    y_aud = y_aud-1
-                x_aud = x_aud+1
-            
-            start_times_aud = [round(a) for a in start_times_aud]
-            end_times_aud = [round(b) for b in end_times_aud]
-            q_list = ['PHQ_8NoInterest','PHQ_8Depressed','PHQ_8Sleep','PHQ_8Tired','PHQ_8Appetite','PHQ_8Failure','PHQ_8Concentrating','PHQ_8Moving']
-            score = int(df_scores[df_scores['Participant_ID']==p_id_int][q_list[q_no-1]].iloc[0])
-            self.data.append([txt_list,df_speech,start_times_aud,end_times_aud,vid_file,df_txt,t,score])
+        # Files not complete for video
+        jobs = [(p_id,data_path,labels.item(p_id,q_no),cache_dir) for p_id in p_id_list if p_id not in missing_files_list]
+        # Participants are read on a bounded pool, in split order
+        self.data = scan_corpus(load_participant, jobs, workers, pool)
+        # Embed the transcripts once, in length-sorted batches across sessions
+        precompute_text(self.data,cache_dir,tokenizer_txt,embedder_txt,device)
+        memory_report(split,self.data)
     
     # Text Preprocess
-    def preprocess_txt(self,txt_list):
-        encoded_input = tokenizer_txt(txt_list, padding=True, truncation=True, return_tensors='pt').to(device)
-        l = len(txt_list)
-        # Maximum number of turns
-        if l > 120:
-            l = 120
+    @profile_range('preprocess_txt')
+    def preprocess_txt(self,txt_file):
+        # Sentence embeddings of the first 120 turns, computed once in precompute_text
+        sentence_embeddings = torch.from_numpy(np.load(txt_file))
+        l = len(sentence_embeddings)
         # Mask for attention layer
         mask_txt = torch.tensor([False]*l)
-        # Compute token embeddings
-        with torch.no_grad():
-            embedder_output = embedder_txt(**encoded_input)
-        # Perform mean pooling
-        sentence_embeddings = mean_pooling(embedder_output, encoded_input['attention_mask'])[:l]
         if l < 120:
-            z = torch.zeros(120-l,768).to(device)
+            z = torch.zeros(120-l,768)
             sentence_embeddings = torch.cat((sentence_embeddings,z),dim=0)
             mask_txt = torch.cat((mask_txt,torch.tensor([True]*(120-l))))
-        sentence_embeddings = F.normalize(sentence_embeddings, p=2, dim=1)
-        return sentence_embeddings.detach().cpu(),mask_txt
+        return sentence_embeddings,mask_txt
 
     # Audio Preprocess
-    def preprocess_aud(self,df_speech,start_times_aud,end_times_aud):
-        df_mod = df_speech.iloc[:,2:]
-        speech= df_mod.values.tolist()
-        speech_0 = torch.tensor(speech[start_times_aud[0]:end_times_aud[0]]).unsqueeze(0)
-        out_aud = torch.mean(speech_0, dim=1)
-        out_aud = out_aud.detach().cpu()
-
-        for i in range(1,len(start_times_aud)):
-            speech_mod = torch.tensor(speech[start_times_aud[i]:end_times_aud[i]]).unsqueeze(0)
-            mean_i_aud = torch.mean(speech_mod, dim=1)
-            mean_i_aud = mean_i_aud.detach().cpu()
-            out_aud = torch.cat((out_aud,mean_i_aud),dim=0)
+    @profile_range('preprocess_aud')
+    def preprocess_aud(self,egemaps_file,start_times_aud,end_times_aud):
+        speech = open_features(egemaps_file)
+        # Mean over the frames of every turn, only the first 120 turns are kept
+        out_aud = torch.from_numpy(segment_means(speech,start_times_aud[:120],end_times_aud[:120]))
         
         l_aud = len(start_times_aud)
         if l_aud > 120:
@@ -148,47 +212,11 @@ class dds(Dataset):
         return out_aud,mask_aud
 
     # Video Preprocess
-    def preprocess_vid(self,vid_file,df_txt,t):
-        vid_data = sio.loadmat(vid_file)
-        vid_feat = vid_data['feature']
-        feat_len = len(vid_feat)
-        
-        # Sampling rate for video
-        m_factor = feat_len/t
-        
-        # Preprocessing start and end times for video
-        start_times_vid = (df_txt['Start_Time'].values*m_factor).tolist()
-        end_times_vid = (df_txt['End_Time'].values*m_factor).tolist()
-
-        x_vid = 1
-        y_vid = len(start_times_vid)
-        while x_vid < y_vid:
-            if start_times_vid[x_vid-1]>start_times_vid[x_vid] or start_times_vid[x_vid]>feat_len:
-                del start_times_vid[x_vid]
-                del end_times_vid[x_vid]
-                x_vid = x_vid-1
-                y_vid = y_vid-1
-            if end_times_vid[x_vid-1]>end_times_vid[x_vid] or end_times_vid[x_vid]>feat_len:
-                del start_times_vid[x_vid]
-                del end_times_vid[x_vid]
-                x_vid = x_vid-1
-                y_vid = y_vid-1
-            x_vid = x_vid+1
-        
-        start_times_vid = [round(a) for a in start_times_vid]
-        end_times_vid = [round(b) for b in end_times_vid]
-        
-        vid_feat_0 = torch.tensor(vid_feat[start_times_vid[0]:end_times_vid[0]]).unsqueeze(0)
-        # Mean pooling
-        out_vid = torch.mean(vid_feat_0,dim=1)
-        out_vid = out_vid.detach().cpu()
-
-        for i in range(1,len(start_times_vid)):
-            vid_feat_i = torch.tensor(vid_feat[start_times_vid[i]:end_times_vid[i]]).unsqueeze(0)
-            # Mean pooling
-            vid_mean_i = torch.mean(vid_feat_i,dim=1)
-            vid_mean_i = vid_mean_i.detach().cpu()
-            out_vid = torch.cat((out_vid,vid_mean_i),dim=0)
+    @profile_range('preprocess_vid')
+    def preprocess_vid(self,vid_feat_file,start_times_vid,end_times_vid):
+        vid_feat = open_features(vid_feat_file)
+        # Mean pooling over the frames of every turn, only the first 120 turns are kept
+        out_vid = torch.from_numpy(segment_means(vid_feat,start_times_vid[:120],end_times_vid[:120]))
         l_vid = len(start_times_vid)
         # Maximum number of turns
         if l_vid > 120:
@@ -204,15 +232,16 @@ class dds(Dataset):
         return out_vid,mask_vid
         
     def __getitem__(self,index):
-        embedding_txt, mask_txt = self.preprocess_txt(self.data[index][0])
-        embedding_aud, mask_aud = self.preprocess_aud(self.data[index][1],self.data[index][2],self.data[index][3])
-        embedding_vid, mask_vid = self.preprocess_vid(self.data[index][4],self.data[index][5],self.data[index][6])
-        return [embedding_txt,mask_txt,embedding_aud,mask_aud,embedding_vid,mask_vid,self.data[index][7]]
+        s = self.data[index]
+        embedding_txt, mask_txt = self.preprocess_txt(s.txt_file)
+        embedding_aud, mask_aud = self.preprocess_aud(s.aud_file,s.aud_start,s.aud_end)
+        embedding_vid, mask_vid = self.preprocess_vid(s.vid_file,s.vid_start,s.vid_end)
+        return [embedding_txt,mask_txt,embedding_aud,mask_aud,embedding_vid,mask_vid,s.label]
     def __len__(self):
         return len(self.data)
 
 class lstm_regressor_txt(nn.Module):
-    def __init__(self):
+    def __init__(self,head='flatten'):
         super(lstm_regressor_txt, self).__init__()
         self.lstm_1 = nn.LSTM(768,50,batch_first=True,bidirectional=True)
         self.attention = nn.MultiheadAttention(100, 4,batch_first=True,dropout=0.5)
@@ -222,15 +251,17 @@ class lstm_regressor_txt(nn.Module):
                                 nn.ReLU(),
                                 nn.Dropout(0.2),
                                 nn.Linear(256,4))
+        self.mlp = make_head(head,self.mlp)
 
+    @profile_range('txt_encoder')
     def forward(self,C,key_padding_mask):
         c_lstm,_ = self.lstm_1(C)
         c_att,_ = self.attention(c_lstm,c_lstm,c_lstm,key_padding_mask=key_padding_mask)
-        logits = self.mlp(c_att)
+        logits = apply_head(self.mlp,c_att,key_padding_mask)
         return logits,c_att
 
 class lstm_regressor_aud(nn.Module):
-    def __init__(self):
+    def __init__(self,head='flatten'):
         super(lstm_regressor_aud, self).__init__()
         self.lstm_1 = nn.LSTM(23,50,batch_first=True,bidirectional=True)
         self.attention1 = nn.MultiheadAttention(100, 4,batch_first=True,dropout=0.2)
@@ -241,16 +272,18 @@ class lstm_regressor_aud(nn.Module):
                                 nn.ReLU(),
                                 nn.Dropout(0.2),
                                 nn.Linear(256,4))
+        self.mlp = make_head(head,self.mlp)
 
+    @profile_range('aud_encoder')
     def forward(self,C,key_padding_mask):
         c_lstm,_ = self.lstm_1(C)
         c_att,_ = self.attention1(c_lstm,c_lstm,c_lstm,key_padding_mask=key_padding_mask)
         c_att2,_ = self.attention2(c_att,c_att,c_att,key_padding_mask=key_padding_mask)
-        logits = self.mlp(c_att2)
+        logits = apply_head(self.mlp,c_att2,key_padding_mask)
         return logits,c_att2
 
 class lstm_regressor_vid(nn.Module):
-    def __init__(self):
+    def __init__(self,head='flatten'):
         super(lstm_regressor_vid, self).__init__()
         self.lstm_1 = nn.LSTM(2048,50,batch_first=True,bidirectional=True)
         self.attention1 = nn.MultiheadAttention(100, 4,batch_first=True,dropout=0.2)
@@ -261,20 +294,24 @@ class lstm_regressor_vid(nn.Module):
                                 nn.ReLU(),
                                 nn.Dropout(0.2),
                                 nn.Linear(256,4))
+        self.mlp = make_head(head,self.mlp)
 
+    @profile_range('vid_encoder')
     def forward(self,C,key_padding_mask):
         c_lstm,_ = self.lstm_1(C)
         c_att,_ = self.attention1(c_lstm,c_lstm,c_lstm,key_padding_mask=key_padding_mask)
         c_att2,_ = self.attention2(c_att,c_att,c_att,key_padding_mask=key_padding_mask)
-        logits = self.mlp(c_att2)
+        logits = apply_head(self.mlp,c_att2,key_padding_mask)
         return logits,c_att2
 
 class lstm_regressor(nn.Module):
-    def __init__(self,txt_model,aud_model,vid_model):
+    def __init__(self,txt_model,aud_model,vid_model,fused_attn=False,grad_ckpt=False,head='flatten'):
         super(lstm_regressor, self).__init__()
         self.txt_model = txt_model
         self.aud_model = aud_model
         self.vid_model = vid_model
+        self.fused_attn = fused_attn
+        self.grad_ckpt = grad_ckpt
 
         self.cross_aud_txt = nn.MultiheadAttention(100, 4,batch_first=True,dropout=0.8)
         self.cross_txt_aud = nn.MultiheadAttention(100, 4,batch_first=True,dropout=0.8)
@@ -294,6 +331,7 @@ class lstm_regressor(nn.Module):
                                 nn.ReLU(),
                                 nn.Dropout(0.5),
                                 nn.Linear(256,4))
+        self.mlp = make_head(head,self.mlp,3)
 
 
         # Freeze Text Encoder
@@ -302,31 +340,63 @@ class lstm_regressor(nn.Module):
 
     def forward(self,C_txt,key_padding_mask_txt,C_aud,key_padding_mask_aud,C_vid,key_padding_mask_vid):
 
+        # Recompute the activations of the audio and video encoders and of the fusion blocks in the
+        # backward pass. The frozen text encoder keeps no activations for backward anyway.
+        ckpt = self.grad_ckpt and self.training
+
         _,c_att_txt = self.txt_model(C_txt,key_padding_mask_txt)
 
-        _,c_att_aud = self.aud_model(C_aud,key_padding_mask_aud)
+        _,c_att_aud = checkpointed(ckpt,self.aud_model,C_aud,key_padding_mask_aud)
+
+        _,c_att_vid = checkpointed(ckpt,self.vid_model,C_vid,key_padding_mask_vid)
 
-        _,c_att_vid = self.vid_model(C_vid,key_padding_mask_vid)
+        c_aud_txt_vid,c_vid_txt_aud,c_txt_aud_vid = checkpointed(ckpt,self.cross_attention,c_att_txt,key_padding_mask_txt,c_att_aud,key_padding_mask_aud,c_att_vid,key_padding_mask_vid)
 
-        c_aud_txt,_ = self.cross_aud_txt(c_att_aud,c_att_txt,c_att_txt,key_padding_mask=key_padding_mask_txt)
-        c_txt_aud,_ = self.cross_txt_aud(c_att_txt,c_att_aud,c_att_aud,key_padding_mask=key_padding_mask_aud)
-        c_vid_aud,_ = self.cross_vid_aud(c_att_vid,c_att_aud,c_att_aud,key_padding_mask=key_padding_mask_aud)
-        c_aud_vid,_ = self.cross_aud_vid(c_att_aud,c_att_vid,c_att_vid,key_padding_mask=key_padding_mask_vid)
-        c_txt_vid,_ = self.cross_txt_vid(c_att_txt,c_att_vid,c_att_vid,key_padding_mask=key_padding_mask_vid)
-        c_vid_txt,_ = self.cross_vid_txt(c_att_vid,c_att_txt,c_att_txt,key_padding_mask=key_padding_mask_txt)
+        c_comb = checkpointed(ckpt,self.self_attention,c_aud_txt_vid,key_padding_mask_aud,c_vid_txt_aud,key_padding_mask_vid,c_txt_aud_vid,key_padding_mask_txt)
+        pred = apply_head(self.mlp,c_comb,(key_padding_mask_aud,key_padding_mask_vid,key_padding_mask_txt))
+
+        return pred
+
+    def cross_attention(self,c_att_txt,key_padding_mask_txt,c_att_aud,key_padding_mask_aud,c_att_vid,key_padding_mask_vid):
+
+        with record_function('cross_attention'):
+            if self.fused_attn:
+                c_aud_txt,c_txt_aud,c_vid_aud,c_aud_vid,c_txt_vid,c_vid_txt = fused_attention(
+                    (self.cross_aud_txt,self.cross_txt_aud,self.cross_vid_aud,self.cross_aud_vid,self.cross_txt_vid,self.cross_vid_txt),
+                    (c_att_aud,c_att_txt,c_att_vid,c_att_aud,c_att_txt,c_att_vid),
+                    (c_att_txt,c_att_aud,c_att_aud,c_att_vid,c_att_vid,c_att_txt),
+                    (key_padding_mask_txt,key_padding_mask_aud,key_padding_mask_aud,key_padding_mask_vid,key_padding_mask_vid,key_padding_mask_txt))
+            else:
+                c_aud_txt,_ = self.cross_aud_txt(c_att_aud,c_att_txt,c_att_txt,key_padding_mask=key_padding_mask_txt)
+                c_txt_aud,_ = self.cross_txt_aud(c_att_txt,c_att_aud,c_att_aud,key_padding_mask=key_padding_mask_aud)
+                c_vid_aud,_ = self.cross_vid_aud(c_att_vid,c_att_aud,c_att_aud,key_padding_mask=key_padding_mask_aud)
+                c_aud_vid,_ = self.cross_aud_vid(c_att_aud,c_att_vid,c_att_vid,key_padding_mask=key_padding_mask_vid)
+                c_txt_vid,_ = self.cross_txt_vid(c_att_txt,c_att_vid,c_att_vid,key_padding_mask=key_padding_mask_vid)
+                c_vid_txt,_ = self.cross_vid_txt(c_att_vid,c_att_txt,c_att_txt,key_padding_mask=key_padding_mask_txt)
 
         c_aud_txt_vid = torch.cat((c_aud_txt,c_aud_vid),dim=2)
         c_vid_txt_aud = torch.cat((c_vid_txt,c_vid_aud),dim=2)
         c_txt_aud_vid = torch.cat((c_txt_aud,c_txt_vid),dim=2)
 
-        c_att_aud_txt_vid,_ = self.self_aud_txt_vid(c_aud_txt_vid,c_aud_txt_vid,c_aud_txt_vid,key_padding_mask=key_padding_mask_aud)
-        c_att_vid_txt_aud,_ = self.self_vid_txt_aud(c_vid_txt_aud,c_vid_txt_aud,c_vid_txt_aud,key_padding_mask=key_padding_mask_vid)
-        c_att_txt_aud_vid,_ = self.self_txt_aud_vid(c_txt_aud_vid,c_txt_aud_vid,c_txt_aud_vid,key_padding_mask=key_padding_mask_txt)
+        return c_aud_txt_vid,c_vid_txt_aud,c_txt_aud_vid
+
+    def self_attention(self,c_aud_txt_vid,key_padding_mask_aud,c_vid_txt_aud,key_padding_mask_vid,c_txt_aud_vid,key_padding_mask_txt):
+
+        with record_function('self_attention'):
+            if self.fused_attn:
+                c_att_aud_txt_vid,c_att_vid_txt_aud,c_att_txt_aud_vid = fused_attention(
+                    (self.self_aud_txt_vid,self.self_vid_txt_aud,self.self_txt_aud_vid),
+                    (c_aud_txt_vid,c_vid_txt_aud,c_txt_aud_vid),
+                    (c_aud_txt_vid,c_vid_txt_aud,c_txt_aud_vid),
+                    (key_padding_mask_aud,key_padding_mask_vid,key_padding_mask_txt))
+            else:
+                c_att_aud_txt_vid,_ = self.self_aud_txt_vid(c_aud_txt_vid,c_aud_txt_vid,c_aud_txt_vid,key_padding_mask=key_padding_mask_aud)
+                c_att_vid_txt_aud,_ = self.self_vid_txt_aud(c_vid_txt_aud,c_vid_txt_aud,c_vid_txt_aud,key_padding_mask=key_padding_mask_vid)
+                c_att_txt_aud_vid,_ = self.self_txt_aud_vid(c_txt_aud_vid,c_txt_aud_vid,c_txt_aud_vid,key_padding_mask=key_padding_mask_txt)
 
         c_comb = torch.cat((c_att_aud_txt_vid,c_att_vid_txt_aud,c_att_txt_aud_vid),dim=2)
-        pred = self.mlp(c_comb)
 
-        return pred
+        return c_comb
 
 # CCC loss
 class ccc_loss(nn.Module):
@@ -354,40 +424,15 @@ class ccc_loss(nn.Module):
 
 # Get weights for ImbOLL function
 
-def get_weights(q_no,label_path, beta):
-    df_data_x = pd.read_csv(label_path + 'train_split.csv')
-    p_id_list_x = df_data_x['Participant_ID'].tolist()
-    df_scores = pd.read_csv(label_path + 'Detailed_PHQ8_Labels.csv')
-    q_list = ['PHQ_8NoInterest','PHQ_8Depressed','PHQ_8Sleep','PHQ_8Tired','PHQ_8Appetite','PHQ_8Failure','PHQ_8Concentrating','PHQ_8Moving']
-    x0 = 0
-    x1 = 0
-    x2 = 0
-    x3 = 0
-    for i in range(len(p_id_list_x)):
-        p_id_int_x = p_id_list_x[i]
-        score = int(df_scores[df_scores['Participant_ID']==p_id_int_x][q_list[q_no-1]].iloc[0])
-        if score ==0:
-            x0 = x0+1
-        elif score ==1:
-            x1 = x1+1
-        elif score ==2:
-            x2 = x2+1
-        elif score ==3:
-            x3 = x3+1
-
-    x_total = x0+x1+x2+x3
-    w0 = x_total/x0
-    w1 = x_total/x1
-    w2 = x_total/x2
-    w3 = x_total/x3
-    w_total = torch.tensor([w0,w1,w2,w3])
-
-    w = w_total**(beta)
+def get_weights(q_no,label_path, beta, cache_dir=None):
+    # Weights of all eight questions in one bincount, see questmf.labels
+    w = class_weights(label_path,beta,cache_dir)[q_no-1]
 
     return w
 
 #ImbOLL
 
+@profile_range('ImbOLL')
 def ImbOLL(logits,w,labels,alpha):
     num_classes = 4
     dist_matrix = [[w[0].item()*0,w[0].item()*1,w[0].item()*2,w[0].item()*3],[w[1].item()*1,w[1].item()*0,w[1].item()*1,w[1].item()*2],[w[2].item()*2,w[2].item()*1,w[2].item()*0,w[2].item()*1],[w[3].item()*3,w[3].item()*2,w[3].item()*1,w[3].item()*0]]
@@ -400,10 +445,13 @@ def ImbOLL(logits,w,labels,alpha):
     loss = torch.sum(err,axis=1).mean()
     return loss
 
-def train(model, train_dataloader, data_train, data_val, tav_ckpt_name, seed, w, alpha, val_dataloader=None, epochs=10, evaluation=False):
+def train(model, train_dataloader, data_train, data_val, tav_ckpt_name, seed, w, alpha, val_dataloader=None, epochs=10, evaluation=False, metrics_path=None, profiler=None, bf16=False):
 
     # Start training loop
     print("Start training...\n")
+    timer = stage_timer(device, metrics_path, phase='train')
+    profiler = profiler or make_profiler(None)
+    profiler.start()
     best_val_loss_ccc=-100
     best_val_loss = 10000
     for epoch_i in range(epochs):
@@ -422,29 +470,39 @@ def train(model, train_dataloader, data_train, data_val, tav_ckpt_name, seed, w,
 
         # Put the model into the training mode
         model.train()
+        timer.reset()
+        set_epoch(train_dataloader, epoch_i)
 
         # For each batch of training data...
-        for step, batch in enumerate(train_dataloader):
+        for step, batch in enumerate(timer.loader(train_dataloader)):
             batch_counts +=1
             # Load batch to GPU
-            c_txt, mask_txt, c_aud, mask_aud, c_vid, mask_vid, phq_scores = tuple(t.to(device) for t in batch)
+            with timer.stage('h2d'):
+                c_txt, mask_txt, c_aud, mask_aud, c_vid, mask_vid, phq_scores = tuple(t.to(device) for t in batch)
+            timer.add_samples(phq_scores.shape[0])
 
             # Zero out any previously calculated gradients
             model.zero_grad()
 
             # Perform a forward pass. This will return predictions.
-            logits = model.forward(c_txt,mask_txt,c_aud,mask_aud,c_vid,mask_vid)
-            loss = ImbOLL(logits,w,phq_scores,alpha)
+            with timer.stage('forward'), autocast(device, bf16):
+                logits = model.forward(c_txt,mask_txt,c_aud,mask_aud,c_vid,mask_vid).float()
+            with timer.stage('loss'):
+                loss = ImbOLL(logits,w,phq_scores,alpha)
             batch_loss += loss.item()
             total_loss += (loss.item() * float(c_txt.shape[0]))
 
             # Perform a backward pass to calculate gradients
-            loss.backward()
+            with timer.stage('backward'):
+                loss.backward()
             # Clip the norm of the gradients to 1.0 to prevent "exploding gradients"
-            torch.nn.utils.clip_grad_norm_(model.parameters(), 1.0)
+            with timer.stage('clip_grad'):
+                torch.nn.utils.clip_grad_norm_(model.parameters(), 1.0)
 
             # Update parameters and the learning rate
-            optimizer.step()
+            with timer.stage('optimizer_step'):
+                optimizer.step()
+            profiler.step()
 
             # Print the loss values and time elapsed for every 20 batches
             if (step % 20 == 0 and step != 0) or (step == len(train_dataloader) - 1):
@@ -458,43 +516,50 @@ def train(model, train_dataloader, data_train, data_val, tav_ckpt_name, seed, w,
                 batch_loss, batch_counts = 0, 0
                 t0_batch = time.time()
 
+        timer.end_loop()
         # Calculate the average loss over the entire training data
-        avg_train_loss = total_loss / len(data_train)
+        # Average over the samples of this rank
+        avg_train_loss = total_loss / n_samples(train_dataloader)
 
         print("-"*70)
         # =======================================
         #               Evaluation
         # =======================================
-        if evaluation == True:
+        if evaluation == True and is_main():
             # After the completion of each training epoch, measure the model's performance
             # on our validation set.
-            val_loss,val_acc,val_mi_f1,val_ma_f1,val_weight_f1,val_loss_ccc,val_rmse,val_mae = evaluate(model, data_val, val_dataloader, w, alpha)
+            val_loss,val_acc,val_mi_f1,val_ma_f1,val_weight_f1,val_loss_ccc,val_rmse,val_mae = evaluate(unwrap(model), data_val, val_dataloader, w, alpha, metrics_path, bf16)
             
             if(val_loss < best_val_loss):
                 best_val_loss = val_loss
-                torch.save(model.state_dict(), tav_ckpt_name + '-seed-' + str(seed) + '.pt')
+                with timer.stage('checkpoint'):
+                    torch.save(unwrap(model).state_dict(), tav_ckpt_name + '-seed-' + str(seed) + '.pt')
             
             if(val_loss_ccc > best_val_loss_ccc):
                 best_val_loss_ccc = val_loss_ccc
-                torch.save(model.state_dict(), tav_ckpt_name + '-seed-' + str(seed) + '-ccc.pt')
+                with timer.stage('checkpoint'):
+                    torch.save(unwrap(model).state_dict(), tav_ckpt_name + '-seed-' + str(seed) + '-ccc.pt')
 
             # Print performance over the entire training data
             time_elapsed = time.time() - t0_epoch
             
             print(f"{epoch_i + 1:^7} | {'-':^7} | {avg_train_loss:^12.6f} | {val_loss:^10.6f} | {time_elapsed:^9.2f}")
             print("-"*70)
+        timer.report(epoch_i + 1, train_loss=avg_train_loss)
         print("\n")
     
+    profiler.stop()
     print("Training complete!")
 
 
-def evaluate(model, data_val, val_dataloader, w, alpha):
+def evaluate(model, data_val, val_dataloader, w, alpha, metrics_path=None, bf16=False):
     """After the completion of each training epoch, measure the model's performance
     on our validation set.
     """
     # Put the model into the evaluation mode. The dropout layers are disabled during
     # the test time.
     model.eval()
+    timer = stage_timer(device, metrics_path, phase='eval')
     total_val_loss = 0
     # Tracking variables
     val_accuracy = []
@@ -502,14 +567,17 @@ def evaluate(model, data_val, val_dataloader, w, alpha):
     labels_list = []
 
     # For each batch in our validation set...
-    for batch in val_dataloader:
+    for batch in timer.loader(val_dataloader):
         # Load batch to GPU
-        c_txt, mask_txt, c_aud, mask_aud, c_vid, mask_vid, phq_scores = tuple(t.to(device) for t in batch)
+        with timer.stage('h2d'):
+            c_txt, mask_txt, c_aud, mask_aud, c_vid, mask_vid, phq_scores = tuple(t.to(device) for t in batch)
+        timer.add_samples(phq_scores.shape[0])
 
         # Compute predictions
-        with torch.no_grad():
-            logits = model.forward(c_txt,mask_txt,c_aud,mask_aud,c_vid,mask_vid)
-        val_loss = ImbOLL(logits,w,phq_scores,alpha)
+        with timer.stage('forward'), torch.no_grad(), autocast(device, bf16):
+            logits = model.forward(c_txt,mask_txt,c_aud,mask_aud,c_vid,mask_vid).float()
+        with timer.stage('loss'):
+            val_loss = ImbOLL(logits,w,phq_scores,alpha)
         total_val_loss += (val_loss.item()* float(c_txt.shape[0]))
         preds = torch.argmax(logits, dim=1).flatten()
         accuracy = (preds == phq_scores).cpu().numpy().mean() * 100
@@ -530,12 +598,15 @@ def evaluate(model, data_val, val_dataloader, w, alpha):
     val_mae = mae_loss_fn(preds_all.float(),labels_all.float())
 
     avg_val_loss = total_val_loss / len(data_val)
+    timer.report(val_loss=avg_val_loss)
 
     return avg_val_loss,val_accuracy,val_mi_f1,val_ma_f1,val_weight_f1,val_loss_ccc,val_loss_rmse,val_mae
 
 if __name__ == '__main__':
 
     args = cmdline_args()
+    set_thread_budget(args.threads, args.interop_threads, args.cores, args.pin)
+    init_distributed(args.ddp)
 
     set_seed(args.seed)    # Set seed for reproducibility
 
@@ -546,45 +617,52 @@ if __name__ == '__main__':
     else:
         device = torch.device("cpu")
     print(f"# Using device: {device}")
+    if args.bf16 or args.bf16_parity:
+        check_bf16(device)
 
     # Load model from HuggingFace Hub
     tokenizer_txt = AutoTokenizer.from_pretrained('sentence-transformers/all-distilroberta-v1')
     embedder_txt = AutoModel.from_pretrained('sentence-transformers/all-distilroberta-v1').to(device)
     
-    # Datasets
-    data_train = dds('train',args.data_path,args.label_path,args.question_number,args.missing_video_files)
-    data_val = dds('val',args.data_path,args.label_path,args.question_number,args.missing_video_files)
+    # Datasets, rank 0 fills the caches before the other ranks read them
+    with main_first():
+        # Stream the training set from shards written by questmf.shards, or build it
+        if args.shards:
+            data_train = shard_dataset(args.shards,args.question_number,['txt','aud','vid'],args.shuffle_buffer,args.seed)
+        else:
+            data_train = dds('train',args.data_path,args.label_path,args.question_number,args.missing_video_files,args.workers,args.pool,args.cache_dir)
+        data_val = dds('val',args.data_path,args.label_path,args.question_number,args.missing_video_files,args.workers,args.pool,args.cache_dir)
     
     # Define Text Encoder
-    pretrain_txt_model = lstm_regressor_txt()
+    pretrain_txt_model = lstm_regressor_txt(head=args.head)
     # Load trained text model
     pretrain_txt_model.load_state_dict(torch.load(args.text_checkpoint_path +'-phq' + str(args.question_number) + '-seed-' + str(args.seed) + '.pt'))
     pretrain_txt_model.to(device)
     
     # Define Audio Encoder
-    pretrain_aud_model = lstm_regressor_aud()
+    pretrain_aud_model = lstm_regressor_aud(head=args.head)
     # Load trained audio model
     pretrain_aud_model.load_state_dict(torch.load(args.audio_checkpoint_path +'-phq' + str(args.question_number) + '-seed' + str(args.seed) + '.pt'))
     pretrain_aud_model.to(device)
     
     # Define Video Encoder
-    pretrain_vid_model = lstm_regressor_vid()
+    pretrain_vid_model = lstm_regressor_vid(head=args.head)
     # Load trained video model
     pretrain_vid_model.load_state_dict(torch.load(args.video_checkpoint_path +'-phq' + str(args.question_number) + '-seed' + str(args.seed) + '.pt'))
     pretrain_vid_model.to(device)
 
     # Define TAV Model
-    model = lstm_regressor(pretrain_txt_model, pretrain_aud_model, pretrain_vid_model)
+    model = lstm_regressor(pretrain_txt_model, pretrain_aud_model, pretrain_vid_model, fused_attn=args.fused_attn, grad_ckpt=args.grad_ckpt, head=args.head)
     model.to(device)
     
     # Dataloaders
-    train_dataloader = DataLoader(data_train,  batch_size=10,shuffle=True)
-    val_dataloader = DataLoader(data_val,  batch_size=10)
+    train_dataloader = train_loader(data_train, args.batch_size, args.seed, args.loader_workers)
+    val_dataloader = DataLoader(data_val,  batch_size=args.batch_size)
     
-    num_epochs = 20
+    num_epochs = args.epochs
     
     optimizer = torch.optim.AdamW(model.parameters(),
-                      lr=5e-4,    # Default learning rate
+                      lr=scale_lr(args.lr, args.batch_size, args.lr_scale),    # 5e-4 at batch size 10 by default
                       eps=1e-8,    # Default epsilon value
                       weight_decay=1e-3)
     
@@ -596,15 +674,30 @@ if __name__ == '__main__':
     ccc_loss_fn = ccc_loss()
     mae_loss_fn = nn.L1Loss()
 
-    w = get_weights(args.question_number,args.label_path,args.beta)
+    w = get_weights(args.question_number,args.label_path,args.beta,args.cache_dir)
     
+    # Profile a window of training steps
+    profiler = make_profiler(args.profile_dir if args.profile and is_main() else None, *args.profile_steps)
+
+    # Compile for the per-rank batch size, the graphs are built on the first batch before training
+    if args.compile and args.train_model:
+        compile_model(model, train_dataloader.batch_size, args.cache_dir)
+        warm_up(model, next(iter(DataLoader(data_train, batch_size=train_dataloader.batch_size))), device, bf16=args.bf16)
+
     if args.train_model:
-        train(model, train_dataloader, data_train, data_val, args.tav_checkpoint_path + '-phq' + str(args.question_number), args.seed, w, args.alpha, val_dataloader, epochs=num_epochs, evaluation=True)
+        train(wrap_model(model, find_unused_parameters=True), train_dataloader, data_train, data_val, args.tav_checkpoint_path + '-phq' + str(args.question_number), args.seed, w, args.alpha, val_dataloader, epochs=num_epochs, evaluation=True, metrics_path=args.metrics_path if is_main() else None, profiler=profiler, bf16=args.bf16)
+        # Wait for rank 0 to write the checkpoints
+        barrier()
     
     # Load trained TAV model
-    best_lstm_regressor = lstm_regressor(pretrain_txt_model, pretrain_aud_model, pretrain_vid_model)
+    best_lstm_regressor = lstm_regressor(pretrain_txt_model, pretrain_aud_model, pretrain_vid_model, fused_attn=args.fused_attn, head=args.head)
     best_lstm_regressor.load_state_dict(torch.load(args.tav_checkpoint_path +'-phq' + str(args.question_number) + '-seed' + str(args.seed) + '.pt'))
     best_lstm_regressor.to(device)
 
     # Evaluate trained TAV model
-    print(evaluate(best_lstm_regressor,data_val,val_dataloader, w, args.alpha))
\ No newline at end of file
+    if args.bf16_parity:
+        names = ('Loss','Accuracy','Micro F1','Macro F1','Weighted F1','CCC','RMSE','MAE')
+        parity_report(names, evaluate(best_lstm_regressor,data_val,val_dataloader, w, args.alpha, args.metrics_path if is_main() else None), evaluate(best_lstm_regressor,data_val,val_dataloader, w, args.alpha, args.metrics_path if is_main() else None, bf16=True))
+    else:
+        print(evaluate(best_lstm_regressor,data_val,val_dataloader, w, args.alpha, args.metrics_path if is_main() else None, bf16=args.bf16))
+    cleanup()
\ No newline at end of file
@@ -9,6 +9,20 @@ import torch.nn.functional as F
 import random
 import argparse
 import os
+import sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from questmf.instrument import stage_timer
+from questmf.profiling import make_profiler, profile_range
+from questmf.corpus import scan_corpus
+from questmf.feature_cache import resnet_cache, open_features, segment_means
+from questmf.records import session, memory_report
+from questmf.threads import set_thread_budget
+from questmf.precision import autocast, check_bf16, parity_report
+from questmf.compile import compile_model, warm_up
+from questmf.config import parse_args
+from questmf.heads import HEADS, make_head, apply_head
+from questmf.prune import load_checkpoint
+from questmf.logits_store import save_logits
 
 def cmdline_args():
     # Make parser object
@@ -18,8 +32,27 @@ def cmdline_args():
     p.add_argument("-l_path", "--label_path", type=str, help="Path to labels, i.e., PHQ-8 scores")
     p.add_argument("-v_ckpt", "--video_checkpoint_path", type=str, help="Path to checkpoint for the video model")
     p.add_argument("-m_files", "--missing_video_files",nargs='+', type=int, help="List of file numbers for incomplete video files")
+    p.add_argument("-metrics", "--metrics_path", type=str, help="JSONL file for per-stage timing metrics")
+    p.add_argument("-profile", "--profile", action='store_true', help="Profile a window of steps with torch.profiler")
+    p.add_argument("-profile_dir", "--profile_dir", type=str, default='profile', help="Directory for profiler traces and the top-ops table")
+    p.add_argument("-profile_steps", "--profile_steps", nargs=3, type=int, default=[1,1,5], help="Number of steps to skip, warm up and record")
+    p.add_argument("-workers", "--workers", type=int, default=8, help="Number of workers for reading the participant files")
+    p.add_argument("-pool", "--pool", type=str, default='thread', choices=['thread','process'], help="Use a thread or a process pool for reading the participant files")
+    p.add_argument("-cache_dir", "--cache_dir", type=str, default='cache', help="Directory for the float32 copies of the ResNet features")
+    p.add_argument("-threads", "--threads", type=int, help="Number of intra-op threads (default: one per core in -cores, else all cores)")
+    p.add_argument("-interop_threads", "--interop_threads", type=int, help="Number of inter-op threads")
+    p.add_argument("-cores", "--cores", type=str, help="Cores for this process, e.g. 0-7")
+    p.add_argument("-pin", "--pin", action='store_true', help="Pin the process to the cores given in -cores")
+    p.add_argument("-bf16", "--bf16", action='store_true', help="Run the forward passes under bf16 autocast, the weights stay float32")
+    p.add_argument("-bf16_parity", "--bf16_parity", action='store_true', help="Evaluate in float32 and in bf16 and compare the metrics")
+    p.add_argument("-compile", "--compile", action='store_true', help="Compile the model with torch.compile, the kernels are cached in <cache_dir>/inductor")
+    p.add_argument("-bs", "--batch_size", type=int, default=10, help="Batch size for evaluation")
+    p.add_argument("-config", "--config", type=str, help="JSON or YAML file with defaults for any of these options, e.g. {\"bs\": 32}")
+    p.add_argument("-head", "--head", type=str, default='flatten', choices=HEADS, help="Classification head of every model: the flattened MLP of the paper, or masked mean+max or attention pooling over the turns")
+    p.add_argument("-logits_store", "--logits_store", type=str, help="SQLite file to store the per-question logits of every participant in, see questmf.logits_store")
+    p.add_argument("-store_splits", "--store_splits", nargs='+', default=['test'], choices=['train','val','test'], help="Splits whose logits go to -logits_store")
 
-    return (p.parse_args())
+    return (parse_args(p))
 
 def set_seed(seed_value=42):
     """Set seed for reproducibility.
@@ -29,8 +62,47 @@ def set_seed(seed_value=42):
     torch.manual_seed(seed_value)
     torch.cuda.manual_seed_all(seed_value)
 
+def load_participant(p_id_int,data_path,score,cache_dir):
+    """Read the transcript and features of one participant.
+    """
+    p_id = str(p_id_int)
+    df_txt = pd.read_csv(data_path + p_id + '_P/' + p_id + '_Transcript.csv')
+    vid_file = data_path + p_id + '_P/features/' + p_id + '_CNN_ResNet.mat'
+    t = librosa.get_duration(path=data_path + p_id + '_P/' + p_id + '_AUDIO.wav')  
+        
+    # float32 copy of the ResNet features, memory mapped in the preprocessing
+    vid_feat_file = resnet_cache(vid_file,cache_dir)
+    vid_feat = open_features(vid_feat_file)
+    feat_len = len(vid_feat)
+    
+    # Sampling rate
+    m_factor = feat_len/t
+
+    # Preprocessing start and end times
+    start_times = (df_txt['Start_Time'].values*m_factor).tolist()
+    end_times = (df_txt['End_Time'].values*m_factor).tolist()
+
+    x = 1
+    y = len(start_times)
+    while x < y:
+        if start_times[x-1]>start_times[x] or start_times[x]>feat_len:
+            del start_times[x]
+            del end_times[x]
+            x = x-1
+            y = y-1
+        if end_times[x-1]>end_times[x] or end_times[x]>feat_len:
+            del start_times[x]
+            del end_times[x]
+            x = x-1
+            y = y-1
+        x = x+1
+    
+    start_times = [round(a) for a in start_times]
+    end_times = [round(b) for b in end_times]
+    return session(p_id_int,float(score),vid_file=vid_feat_file,vid_start=start_times,vid_end=end_times)
+
 class dds(Dataset):
-    def __init__(self,split,data_path,label_path,missing_files_list):
+    def __init__(self,split,data_path,label_path,missing_files_list,workers=1,pool='thread',cache_dir='cache'):
         super(dds,self).__init__()
         if split == 'train':
             df_data = pd.read_csv(label_path + 'train_split.csv')
@@ -40,60 +112,19 @@ class dds(Dataset):
             df_data = pd.read_csv(label_path + 'test_split.csv')
         else:
             raise Exception(f"wrong split: {split}")
-        self.data = []
         p_id_list = df_data['Participant_ID'].tolist()
         phq_score_list = df_data['PHQ_Score'].tolist()
-        for i in range(len(p_id_list)):
-            p_id = str(p_id_list[i])
-            # Files not complete
-            if p_id_list[i] in missing_files_list:
-                continue
-            df_txt = pd.read_csv(data_path + p_id + '_P/' + p_id + '_Transcript.csv')
-            vid_file = data_path + p_id + '_P/features/' + p_id + '_CNN_ResNet.mat'
-            t = librosa.get_duration(path=data_path + p_id + '_P/' + p_id + '_AUDIO.wav')  
-                
-            self.data.append([vid_file,df_txt,t,float(phq_score_list[i])])
+        # Files not complete for video
+        jobs = [(p_id,data_path,score,cache_dir) for p_id,score in zip(p_id_list,phq_score_list) if p_id not in missing_files_list]
+        # Participants are read on a bounded pool, in split order
+        self.data = scan_corpus(load_participant, jobs, workers, pool)
+        memory_report(split,self.data)
     
-    def preprocess(self,vid_file,df_txt,t):
-        vid_data = sio.loadmat(vid_file)
-        vid_feat = vid_data['feature']
-        feat_len = len(vid_feat)
-        
-        # Sampling rate
-        m_factor = feat_len/t
-
-        # Preprocessing start and end times
-        start_times = (df_txt['Start_Time'].values*m_factor).tolist()
-        end_times = (df_txt['End_Time'].values*m_factor).tolist()
-
-        x = 1
-        y = len(start_times)
-        while x < y:
-            if start_times[x-1]>start_times[x] or start_times[x]>feat_len:
-                del start_times[x]
-                del end_times[x]
-                x = x-1
-                y = y-1
-            if end_times[x-1]>end_times[x] or end_times[x]>feat_len:
-                del start_times[x]
-                del end_times[x]
-                x = x-1
-                y = y-1
-            x = x+1
-        
-        start_times = [round(a) for a in start_times]
-        end_times = [round(b) for b in end_times]
-        
-        vid_feat_0 = torch.tensor(vid_feat[start_times[0]:end_times[0]]).unsqueeze(0)
-        out = torch.mean(vid_feat_0,dim=1)
-        out = out.detach().cpu()
-
-        for i in range(1,len(start_times)):
-            vid_feat_i = torch.tensor(vid_feat[start_times[i]:end_times[i]]).unsqueeze(0)
-            # Mean pooling
-            mean_i = torch.mean(vid_feat_i,dim=1)
-            mean_i = mean_i.detach().cpu()
-            out = torch.cat((out,mean_i),dim=0)
+    @profile_range('preprocess_vid')
+    def preprocess(self,vid_feat_file,start_times,end_times):
+        vid_feat = open_features(vid_feat_file)
+        # Mean pooling over the frames of every turn, only the first 120 turns are kept
+        out = torch.from_numpy(segment_means(vid_feat,start_times[:120],end_times[:120]))
         l = len(start_times)
         # Maximum number of turns
         if l > 120:
@@ -108,13 +139,14 @@ class dds(Dataset):
         out = F.normalize(out, p=2, dim=1)
         return out,mask
     def __getitem__(self,index):
-        embedding, mask = self.preprocess(self.data[index][0],self.data[index][1],self.data[index][2])
-        return [embedding,mask,self.data[index][3]]
+        s = self.data[index]
+        embedding, mask = self.preprocess(s.vid_file,s.vid_start,s.vid_end)
+        return [embedding,mask,s.label]
     def __len__(self):
         return len(self.data)
 
 class lstm_regressor(nn.Module):
-    def __init__(self):
+    def __init__(self,head='flatten'):
         super(lstm_regressor, self).__init__()
         self.lstm_1 = nn.LSTM(2048,50,batch_first=True,bidirectional=True)
         self.attention1 = nn.MultiheadAttention(100, 4,batch_first=True,dropout=0.2)
@@ -125,12 +157,14 @@ class lstm_regressor(nn.Module):
                                 nn.ReLU(),
                                 nn.Dropout(0.2),
                                 nn.Linear(256,4))
+        self.mlp = make_head(head,self.mlp)
 
+    @profile_range('vid_encoder')
     def forward(self,C,key_padding_mask):
         c_lstm,_ = self.lstm_1(C)
         c_att,_ = self.attention1(c_lstm,c_lstm,c_lstm,key_padding_mask=key_padding_mask)
         c_att2,_ = self.attention2(c_att,c_att,c_att,key_padding_mask=key_padding_mask)
-        logits = self.mlp(c_att2)
+        logits = apply_head(self.mlp,c_att2,key_padding_mask)
         return logits
 
 # CCC loss
@@ -157,7 +191,7 @@ class ccc_loss(nn.Module):
         ccc = numerator/denominator
         return 1-ccc
 
-def evaluate(model1,model2,model3,model4,model5,model6,model7,model8, val_dataloader):
+def evaluate(model1,model2,model3,model4,model5,model6,model7,model8, val_dataloader, metrics_path=None, profiler=None, bf16=False, logits_out=None):
     """After the completion of each training epoch, measure the model's performance
     on our validation set.
     """
@@ -171,18 +205,23 @@ def evaluate(model1,model2,model3,model4,model5,model6,model7,model8, val_datalo
     model6.eval()
     model7.eval()
     model8.eval()
+    timer = stage_timer(device, metrics_path, phase='eval')
+    profiler = profiler or make_profiler(None)
+    profiler.start()
 
     # Tracking variables
     preds_list = []
     labels_list = []
 
     # For each batch in our validation set...
-    for batch in val_dataloader:
+    for batch in timer.loader(val_dataloader):
         # Load batch to GPU
-        c, mask, phq_scores = tuple(t.to(device) for t in batch)
+        with timer.stage('h2d'):
+            c, mask, phq_scores = tuple(t.to(device) for t in batch)
+        timer.add_samples(phq_scores.shape[0])
 
         # Compute predictions
-        with torch.no_grad():
+        with timer.stage('forward'), torch.no_grad(), autocast(device, bf16):
             logits1 = model1.forward(c,mask)
             logits2 = model2.forward(c,mask)
             logits3 = model3.forward(c,mask)
@@ -191,6 +230,8 @@ def evaluate(model1,model2,model3,model4,model5,model6,model7,model8, val_datalo
             logits6 = model6.forward(c,mask)
             logits7 = model7.forward(c,mask)
             logits8 = model8.forward(c,mask)
+        if logits_out is not None:
+            logits_out.append(torch.stack([logits1,logits2,logits3,logits4,logits5,logits6,logits7,logits8], dim=1).float().cpu())
         
         # Compute preds
         preds1 = torch.argmax(logits1, dim=1).flatten()
@@ -205,6 +246,7 @@ def evaluate(model1,model2,model3,model4,model5,model6,model7,model8, val_datalo
         preds = preds1+preds2+preds3+preds4+preds5+preds6+preds7+preds8
         preds_list.append(preds)
         labels_list.append(phq_scores)
+        profiler.step()
 
         preds = preds.detach().cpu()
         phq_scores = phq_scores.detach().cpu()
@@ -212,6 +254,8 @@ def evaluate(model1,model2,model3,model4,model5,model6,model7,model8, val_datalo
     # Compute the average accuracy and loss over the validation set.
     preds_all = torch.cat(preds_list, dim=0)
     labels_all = torch.cat(labels_list, dim=0)
+    profiler.stop()
+    timer.report()
     val_loss_ccc = 1 - ccc_loss_fn(preds_all.float(), labels_all.float())
     val_loss_rmse = torch.sqrt(loss_fn_mse(preds_all.float(), labels_all.float()))
     val_loss_mae = mae_loss_fn(preds_all.float(),labels_all.float())
@@ -221,6 +265,7 @@ def evaluate(model1,model2,model3,model4,model5,model6,model7,model8, val_datalo
 if __name__ == '__main__':
 
     args = cmdline_args()
+    set_thread_budget(args.threads, args.interop_threads, args.cores, args.pin)
 
     set_seed(args.seed)    # Set seed for reproducibility
 
@@ -231,31 +276,33 @@ if __name__ == '__main__':
     else:
         device = torch.device("cpu")
     print(f"# Using device: {device}")
+    if args.bf16 or args.bf16_parity:
+        check_bf16(device)
 
     # Datasets
-    data_train = dds('train',args.data_path,args.label_path,args.missing_video_files)
-    data_val = dds('val',args.data_path,args.label_path,args.missing_video_files)
-    data_test = dds('test',args.data_path,args.label_path,args.missing_video_files)
+    data_train = dds('train',args.data_path,args.label_path,args.missing_video_files,args.workers,args.pool,args.cache_dir)
+    data_val = dds('val',args.data_path,args.label_path,args.missing_video_files,args.workers,args.pool,args.cache_dir)
+    data_test = dds('test',args.data_path,args.label_path,args.missing_video_files,args.workers,args.pool,args.cache_dir)
     
     # Define Video Encoder for each Question
-    r1 = lstm_regressor()
-    r2 = lstm_regressor()
-    r3 = lstm_regressor()
-    r4 = lstm_regressor()
-    r5 = lstm_regressor()
-    r6 = lstm_regressor()
-    r7 = lstm_regressor()
-    r8 = lstm_regressor()
+    r1 = lstm_regressor(head=args.head)
+    r2 = lstm_regressor(head=args.head)
+    r3 = lstm_regressor(head=args.head)
+    r4 = lstm_regressor(head=args.head)
+    r5 = lstm_regressor(head=args.head)
+    r6 = lstm_regressor(head=args.head)
+    r7 = lstm_regressor(head=args.head)
+    r8 = lstm_regressor(head=args.head)
     
     # Load pretrained weights
-    r1.load_state_dict(torch.load(args.video_checkpoint_path + '-phq1-seed-' + str(args.seed) + '-ccc.pt'))
-    r2.load_state_dict(torch.load(args.video_checkpoint_path + '-phq2-seed-' + str(args.seed) + '-ccc.pt'))
-    r3.load_state_dict(torch.load(args.video_checkpoint_path + '-phq3-seed-' + str(args.seed) + '-ccc.pt'))
-    r4.load_state_dict(torch.load(args.video_checkpoint_path + '-phq4-seed-' + str(args.seed) + '-ccc.pt'))
-    r5.load_state_dict(torch.load(args.video_checkpoint_path + '-phq5-seed-' + str(args.seed) + '-ccc.pt'))
-    r6.load_state_dict(torch.load(args.video_checkpoint_path + '-phq6-seed-' + str(args.seed) + '-ccc.pt'))
-    r7.load_state_dict(torch.load(args.video_checkpoint_path + '-phq7-seed-' + str(args.seed) + '-ccc.pt'))
-    r8.load_state_dict(torch.load(args.video_checkpoint_path + '-phq8-seed-' + str(args.seed) + '-ccc.pt'))
+    load_checkpoint(r1, args.video_checkpoint_path + '-phq1-seed-' + str(args.seed) + '-ccc.pt')
+    load_checkpoint(r2, args.video_checkpoint_path + '-phq2-seed-' + str(args.seed) + '-ccc.pt')
+    load_checkpoint(r3, args.video_checkpoint_path + '-phq3-seed-' + str(args.seed) + '-ccc.pt')
+    load_checkpoint(r4, args.video_checkpoint_path + '-phq4-seed-' + str(args.seed) + '-ccc.pt')
+    load_checkpoint(r5, args.video_checkpoint_path + '-phq5-seed-' + str(args.seed) + '-ccc.pt')
+    load_checkpoint(r6, args.video_checkpoint_path + '-phq6-seed-' + str(args.seed) + '-ccc.pt')
+    load_checkpoint(r7, args.video_checkpoint_path + '-phq7-seed-' + str(args.seed) + '-ccc.pt')
+    load_checkpoint(r8, args.video_checkpoint_path + '-phq8-seed-' + str(args.seed) + '-ccc.pt')
     
     r1.to(device)
     r2.to(device)
@@ -267,13 +314,37 @@ if __name__ == '__main__':
     r8.to(device)
     
     # Dataloaders
-    train_dataloader = DataLoader(data_train,  batch_size=10)
-    val_dataloader = DataLoader(data_val,  batch_size=10)
-    test_dataloader = DataLoader(data_test,  batch_size=10)
+    train_dataloader = DataLoader(data_train,  batch_size=args.batch_size)
+    val_dataloader = DataLoader(data_val,  batch_size=args.batch_size)
+    test_dataloader = DataLoader(data_test,  batch_size=args.batch_size)
     
     # Specify loss functions/Metrics
     loss_fn_mse = nn.MSELoss()
     ccc_loss_fn = ccc_loss()
     mae_loss_fn = nn.L1Loss()
     
-    print(evaluate(r1,r2,r3,r4,r5,r6,r7,r8,test_dataloader))
\ No newline at end of file
+    # Compile the models and build their graphs on the first batch
+    if args.compile:
+        for model in (r1, r2, r3, r4, r5, r6, r7, r8):
+            compile_model(model, test_dataloader.batch_size, args.cache_dir)
+            warm_up(model, next(iter(test_dataloader)), device, train=False, bf16=args.bf16)
+
+    # Logits kept for -logits_store, per split
+    store_logits = {split: [] for split in args.store_splits} if args.logits_store else {}
+
+    # Profile a window of evaluation batches
+    profiler = make_profiler(args.profile_dir if args.profile else None, *args.profile_steps)
+
+    if args.bf16_parity:
+        parity_report(('CCC','RMSE','MAE'), evaluate(r1,r2,r3,r4,r5,r6,r7,r8,test_dataloader, args.metrics_path, profiler), evaluate(r1,r2,r3,r4,r5,r6,r7,r8,test_dataloader, args.metrics_path, bf16=True))
+    else:
+        print(evaluate(r1,r2,r3,r4,r5,r6,r7,r8,test_dataloader, args.metrics_path, profiler, args.bf16, logits_out=store_logits.get('test')))
+
+    # Store the logits of every participant, the test logits come from the evaluation above
+    if args.logits_store:
+        ckpt_files = [args.video_checkpoint_path + '-phq' + str(q) + '-seed-' + str(args.seed) + '-ccc.pt' for q in range(1, 9)]
+        splits = {'train': (data_train, train_dataloader), 'val': (data_val, val_dataloader), 'test': (data_test, test_dataloader)}
+        for split, logits in store_logits.items():
+            if not logits:
+                evaluate(r1,r2,r3,r4,r5,r6,r7,r8,splits[split][1], bf16=args.bf16, logits_out=logits)
+            save_logits(args.logits_store, 'V', split, args.seed, splits[split][0], torch.cat(logits), ckpt_files, head=args.head, bf16=args.bf16)
@@ -0,0 +1 @@
+# Shared tooling for the QuestMF training and evaluation scripts
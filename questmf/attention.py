@@ -0,0 +1,70 @@
+import torch
+import torch.nn.functional as F
+
+# Several nn.MultiheadAttention blocks of the same shape in one go. The input projections of blocks
+# that read the same tensor (e.g. the two cross blocks with audio as query) are packed into one
+# batched matmul, every block runs F.scaled_dot_product_attention and the output projections run as
+# one batched matmul. The blocks' own parameters are used, so existing state dicts load as they are.
+# Like nn.MultiheadAttention, the work is done sequence first, so the per-head views need no copies.
+
+def _project(xs, weights, biases):
+    """F.linear(xs[i], weights[i], biases[i]) for every i, with one batched matmul per distinct input.
+
+    xs are (length * batch, embed_dim); every output comes back contiguous.
+    """
+    out = [None] * len(xs)
+    groups = {}
+    for i, x in enumerate(xs):
+        groups.setdefault(id(x), []).append(i)
+    for idx in groups.values():
+        x = xs[idx[0]]
+        y = torch.baddbmm(torch.stack([biases[i] for i in idx]).unsqueeze(1), x.expand(len(idx), *x.shape),
+                          torch.stack([weights[i] for i in idx]).transpose(1, 2))
+        for j, i in enumerate(idx):
+            out[i] = y[j]
+    return out
+
+def fused_attention(blocks, queries, keys, key_padding_masks):
+    """Same as [b(q, k, k, key_padding_mask=m)[0] for b, q, k, m in zip(blocks, queries, keys, key_padding_masks)]
+
+    for batch_first nn.MultiheadAttention blocks with equal embed_dim, num_heads and dropout, where
+    the keys are also the values. Masks are boolean with True at padded positions.
+    """
+    b0 = blocks[0]
+    embed_dim, num_heads, n = b0.embed_dim, b0.num_heads, len(blocks)
+    for b in blocks:
+        assert b.batch_first and b._qkv_same_embed_dim and b.in_proj_bias is not None and b.bias_k is None and not b.add_zero_attn
+        assert (b.embed_dim, b.num_heads, b.dropout) == (embed_dim, num_heads, b0.dropout)
+    batch, tgt_len, src_len = queries[0].shape[0], queries[0].shape[1], keys[0].shape[1]
+    head_dim = embed_dim // num_heads
+
+    # Sequence first, one transpose per distinct input
+    seq_first = {}
+    for x in list(queries) + list(keys):
+        if id(x) not in seq_first:
+            seq_first[id(x)] = x.transpose(0, 1).reshape(-1, embed_dim)
+    # Keys and values of all blocks reading the same tensor come out of one matmul
+    q = _project([seq_first[id(x)] for x in queries], [b.in_proj_weight[:embed_dim] for b in blocks], [b.in_proj_bias[:embed_dim] for b in blocks])
+    kv = _project([seq_first[id(x)] for x in keys for _ in range(2)],
+                  [w for b in blocks for w in b.in_proj_weight[embed_dim:].chunk(2)],
+                  [w for b in blocks for w in b.in_proj_bias[embed_dim:].chunk(2)])
+
+    # Additive masks, built once per distinct key padding mask
+    masks = {}
+    for m in key_padding_masks:
+        if id(m) not in masks:
+            mask = torch.zeros(m.shape, dtype=q[0].dtype, device=m.device).masked_fill_(m, float('-inf'))
+            masks[id(m)] = mask[:, None, None, :].expand(batch, num_heads, 1, src_len).reshape(batch * num_heads, 1, src_len)
+    dropout_p = b0.dropout if b0.training else 0.0
+    out = []
+    for i, m in enumerate(key_padding_masks):
+        # (length * batch, embed_dim) -> (batch * heads, length, head_dim) views
+        qi = q[i].view(tgt_len, batch * num_heads, head_dim).transpose(0, 1)
+        ki = kv[2 * i].view(src_len, batch * num_heads, head_dim).transpose(0, 1)
+        vi = kv[2 * i + 1].view(src_len, batch * num_heads, head_dim).transpose(0, 1)
+        o = F.scaled_dot_product_attention(qi, ki, vi, attn_mask=masks[id(m)], dropout_p=dropout_p)
+        out.append(o.transpose(0, 1).reshape(tgt_len * batch, embed_dim))
+
+    out = torch.baddbmm(torch.stack([b.out_proj.bias for b in blocks]).unsqueeze(1), torch.stack(out),
+                        torch.stack([b.out_proj.weight for b in blocks]).transpose(1, 2))
+    return out.view(n, tgt_len, batch, embed_dim).transpose(1, 2).unbind(0)
@@ -0,0 +1,94 @@
+import argparse
+import json
+import os
+import torch
+
+from questmf.bench import run_case
+from questmf.config import BASE_BATCH_SIZE, scale_lr
+from questmf.scripts import COMBOS
+
+# Find the largest training batch size of a model that fits a memory budget on this machine.
+# Doubles the batch size from -start and runs full training steps (forward, ImbOLL, backward,
+# AdamW step) on random inputs, each size in a fresh process, until a step no longer fits
+# in the budget or runs out of memory:
+#
+#   python -m questmf.batch_finder -combo TAV -budget_mb 8000
+#
+# The peak is that of the whole process (RSS on CPU, allocated memory on CUDA), since that
+# is what has to fit. The chosen size goes to the training scripts as -bs, e.g. with -lr_scale sqrt.
+
+def cmdline_args():
+    # Make parser object
+    p = argparse.ArgumentParser()
+    p.add_argument("-combo", "--combo", type=str, default='TAV', choices=list(COMBOS), help="Modality combination of the model")
+    p.add_argument("-budget_mb", "--budget_mb", type=float, help="Memory budget in MB (default: 90%% of the GPU memory, or 80%% of the available RAM)")
+    p.add_argument("-start", "--start", type=int, default=BASE_BATCH_SIZE, help="First batch size to try")
+    p.add_argument("-max_bs", "--max_batch_size", type=int, default=4096, help="Largest batch size to try")
+    p.add_argument("-reps", "--reps", type=int, default=3, help="Timed steps per batch size")
+    p.add_argument("-warmup", "--warmup", type=int, default=1, help="Untimed steps per batch size")
+    p.add_argument("-device", "--device", type=str, default='cuda' if torch.cuda.is_available() else 'cpu', help="Device to run on")
+    p.add_argument("-bf16", "--bf16", action='store_true', help="Run the forward passes under bf16 autocast")
+    p.add_argument("-fused_attn", "--fused_attn", action='store_true', help="Fused attention blocks (fusion models)")
+    p.add_argument("-grad_ckpt", "--grad_ckpt", action='store_true', help="Activation checkpointing (TAV model)")
+    p.add_argument("-lr", "--lr", type=float, default=5e-4, help="Learning rate at batch size 10, to print the scaled learning rates")
+    p.add_argument("-lr_scale", "--lr_scale", type=str, default='sqrt', choices=['none','linear','sqrt'], help="Scaling rule for the printed learning rates")
+    p.add_argument("-o", "--output", type=str, help="JSON file for the results")
+    return p.parse_args()
+
+def default_budget_mb(device):
+    if torch.device(device).type == 'cuda':
+        return 0.9 * torch.cuda.get_device_properties(torch.device(device)).total_memory / 2 ** 20
+    with open('/proc/meminfo') as f:
+        info = dict(line.split(':', 1) for line in f)
+    return 0.8 * int(info['MemAvailable'].split()[0]) / 1024
+
+def peak_mb(result):
+    return result['cuda_peak_mb'] if 'cuda_peak_mb' in result else result['peak_rss_mb']
+
+def find_batch_size(combo, budget_mb, start, max_batch_size, opts, **options):
+    """Try batch sizes start, 2*start, ... and return a record per size tried.
+
+    Stops after the first size that goes over budget_mb or fails (e.g. out of memory).
+    """
+    results = []
+    bs = start
+    while bs <= max_batch_size:
+        result = run_case(dict({'kind': 'train_step', 'combo': combo, 'batch_size': bs}, **options), opts)
+        result['fits'] = 'error' not in result and peak_mb(result) <= budget_mb
+        results.append(result)
+        if 'error' in result:
+            print(f"{bs:>6} | error: {result['error']}")
+        else:
+            print(f"{bs:>6} | {result['ms_per_op']:>10.1f} | {result['samples_per_sec']:>9.1f} | {peak_mb(result):>9.0f}" + ("" if result['fits'] else " | over budget"))
+        if not result['fits']:
+            break
+        bs *= 2
+    return results
+
+if __name__ == '__main__':
+
+    args = cmdline_args()
+    if args.grad_ckpt and args.combo != 'TAV':
+        raise SystemExit("-grad_ckpt is only available for the TAV model")
+    budget = args.budget_mb or default_budget_mb(args.device)
+    options = {k: True for k in ('bf16', 'fused_attn', 'grad_ckpt') if getattr(args, k)}
+    opts = {'reps': args.reps, 'warmup': args.warmup, 'device': args.device}
+    print(f"# {args.combo} on {args.device}, budget {budget:.0f} MB" + "".join(f", {k}" for k in options))
+    print(f"{'Batch':>6} | {'ms/step':>10} | {'samples/s':>9} | {'Peak MB':>9}")
+    print("-"*45)
+    results = find_batch_size(args.combo, budget, args.start, args.max_batch_size, opts, **options)
+
+    fits = [r for r in results if r['fits']]
+    if not fits:
+        print(f"# Batch size {args.start} does not fit in {budget:.0f} MB")
+    else:
+        largest = fits[-1]
+        fastest = max(fits, key=lambda r: r['samples_per_sec'])
+        print(f"# Largest batch size within budget: {largest['batch_size']}, highest throughput: {fastest['batch_size']} ({fastest['samples_per_sec']:.1f} samples/s)")
+        for bs in sorted({largest['batch_size'], fastest['batch_size']}):
+            scale_lr(args.lr, bs, args.lr_scale)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'combo': args.combo, 'device': args.device, 'budget_mb': budget, 'options': options,
+                       'num_threads': torch.get_num_threads(), 'cpu_count': os.cpu_count(), 'results': results}, f, indent=1)
+        print(f"# Results written to {args.output}")
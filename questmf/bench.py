@@ -0,0 +1,360 @@
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+from queue import Empty
+import resource
+import statistics
+import subprocess
+import tempfile
+import time
+import torch
+
+from questmf.heads import HEADS
+from questmf.scripts import COMBOS, ROOT, load_script, bind, build_model, random_inputs, uses_text
+from questmf.synthetic import write_corpus
+
+# Benchmark suite for the QuestMF scripts on a synthetic corpus.
+# Every case runs in a fresh process so that the reported peak memory belongs to that case only.
+#
+#   python -m questmf.bench -o bench.json
+#   python -m questmf.bench -o new.json -compare old.json
+
+def cmdline_args():
+    # Make parser object
+    p = argparse.ArgumentParser()
+    p.add_argument("-o", "--output", type=str, default='bench.json', help="JSON file for the results")
+    p.add_argument("-cases", "--cases", nargs='+', default=['dds_init','getitem','forward','backward','imboll','evaluate'], help="Groups of cases to run, 'compile' compares eager and compiled training steps, 'fused_attn' unfused and fused attention, 'train_step' full training steps, 'grad_ckpt' TAV steps with and without checkpointing, 'head' training steps with each classification head")
+    p.add_argument("-combos", "--combos", nargs='+', default=list(COMBOS), help="Modality combinations to benchmark")
+    p.add_argument("-batch_sizes", "--batch_sizes", nargs='+', type=int, default=[1,10,32], help="Batch sizes for forward, backward and ImbOLL")
+    p.add_argument("-reps", "--reps", type=int, default=10, help="Timed repetitions per case")
+    p.add_argument("-warmup", "--warmup", type=int, default=2, help="Untimed repetitions per case")
+    p.add_argument("-n_turns", "--n_turns", type=int, default=140, help="Turns per synthetic session")
+    p.add_argument("-n_sessions", "--n_sessions", type=int, default=8, help="Synthetic sessions in the train split (val and test get half)")
+    p.add_argument("-data_dir", "--data_dir", type=str, default=None, help="Reuse/keep the synthetic corpus in this directory")
+    p.add_argument("-embedder", "--embedder", type=str, default='sentence-transformers/all-distilroberta-v1', help="Sentence embedder for text cases")
+    p.add_argument("-workers", "--workers", type=int, default=1, help="Workers for reading the participant files in dds_init/getitem/evaluate")
+    p.add_argument("-device", "--device", type=str, default='cpu', help="Device to run on")
+    p.add_argument("-compare", "--compare", type=str, default=None, help="Earlier results to compare against")
+    return p.parse_args()
+
+def _sync(device):
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+
+def _peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+def time_op(fn, reps, warmup, device, setup=None):
+    """Run fn warmup+reps times and return the timed durations in milliseconds.
+    setup runs before each call and is not timed.
+    """
+    times = []
+    for i in range(warmup + reps):
+        if setup is not None:
+            setup()
+        _sync(device)
+        t0 = time.perf_counter()
+        fn()
+        _sync(device)
+        if i >= warmup:
+            times.append((time.perf_counter() - t0) * 1000)
+    return times
+
+def _load_embedder(opts, device):
+    from transformers import AutoTokenizer, AutoModel
+    tokenizer = AutoTokenizer.from_pretrained(opts['embedder'])
+    embedder = AutoModel.from_pretrained(opts['embedder']).to(device)
+    return tokenizer, embedder
+
+def _script(combo, kind, opts, device):
+    module = load_script(combo, kind)
+    if uses_text(combo):
+        tokenizer, embedder = _load_embedder(opts, device)
+        return bind(module, device, tokenizer, embedder)
+    return bind(module, device)
+
+def _dds(module, combo, split, opts):
+    args = (split, opts['data_path'], opts['label_path']) + ((1,) if split == 'train' else ()) + ([], opts['workers'])
+    # The feature and sentence embedding caches live next to the synthetic corpus
+    return module.dds(*args, cache_dir=opts['cache_dir'])
+
+# Cases
+
+def case_dds_init(case, opts, device):
+    module = _script(case['combo'], 'train', opts, device)
+    fn = lambda: _dds(module, case['combo'], 'train', opts)
+    return time_op(fn, max(1, opts['reps'] // 5), 1, device)
+
+def case_getitem(case, opts, device):
+    module = _script(case['combo'], 'train', opts, device)
+    data = _dds(module, case['combo'], 'train', opts)
+    idx = iter(range(10 ** 9))
+    fn = lambda: data[next(idx) % len(data)]
+    return time_op(fn, opts['reps'], opts['warmup'], device)
+
+def case_forward(case, opts, device):
+    module = _script_no_text(case['combo'], device)
+    model = build_model(module, case['combo']).to(device)
+    model.train()
+    inputs = random_inputs(case['combo'], case['batch_size'], device)
+    fn = lambda: model(*inputs)
+    return time_op(fn, opts['reps'], opts['warmup'], device)
+
+def case_backward(case, opts, device):
+    module = _script_no_text(case['combo'], device)
+    model = build_model(module, case['combo']).to(device)
+    model.train()
+    inputs = random_inputs(case['combo'], case['batch_size'], device)
+    labels = torch.randint(0, 4, (case['batch_size'],), device=device).float()
+    w = torch.rand(4) + 0.5
+    state = {}
+    def setup():
+        model.zero_grad()
+        state['loss'] = module.ImbOLL(model(*inputs), w, labels, 1.0)
+    fn = lambda: state['loss'].backward()
+    return time_op(fn, opts['reps'], opts['warmup'], device, setup=setup)
+
+def case_imboll(case, opts, device):
+    module = _script_no_text('A', device)
+    logits = torch.randn(case['batch_size'], 4, device=device, requires_grad=True)
+    labels = torch.randint(0, 4, (case['batch_size'],), device=device).float()
+    w = torch.rand(4) + 0.5
+    fn = lambda: module.ImbOLL(logits, w, labels, 1.5).backward()
+    return time_op(fn, opts['reps'] * 10, opts['warmup'], device)
+
+def case_evaluate(case, opts, device):
+    module = _script(case['combo'], 'eval', opts, device)
+    data = _dds(module, case['combo'], 'test', opts)
+    models = []
+    for q in range(8):
+        model = build_model(module, case['combo']).to(device)
+        models.append(model)
+    loader = torch.utils.data.DataLoader(data, batch_size=10)
+    fn = lambda: module.evaluate(*models, loader)
+    return time_op(fn, max(1, opts['reps'] // 5), 1, device)
+
+def case_compile(case, opts, device):
+    """A full training step (forward, ImbOLL, backward, AdamW step) in eager mode or compiled."""
+    module = _script_no_text(case['combo'], device)
+    model = build_model(module, case['combo']).to(device)
+    model.train()
+    inputs = random_inputs(case['combo'], case['batch_size'], device)
+    labels = torch.randint(0, 4, (case['batch_size'],), device=device).float()
+    w = torch.rand(4) + 0.5
+    optimizer = torch.optim.AdamW(model.parameters(), lr=5e-4)
+    extra = {}
+    if case['compiled']:
+        from questmf.compile import compile_model
+        compile_model(model, case['batch_size'], opts['cache_dir'])
+        t0 = time.perf_counter()
+        model(*inputs).sum().backward()
+        extra['compile_s'] = time.perf_counter() - t0
+    def fn():
+        model.zero_grad()
+        module.ImbOLL(model(*inputs), w, labels, 1.0).backward()
+        optimizer.step()
+    return time_op(fn, opts['reps'], opts['warmup'], device), extra
+
+def case_fused_attn(case, opts, device):
+    """Training step (forward and backward) of a fusion model with the attention blocks run one by one or fused."""
+    module = _script_no_text(case['combo'], device)
+    torch.manual_seed(0)
+    model = build_model(module, case['combo'], fused_attn=case['fused']).to(device)
+    inputs = random_inputs(case['combo'], case['batch_size'], device)
+    extra = {}
+    if case['fused']:
+        # Same weights through the unfused blocks
+        ref = build_model(module, case['combo']).to(device)
+        ref.load_state_dict(model.state_dict())
+        ref.eval()
+        model.eval()
+        with torch.no_grad():
+            extra['max_abs_diff'] = (model(*inputs) - ref(*inputs)).abs().max().item()
+    model.train()
+    def fn():
+        model.zero_grad()
+        model(*inputs).sum().backward()
+    return time_op(fn, opts['reps'], opts['warmup'], device), extra
+
+def case_grad_ckpt(case, opts, device):
+    """TAV training step with and without activation checkpointing, and the memory it takes."""
+    module = _script_no_text('TAV', device)
+    torch.manual_seed(0)
+    model = build_model(module, 'TAV', grad_ckpt=case['ckpt']).to(device)
+    model.train()
+    inputs = random_inputs('TAV', case['batch_size'], device)
+    labels = torch.randint(0, 4, (case['batch_size'],), device=device).float()
+    w = torch.rand(4) + 0.5
+    baseline = _peak_rss_mb()
+    if device.type == 'cuda':
+        torch.cuda.reset_peak_memory_stats(device)
+        baseline = torch.cuda.memory_allocated(device) / 2 ** 20
+    def fn():
+        model.zero_grad()
+        module.ImbOLL(model(*inputs), w, labels, 1.0).backward()
+    times = time_op(fn, opts['reps'], opts['warmup'], device)
+    # Memory taken by a step on top of the model and the inputs
+    peak = torch.cuda.max_memory_allocated(device) / 2 ** 20 if device.type == 'cuda' else _peak_rss_mb()
+    return times, {'step_peak_mb': peak - baseline}
+
+def case_train_step(case, opts, device):
+    """A full training step with the options of the training scripts, and the memory it takes."""
+    from questmf.precision import autocast
+    module = _script_no_text(case['combo'], device)
+    kwargs = {k: True for k in ('fused_attn', 'grad_ckpt') if case.get(k)}
+    model = build_model(module, case['combo'], head=case.get('head', 'flatten'), **kwargs).to(device)
+    model.train()
+    inputs = random_inputs(case['combo'], case['batch_size'], device)
+    labels = torch.randint(0, 4, (case['batch_size'],), device=device).float()
+    w = torch.rand(4) + 0.5
+    optimizer = torch.optim.AdamW(model.parameters(), lr=5e-4)
+    baseline = torch.cuda.memory_allocated(device) / 2 ** 20 if device.type == 'cuda' else _peak_rss_mb()
+    def fn():
+        model.zero_grad()
+        with autocast(device, case.get('bf16', False)):
+            logits = model(*inputs).float()
+        module.ImbOLL(logits, w, labels, 1.0).backward()
+        optimizer.step()
+    times = time_op(fn, opts['reps'], opts['warmup'], device)
+    peak = torch.cuda.max_memory_allocated(device) / 2 ** 20 if device.type == 'cuda' else _peak_rss_mb()
+    return times, {'step_peak_mb': peak - baseline, 'samples_per_sec': case['batch_size'] * 1000 / statistics.mean(times),
+                   'params': sum(p.numel() for p in model.parameters())}
+
+def _script_no_text(combo, device):
+    # Model-only cases never touch the embedder
+    return bind(load_script(combo, 'train'), device)
+
+CASES = {'dds_init': case_dds_init, 'getitem': case_getitem, 'forward': case_forward,
+         'backward': case_backward, 'imboll': case_imboll, 'evaluate': case_evaluate, 'compile': case_compile,
+         'fused_attn': case_fused_attn, 'grad_ckpt': case_grad_ckpt, 'train_step': case_train_step,
+         'head': case_train_step}
+
+def _worker(case, opts, queue):
+    device = torch.device(opts['device'])
+    result = dict(case)
+    try:
+        times = CASES[case['kind']](case, opts, device)
+        if isinstance(times, tuple):
+            # Cases can report more than timings
+            times, extra = times
+            result.update(extra)
+        result.update({'ms_per_op': statistics.mean(times), 'ms_median': statistics.median(times),
+                       'ms_min': min(times), 'ms_stdev': statistics.pstdev(times), 'reps': len(times)})
+    except Exception as e:
+        result['error'] = repr(e)
+    result['peak_rss_mb'] = _peak_rss_mb()
+    if device.type == 'cuda':
+        result['cuda_peak_mb'] = torch.cuda.max_memory_allocated() / 2 ** 20
+    queue.put(result)
+
+def run_case(case, opts):
+    """Run a single case in a fresh process and return its result record.
+    """
+    ctx = multiprocessing.get_context('spawn')
+    queue = ctx.Queue()
+    proc = ctx.Process(target=_worker, args=(case, opts, queue))
+    proc.start()
+    result = None
+    while result is None:
+        try:
+            result = queue.get(timeout=1)
+        except Empty:
+            # The worker died without reporting back
+            if not proc.is_alive():
+                result = dict(case, error=f'worker exited with code {proc.exitcode}')
+    proc.join()
+    return result
+
+def make_cases(args):
+    cases = []
+    for kind in args.cases:
+        if kind == 'imboll':
+            cases += [{'kind': kind, 'batch_size': bs} for bs in args.batch_sizes]
+            continue
+        if kind == 'train_step':
+            cases += [{'kind': kind, 'combo': combo, 'batch_size': bs} for combo in args.combos for bs in args.batch_sizes]
+            continue
+        if kind == 'head':
+            # Training steps with each classification head
+            cases += [{'kind': kind, 'combo': combo, 'batch_size': bs, 'head': h} for combo in args.combos for bs in args.batch_sizes for h in HEADS]
+            continue
+        if kind == 'grad_ckpt':
+            # Only the TAV model has the option
+            cases += [{'kind': kind, 'combo': 'TAV', 'batch_size': bs, 'ckpt': c} for bs in args.batch_sizes for c in (False, True)]
+            continue
+        for combo in args.combos:
+            if kind in ('forward', 'backward'):
+                cases += [{'kind': kind, 'combo': combo, 'batch_size': bs} for bs in args.batch_sizes]
+            elif kind == 'fused_attn':
+                if len(COMBOS[combo][2]) > 1:
+                    cases += [{'kind': kind, 'combo': combo, 'batch_size': bs, 'fused': f} for bs in args.batch_sizes for f in (False, True)]
+            elif kind == 'compile':
+                # Eager and compiled steps side by side
+                cases += [{'kind': kind, 'combo': combo, 'batch_size': bs, 'compiled': c} for bs in args.batch_sizes for c in (False, True)]
+            elif kind != 'getitem' or len(COMBOS[combo][2]) == 1 or combo == 'TAV':
+                # Item fetch per modality plus the full TAV sample
+                cases.append({'kind': kind, 'combo': combo})
+    return cases
+
+def case_name(case):
+    return '/'.join([case['kind']] + ([case['combo']] if 'combo' in case else []) + ([f"bs{case['batch_size']}"] if 'batch_size' in case else []) + (['compiled' if case['compiled'] else 'eager'] if 'compiled' in case else []) + (['fused' if case['fused'] else 'unfused'] if 'fused' in case else []) + (['ckpt' if case['ckpt'] else 'no_ckpt'] if 'ckpt' in case else []) + ([case['head']] if 'head' in case else []))
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=ROOT, text=True).strip()
+    except Exception:
+        return None
+
+def compare(results, old_path):
+    """Print the change of ms/op and peak memory against an earlier run.
+    """
+    with open(old_path) as f:
+        old = {r['name']: r for r in json.load(f)['results']}
+    print(f"{'Case':<28} | {'Old ms':>10} | {'New ms':>10} | {'Speedup':>8} | {'Old MB':>8} | {'New MB':>8}")
+    print("-"*88)
+    for r in results:
+        o = old.get(r['name'])
+        if o is None or 'ms_per_op' not in o or 'ms_per_op' not in r:
+            continue
+        print(f"{r['name']:<28} | {o['ms_per_op']:>10.2f} | {r['ms_per_op']:>10.2f} | {o['ms_per_op'] / r['ms_per_op']:>7.2f}x | {o['peak_rss_mb']:>8.0f} | {r['peak_rss_mb']:>8.0f}")
+
+if __name__ == '__main__':
+
+    args = cmdline_args()
+    tmp = None
+    data_dir = args.data_dir
+    if data_dir is None:
+        tmp = tempfile.TemporaryDirectory()
+        data_dir = tmp.name
+    if not os.path.exists(os.path.join(data_dir, 'labels', 'Detailed_PHQ8_Labels.csv')):
+        print(f"# Writing synthetic corpus to {data_dir}")
+        write_corpus(data_dir, n_train=args.n_sessions, n_val=max(1, args.n_sessions // 2), n_test=max(1, args.n_sessions // 2), n_turns=args.n_turns)
+    opts = {'data_path': os.path.join(data_dir, 'data') + '/', 'label_path': os.path.join(data_dir, 'labels') + '/',
+            'reps': args.reps, 'warmup': args.warmup, 'embedder': args.embedder, 'device': args.device, 'workers': args.workers,
+            'cache_dir': os.path.join(data_dir, 'cache')}
+
+    results = []
+    for case in make_cases(args):
+        result = run_case(case, opts)
+        result['name'] = case_name(case)
+        results.append(result)
+        if 'error' in result:
+            print(f"{result['name']:<28} | error: {result['error']}")
+        else:
+            print(f"{result['name']:<28} | {result['ms_per_op']:>10.2f} ms/op | {result['peak_rss_mb']:>8.0f} MB peak" + (f" | compiled in {result['compile_s']:.1f}s" if 'compile_s' in result else "") + (f" | max abs diff {result['max_abs_diff']:.1e}" if 'max_abs_diff' in result else "") + (f" | step peak {result['step_peak_mb']:.0f} MB" if 'step_peak_mb' in result else "") + (f" | {result['params'] / 1e6:.1f}M params" if 'params' in result else ""))
+
+    report = {'commit': git_commit(), 'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'), 'torch': torch.__version__,
+              'python': platform.python_version(), 'machine': platform.machine(), 'cpu_count': os.cpu_count(),
+              'num_threads': torch.get_num_threads(), 'device': args.device, 'workers': args.workers, 'n_turns': args.n_turns,
+              'n_sessions': args.n_sessions, 'results': results}
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=1)
+    print(f"# Results written to {args.output}")
+
+    if args.compare:
+        compare(results, args.compare)
+    if tmp is not None:
+        tmp.cleanup()
@@ -0,0 +1,12 @@
+import torch
+from torch.utils.checkpoint import checkpoint
+
+# Activation checkpointing: a checkpointed block keeps only its inputs during the forward pass and
+# recomputes its activations in the backward pass, trading compute for memory. The RNG state is
+# restored for the recomputation, so dropout draws the same masks and the gradients are unchanged.
+
+def checkpointed(enabled, fn, *args):
+    """fn(*args), checkpointed when enabled and gradients are being recorded."""
+    if enabled and torch.is_grad_enabled():
+        return checkpoint(fn, *args, use_reentrant=False)
+    return fn(*args)
@@ -0,0 +1,63 @@
+import os
+import time
+import torch
+import torch._dynamo
+import torch._inductor.config
+
+from questmf.precision import autocast
+
+# torch.compile for the encoders and fusion models. Their inputs are always (batch x 120 x dim), so
+# they are compiled for one static batch size. A shorter last batch is padded up to it by repeating
+# its last sample and the extra rows are cut from the output, so it runs the same graph instead of
+# triggering a recompile. The generated kernels are cached on disk and reused by later runs.
+
+def pad_rows(t, batch_size):
+    """Pad t along the batch dimension to batch_size rows by repeating its last row."""
+    n = t.shape[0]
+    if n >= batch_size:
+        return t
+    return torch.cat((t, t[-1:].expand(batch_size - n, *t.shape[1:])), dim=0)
+
+def compile_model(model, batch_size, cache_dir, mode=None):
+    """Compile model.forward in place for a static batch size.
+
+    The parameters are untouched, so checkpoints still load into and save from the eager model.
+    """
+    # Has to be set before the first compile, inductor reads it once
+    os.environ.setdefault('TORCHINDUCTOR_CACHE_DIR', os.path.abspath(os.path.join(cache_dir, 'inductor')))
+    if hasattr(torch._inductor.config, 'fx_graph_cache'):
+        torch._inductor.config.fx_graph_cache = True
+    # One graph per model and train/eval mode, e.g. 8 questions x 2 modes in the evaluation scripts
+    torch._dynamo.config.cache_size_limit = max(torch._dynamo.config.cache_size_limit, 32)
+    compiled = torch.compile(model.forward, dynamic=False, mode=mode)
+
+    def forward(*inputs):
+        n = inputs[0].shape[0]
+        if n == batch_size:
+            return compiled(*inputs)
+        return compiled(*(pad_rows(t, batch_size) for t in inputs))[:n]
+
+    model.forward = forward
+    return model
+
+def warm_up(model, batch, device, train=True, bf16=False):
+    """Compile the graphs on one batch before the timed loop starts.
+
+    Runs a training step's forward and backward (when train) and an evaluation forward, with the
+    random state restored afterwards, so that dropout draws the same masks as without compiling.
+    """
+    inputs = [t.to(device) for t in batch[:-1]]
+    was_training = model.training
+    t0 = time.perf_counter()
+    with torch.random.fork_rng(devices=[device] if device.type == 'cuda' else []):
+        if train:
+            model.train()
+            with autocast(device, bf16):
+                out = model.forward(*inputs)
+            out.float().sum().backward()
+            model.zero_grad(set_to_none=True)
+        model.eval()
+        with torch.no_grad(), autocast(device, bf16):
+            model.forward(*inputs)
+    model.train(was_training)
+    print(f"# Compiled in {time.perf_counter() - t0:.1f}s")
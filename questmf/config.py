@@ -0,0 +1,45 @@
+import json
+import math
+
+# Batch size the learning rate of the scripts (5e-4) was tuned at
+BASE_BATCH_SIZE = 10
+
+def load_config(path):
+    """Read a JSON or, for .yaml/.yml files, a YAML mapping of option names to values."""
+    with open(path) as f:
+        if path.endswith(('.yaml', '.yml')):
+            import yaml
+            return yaml.safe_load(f) or {}
+        return json.load(f)
+
+def parse_args(p, argv=None):
+    """p.parse_args() with the defaults taken from the file given in -config.
+
+    Keys are option names with or without dashes, short or long (bs, batch_size, lr, qno, ...).
+    Options given on the command line override the file.
+    """
+    args, _ = p.parse_known_args(argv)
+    if getattr(args, 'config', None):
+        dests = {}
+        for a in p._actions:
+            dests[a.dest] = a.dest
+            for s in a.option_strings:
+                dests[s.lstrip('-')] = a.dest
+        config = load_config(args.config)
+        unknown = [k for k in config if k not in dests]
+        if unknown:
+            p.error(f"unknown options in {args.config}: {', '.join(unknown)}")
+        p.set_defaults(**{dests[k]: v for k, v in config.items()})
+    return p.parse_args(argv)
+
+def scale_lr(lr, batch_size, rule='none', base_batch_size=BASE_BATCH_SIZE):
+    """Learning rate for batch_size, given lr tuned at base_batch_size.
+
+    'linear' scales it by batch_size / base_batch_size, 'sqrt' by the square root of that.
+    """
+    if rule == 'none' or batch_size == base_batch_size:
+        return lr
+    k = batch_size / base_batch_size
+    scaled = lr * (k if rule == 'linear' else math.sqrt(k))
+    print(f"# Learning rate {lr:g} at batch size {base_batch_size} scaled ({rule}) to {scaled:g} at batch size {batch_size}")
+    return scaled
@@ -0,0 +1,37 @@
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+def _load(load_fn, job):
+    # Run in the worker so that one unreadable session does not take down the whole scan
+    try:
+        return load_fn(*job), None
+    except Exception as e:
+        return None, f"{type(e).__name__}: {e}"
+
+def scan_corpus(load_fn, jobs, workers=1, pool='thread'):
+    """Call load_fn(*job) for every job on a bounded pool and return the results in job order.
+
+    The first element of every job is the participant id. Participants whose files cannot be
+    read are reported and skipped. Threads suit the default case, since reading the csv and wav
+    files is mostly I/O; with pool='process' load_fn has to be picklable (a module level function).
+    """
+    workers = max(1, min(workers, len(jobs)))
+    if workers == 1:
+        results = [_load(load_fn, job) for job in jobs]
+    else:
+        executor = ThreadPoolExecutor if pool == 'thread' else ProcessPoolExecutor
+        with executor(max_workers=workers) as ex:
+            futures = [ex.submit(_load, load_fn, job) for job in jobs]
+            results = [f.result() for f in futures]
+    data = []
+    failed = []
+    for job, (item, error) in zip(jobs, results):
+        if error is not None:
+            print(f"# Skipping participant {job[0]}: {error}")
+            failed.append(job[0])
+        else:
+            data.append(item)
+    if failed:
+        print(f"# Skipped {len(failed)} of {len(jobs)} participants: {failed}")
+    if jobs and not data:
+        raise RuntimeError("no participant could be loaded")
+    return data
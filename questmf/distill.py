@@ -0,0 +1,206 @@
+import argparse
+import hashlib
+import json
+import os
+import numpy as np
+import torch
+import torch.nn.functional as F
+from torch.utils.data import Dataset, DataLoader
+
+from questmf.config import scale_lr
+from questmf.heads import HEADS
+from questmf.labels import class_weights
+from questmf.multitask import (ITEMS, MODALITY_CKPT, build_multitask, load_ensemble, eval_script, splits, checkpoint_name,
+                               forward_items, item_loss, predict, scores, n_params, train)
+from questmf.scripts import COMBOS, load_script, bind
+
+# Distil the eight per-question models of the evaluation scripts (the teacher) into one multitask
+# student (see questmf.multitask) that predicts all eight items. The teacher runs once: its logits
+# for every session are cached on disk, keyed on its checkpoints, and later runs only compute the
+# sessions that are missing. The student can use fewer modalities than the teacher, e.g. an audio
+# student of the TAV ensemble:
+#
+#   python -m questmf.distill -teacher TAV -student A -s 1 -b 1 -a 1 -d_path ... -l_path ... \
+#       -t_ckpt ckpt/t -a_ckpt ckpt/a -v_ckpt ckpt/v -tav_ckpt ckpt/tav -train
+#
+# The student checkpoints are <student_ckpt>-student-seed-<seed>.pt and ...-ccc.pt.
+
+CKPT_ARGS = {'T': 'text_checkpoint_path', 'A': 'audio_checkpoint_path', 'V': 'video_checkpoint_path', 'TA': 'ta_checkpoint_path',
+             'TV': 'tv_checkpoint_path', 'AV': 'av_checkpoint_path', 'TAV': 'tav_checkpoint_path'}
+
+def cmdline_args():
+    # Make parser object
+    p = argparse.ArgumentParser()
+    p.add_argument("-teacher", "--teacher", type=str, default='TAV', choices=list(COMBOS), help="Modality combination of the teacher ensemble")
+    p.add_argument("-student", "--student", type=str, default='TAV', choices=list(COMBOS), help="Modality combination of the student")
+    p.add_argument("-s", "--seed", type=int, default=1, help="Set a random seed")
+    p.add_argument("-b", "--beta", type=float, default=1.0, help="The beta value used in weights for ImbOLL")
+    p.add_argument("-a", "--alpha", type=float, default=1.0, help="The alpha value used in distance for ImbOLL")
+    p.add_argument("-d_path", "--data_path", type=str, help="Path to data files (text transcripts, audio files, video features)")
+    p.add_argument("-l_path", "--label_path", type=str, help="Path to labels, i.e., PHQ-8 scores")
+    p.add_argument("-t_ckpt", "--text_checkpoint_path", type=str, help="Path to checkpoint for the text model")
+    p.add_argument("-a_ckpt", "--audio_checkpoint_path", type=str, help="Path to checkpoint for the audio model")
+    p.add_argument("-v_ckpt", "--video_checkpoint_path", type=str, help="Path to checkpoint for the video model")
+    p.add_argument("-ta_ckpt", "--ta_checkpoint_path", type=str, help="Path to checkpoint for the text+audio model")
+    p.add_argument("-tv_ckpt", "--tv_checkpoint_path", type=str, help="Path to checkpoint for the text+video model")
+    p.add_argument("-av_ckpt", "--av_checkpoint_path", type=str, help="Path to checkpoint for the audio+video model")
+    p.add_argument("-tav_ckpt", "--tav_checkpoint_path", type=str, help="Path to checkpoint for the text+audio+video model")
+    p.add_argument("-student_ckpt", "--student_checkpoint_path", type=str, help="Checkpoint prefix of the student (default: that of the student combination)")
+    p.add_argument("-m_files", "--missing_video_files", nargs='+', type=int, default=[], help="List of file numbers for incomplete video files")
+    p.add_argument("-train", "--train_model", action='store_true', help="Train the student")
+    p.add_argument("-T", "--temperature", type=float, default=2.0, help="Softmax temperature of the distillation loss")
+    p.add_argument("-kd_weight", "--kd_weight", type=float, default=0.5, help="Weight of the distillation loss, the item ImbOLL loss gets the rest")
+    p.add_argument("-bs", "--batch_size", type=int, default=10, help="Batch size")
+    p.add_argument("-epochs", "--epochs", type=int, default=20, help="Number of training epochs")
+    p.add_argument("-lr", "--lr", type=float, default=5e-4, help="Learning rate at batch size 10")
+    p.add_argument("-lr_scale", "--lr_scale", type=str, default='none', choices=['none','linear','sqrt'], help="Scale -lr with the batch size relative to 10")
+    p.add_argument("-fused_attn", "--fused_attn", action='store_true', help="Fused attention blocks (fusion models)")
+    p.add_argument("-head", "--head", type=str, default='flatten', choices=HEADS, help="Classification head of the teacher models")
+    p.add_argument("-student_head", "--student_head", type=str, default='flatten', choices=HEADS, help="Classification head of the student")
+    p.add_argument("-bf16", "--bf16", action='store_true', help="Run the forward passes under bf16 autocast")
+    p.add_argument("-workers", "--workers", type=int, default=8, help="Number of workers for reading the participant files")
+    p.add_argument("-cache_dir", "--cache_dir", type=str, default='cache', help="Directory for the feature, sentence embedding and teacher logit caches")
+    p.add_argument("-embedder", "--embedder", type=str, default='sentence-transformers/all-distilroberta-v1', help="Sentence embedder for the text modality")
+    p.add_argument("-metrics", "--metrics_path", type=str, help="JSONL file for per-stage timing metrics")
+    p.add_argument("-o", "--output", type=str, help="JSON file for the student vs teacher report")
+    return p.parse_args()
+
+def sessions(data):
+    # The session records under any number of dataset wrappers
+    while not isinstance(data, list):
+        data = data.data
+    return data
+
+def teacher_files(combo, ckpts, encoder_ckpts, seed):
+    """The checkpoint files load_ensemble reads for a teacher."""
+    files = []
+    for q in range(1, len(ITEMS) + 1):
+        if len(COMBOS[combo][2]) > 1:
+            files += [encoder_ckpts[m] + '-phq' + str(q) + '-seed-' + str(seed) + '.pt' for m in COMBOS[combo][2]]
+        files.append(ckpts + '-phq' + str(q) + '-seed-' + str(seed) + '-ccc.pt')
+    return files
+
+def teacher_cache_path(cache_dir, combo, files):
+    # A new or retrained checkpoint gives a new cache file
+    key = hashlib.sha1(json.dumps([[os.path.abspath(f), os.path.getmtime(f)] for f in files]).encode()).hexdigest()[:16]
+    return os.path.join(cache_dir, 'teacher-' + combo.lower() + '-' + key + '.pt')
+
+def teacher_logits(ensemble, datasets, n_inputs, device, path, batch_size=10):
+    """Logits (items x 4) of the teacher for every session of datasets, by participant ID.
+
+    Read from path, only the sessions not cached yet are run through the teacher.
+    """
+    cached = torch.load(path) if os.path.exists(path) else {}
+    for data in datasets:
+        todo = [i for i, s in enumerate(sessions(data)) if s.p_id not in cached]
+        if not todo:
+            continue
+        for model in ensemble:
+            model.eval()
+        loader = DataLoader(torch.utils.data.Subset(data, todo), batch_size=batch_size)
+        logits = []
+        with torch.no_grad():
+            for batch in loader:
+                logits.append(forward_items(ensemble, [t.to(device) for t in batch[:n_inputs]]).float().cpu())
+        for i, l in zip(todo, torch.cat(logits)):
+            cached[sessions(data)[i].p_id] = l
+        print(f"# Teacher logits of {len(todo)} sessions written to {path}")
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        torch.save(cached, path)
+    return cached
+
+class with_teacher(Dataset):
+    """Samples of a dataset with the teacher's logits of the session appended."""
+    def __init__(self, data, logits):
+        super(with_teacher, self).__init__()
+        self.data = data
+        self.logits = torch.stack([logits[s.p_id] for s in sessions(data)])
+
+    def __getitem__(self, index):
+        return self.data[index] + [self.logits[index]]
+
+    def __len__(self):
+        return len(self.data)
+
+def kd_loss(student_logits, teacher_logits, temperature):
+    """KL divergence from the softened teacher to the student item distributions, scaled by T^2."""
+    s = F.log_softmax(student_logits.flatten(0, 1) / temperature, dim=1)
+    t = F.log_softmax(teacher_logits.flatten(0, 1) / temperature, dim=1)
+    return F.kl_div(s, t, log_target=True, reduction='batchmean') * temperature ** 2
+
+def agreement(preds, teacher_preds):
+    """Share of item predictions equal to the teacher's, in percent."""
+    return float((preds == teacher_preds).float().mean() * 100)
+
+def latency(models, data, n_inputs, device, batch_size, n_batches=4, bf16=False):
+    """Median forward time in ms of the first n_batches batches of data, the first one untimed."""
+    subset = torch.utils.data.Subset(data, range(min(len(data), batch_size * n_batches)))
+    times = predict(models, DataLoader(subset, batch_size=batch_size), n_inputs, device, bf16)[3]
+    return float(np.median(times[1:] or times))
+
+def report(module, student, ensemble, student_data, teacher_data, logits, n_inputs, device, batch_size, bf16=False):
+    """Student against teacher on the validation and test splits.
+
+    The teacher's scores come from its cached logits, it only runs to time a few batches.
+    """
+    rows = {'teacher': {'params': n_params(ensemble), 'ms_per_batch': latency(ensemble, teacher_data[2], n_inputs[0], device, batch_size, bf16=bf16)},
+            'student': {'params': n_params([student]), 'ms_per_batch': latency([student], student_data[2], n_inputs[1], device, batch_size, bf16=bf16)}}
+    for split, data in (('val', student_data[1]), ('test', student_data[2])):
+        totals = torch.tensor([s.label for s in sessions(data)])
+        items = getattr(data, 'items', None)
+        teacher_preds = torch.stack([logits[s.p_id] for s in sessions(data)]).argmax(dim=2)
+        preds = predict([student], DataLoader(data, batch_size=batch_size), n_inputs[1], device, bf16)[0]
+        for name, p in (('teacher', teacher_preds), ('student', preds)):
+            rows[name].update({split + '_' + k: v for k, v in scores(p, totals, items).items()})
+            rows[name][split + '_agreement'] = agreement(p, teacher_preds)
+    print(f"{'Model':^8} | {'Params':^11} | {'ms/batch':^9} | {'Val item acc':^12} | {'Val agree':^9} | {'Test agree':^10} | {'Val CCC':^8} | {'Test CCC':^8} | {'Test MAE':^8}")
+    print("-"*104)
+    for name, r in rows.items():
+        print(f"{name:^8} | {r['params']:^11,} | {r['ms_per_batch']:^9.2f} | {r['val_item_accuracy']:^12.2f} | {r['val_agreement']:^9.2f} | {r['test_agreement']:^10.2f} | {r['val_ccc']:^8.4f} | {r['test_ccc']:^8.4f} | {r['test_mae']:^8.4f}")
+    return rows
+
+if __name__ == '__main__':
+
+    args = cmdline_args()
+    torch.manual_seed(args.seed)
+    np.random.seed(args.seed)
+    os.environ["TOKENIZERS_PARALLELISM"] = "false"
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    print(f"# Using device: {device}")
+
+    modality_ckpts = {m: getattr(args, a) for m, a in MODALITY_CKPT.items()}
+    student_prefix = args.student_checkpoint_path or getattr(args, CKPT_ARGS[args.student])
+    teacher_module = bind(load_script(args.teacher, 'train'), device)
+    student_module = teacher_module if args.student == args.teacher else bind(load_script(args.student, 'train'), device)
+    kwargs = lambda combo, head: dict({'fused_attn': args.fused_attn} if len(COMBOS[combo][2]) > 1 else {}, head=head)
+    n_teacher, n_student = 2 * len(COMBOS[args.teacher][2]), 2 * len(COMBOS[args.student][2])
+
+    # Every combination reads its inputs through its own evaluation script
+    teacher_data = splits(eval_script(args.teacher, device, args.embedder), args)
+    student_data = teacher_data if args.student == args.teacher else splits(eval_script(args.student, device, args.embedder), args)
+
+    # Teacher logits of all splits, computed once
+    teacher_ckpt = getattr(args, CKPT_ARGS[args.teacher])
+    path = teacher_cache_path(args.cache_dir, args.teacher, teacher_files(args.teacher, teacher_ckpt, modality_ckpts, args.seed))
+    ensemble = load_ensemble(teacher_module, args.teacher, teacher_ckpt, modality_ckpts, args.seed, device, **kwargs(args.teacher, args.head))
+    logits = teacher_logits(ensemble, teacher_data, n_teacher, device, path, args.batch_size)
+
+    data_train, data_val, _ = student_data
+    if args.train_model:
+        val_dataloader = DataLoader(data_val, batch_size=args.batch_size)
+        student = build_multitask(student_module, args.student, modality_ckpts, args.seed, **kwargs(args.student, args.student_head)).to(device)
+        weights = list(class_weights(args.label_path, args.beta, args.cache_dir))
+        # Soft targets of the teacher plus the item labels
+        loss_fn = lambda out, batch: ((1 - args.kd_weight) * item_loss(student_module, out, weights, batch[n_student + 1], args.alpha)
+                                      + args.kd_weight * kd_loss(out, batch[n_student + 2], args.temperature))
+        train_dataloader = DataLoader(with_teacher(data_train, logits), batch_size=args.batch_size, shuffle=True)
+        train(student, student_module, train_dataloader, val_dataloader, n_student, weights, args.alpha, student_prefix, args.seed,
+              args.epochs, scale_lr(args.lr, args.batch_size, args.lr_scale), device, args.bf16, args.metrics_path, loss_fn=loss_fn, tag='student')
+
+    student = build_multitask(student_module, args.student, modality_ckpts, args.seed, **kwargs(args.student, args.student_head))
+    student.load_state_dict(torch.load(checkpoint_name(student_prefix, args.seed, ccc=True, tag='student'), map_location='cpu'))
+    student.to(device)
+    rows = report(student_module, student, ensemble, student_data, teacher_data, logits, (n_teacher, n_student), device, args.batch_size, args.bf16)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(dict(rows, teacher=args.teacher, student=args.student, seed=args.seed, temperature=args.temperature, kd_weight=args.kd_weight), f, indent=1)
@@ -0,0 +1,101 @@
+import os
+import sys
+from contextlib import contextmanager
+import torch
+import torch.distributed as dist
+from torch.nn.parallel import DistributedDataParallel
+from torch.utils.data import DataLoader, IterableDataset
+from torch.utils.data.distributed import DistributedSampler
+
+# Data parallel training with one process per rank, launched with torchrun:
+#
+#   torchrun --standalone --nproc_per_node 8 Text+Audio+Video/TAV-questMF.py -ddp ...
+#
+# Every rank trains on its shard of the training set and the gradients are averaged with an
+# all-reduce. Rank 0 runs the validation, writes the checkpoints and the metrics.
+
+def init_distributed(enabled):
+    """Join the process group set up by torchrun (gloo on CPU, nccl on GPU) and return (rank, world_size).
+
+    Without torchrun a single rank group is created, so -ddp also runs as a plain script.
+    """
+    if not enabled:
+        return 0, 1
+    os.environ.setdefault('MASTER_ADDR', '127.0.0.1')
+    os.environ.setdefault('MASTER_PORT', '29500')
+    os.environ.setdefault('RANK', '0')
+    os.environ.setdefault('WORLD_SIZE', '1')
+    if torch.cuda.is_available():
+        torch.cuda.set_device(int(os.environ.get('LOCAL_RANK', 0)))
+    backend = 'nccl' if torch.cuda.is_available() else 'gloo'
+    dist.init_process_group(backend)
+    rank = dist.get_rank()
+    if rank != 0:
+        # Only rank 0 logs, errors still go to stderr
+        sys.stdout = open(os.devnull, 'w')
+    print(f"# Data parallel training on {dist.get_world_size()} ranks ({backend})")
+    return rank, dist.get_world_size()
+
+def is_main():
+    return not dist.is_initialized() or dist.get_rank() == 0
+
+def barrier():
+    if dist.is_initialized():
+        dist.barrier()
+
+@contextmanager
+def main_first():
+    """Run the body on rank 0 first, e.g. so that only rank 0 fills the feature caches."""
+    if not is_main():
+        barrier()
+    yield
+    if is_main():
+        barrier()
+
+def wrap_model(model, find_unused_parameters=False):
+    """DistributedDataParallel around model when running distributed.
+
+    The fusion models need find_unused_parameters, since the heads of their encoders take no part in the loss.
+    """
+    if not dist.is_initialized():
+        return model
+    device_ids = [torch.cuda.current_device()] if torch.cuda.is_available() else None
+    return DistributedDataParallel(model, device_ids=device_ids, find_unused_parameters=find_unused_parameters)
+
+def unwrap(model):
+    return model.module if isinstance(model, DistributedDataParallel) else model
+
+def train_loader(data, batch_size, seed, num_workers=0):
+    """Shuffled training DataLoader. When distributed, every rank gets its shard of the data and a
+    batch_size // world_size slice of each global batch, so the averaged gradients match a single process.
+
+    Streamed datasets (questmf.shards) shuffle and split themselves across ranks and workers.
+    """
+    world_size = dist.get_world_size() if dist.is_initialized() else 1
+    if isinstance(data, IterableDataset):
+        if hasattr(data, 'set_batching'):
+            data.set_batching(max(1, batch_size // world_size), num_workers)
+        return DataLoader(data, batch_size=max(1, batch_size // world_size), num_workers=num_workers)
+    if not dist.is_initialized():
+        return DataLoader(data, batch_size=batch_size, shuffle=True, num_workers=num_workers)
+    if batch_size % world_size:
+        print(f"# Batch size {batch_size} is not a multiple of {world_size} ranks, the global batch size is {max(1, batch_size // world_size) * world_size}")
+    sampler = DistributedSampler(data, shuffle=True, seed=seed)
+    return DataLoader(data, batch_size=max(1, batch_size // world_size), sampler=sampler, num_workers=num_workers)
+
+def set_epoch(dataloader, epoch):
+    # DistributedSampler and the streamed datasets reshuffle only when told the epoch
+    if isinstance(dataloader.sampler, DistributedSampler):
+        dataloader.sampler.set_epoch(epoch)
+    elif hasattr(dataloader.dataset, 'set_epoch'):
+        dataloader.dataset.set_epoch(epoch)
+
+def n_samples(dataloader):
+    """Samples of this rank in an epoch of a training DataLoader."""
+    if isinstance(dataloader.dataset, IterableDataset):
+        return len(dataloader.dataset)
+    return len(dataloader.sampler)
+
+def cleanup():
+    if dist.is_initialized():
+        dist.destroy_process_group()
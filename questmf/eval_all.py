@@ -0,0 +1,121 @@
+import argparse
+import json
+import os
+import time
+import torch
+
+from questmf.heads import HEADS
+from questmf.logits_store import save_logits
+from questmf.multi_seed import materialize, evaluate_seeds, seed_report
+from questmf.multitask import ITEMS, MODALITY_CKPT, eval_script
+from questmf.scripts import COMBOS
+
+# Evaluation of any set of modality combinations against one load of the features. The sessions
+# of the split are read, the transcripts embedded and the eGeMAPS and ResNet features parsed once,
+# by the evaluation script of the smallest combination that has every modality needed. Each
+# combination then runs its eight per-question models on its own modalities of these batches:
+#
+#   python -m questmf.eval_all -d_path ... -l_path ... -t_ckpt ckpt/t -a_ckpt ckpt/a -v_ckpt ckpt/v -ta_ckpt ckpt/ta -tv_ckpt ckpt/tv -av_ckpt ckpt/av -tav_ckpt ckpt/tav
+#   python -m questmf.eval_all -combos A V AV -seeds 1 2 3 4 5 -d_path ... -l_path ... -a_ckpt ckpt/a -v_ckpt ckpt/v -av_ckpt ckpt/av
+#
+# Prints a table of the CCC, RMSE and MAE of every combination, as the evaluation scripts compute
+# them, with the mean and standard deviation over the seeds and the seed ensemble when there are several.
+
+def cmdline_args():
+    # Make parser object
+    p = argparse.ArgumentParser()
+    p.add_argument("-combos", "--combos", nargs='+', choices=list(COMBOS), help="Combinations to evaluate (default: all whose checkpoints are given)")
+    p.add_argument("-seeds", "--seeds", nargs='+', type=int, default=[1], help="Seeds of the checkpoints to evaluate")
+    p.add_argument("-d_path", "--data_path", type=str, help="Path to data files (text transcripts, audio files, video features)")
+    p.add_argument("-l_path", "--label_path", type=str, help="Path to labels, i.e., PHQ-8 scores")
+    p.add_argument("-t_ckpt", "--text_checkpoint_path", type=str, help="Checkpoint prefix of the text model")
+    p.add_argument("-a_ckpt", "--audio_checkpoint_path", type=str, help="Checkpoint prefix of the audio model")
+    p.add_argument("-v_ckpt", "--video_checkpoint_path", type=str, help="Checkpoint prefix of the video model")
+    p.add_argument("-ta_ckpt", "--ta_checkpoint_path", type=str, help="Checkpoint prefix of the text+audio model")
+    p.add_argument("-tv_ckpt", "--tv_checkpoint_path", type=str, help="Checkpoint prefix of the text+video model")
+    p.add_argument("-av_ckpt", "--av_checkpoint_path", type=str, help="Checkpoint prefix of the audio+video model")
+    p.add_argument("-tav_ckpt", "--tav_checkpoint_path", type=str, help="Checkpoint prefix of the text+audio+video model")
+    p.add_argument("-m_files", "--missing_video_files", nargs='+', type=int, default=[], help="List of file numbers for incomplete video files")
+    p.add_argument("-split", "--split", type=str, default='test', choices=['train','val','test'], help="Split to evaluate")
+    p.add_argument("-procs", "--procs", type=int, default=1, help="Worker processes for the seeds of a combination, see questmf.multi_seed")
+    p.add_argument("-threads", "--threads", type=int, help="Threads per worker (default: the cores divided among the workers)")
+    p.add_argument("-bs", "--batch_size", type=int, default=10, help="Batch size")
+    p.add_argument("-head", "--head", type=str, default='flatten', choices=HEADS, help="Classification head of the models")
+    p.add_argument("-fused_attn", "--fused_attn", action='store_true', help="Fused attention blocks (fusion models)")
+    p.add_argument("-bf16", "--bf16", action='store_true', help="Run the forward passes under bf16 autocast")
+    p.add_argument("-workers", "--workers", type=int, default=8, help="Number of workers for reading the participant files")
+    p.add_argument("-cache_dir", "--cache_dir", type=str, default='cache', help="Directory for the feature and sentence embedding caches")
+    p.add_argument("-embedder", "--embedder", type=str, default='sentence-transformers/all-distilroberta-v1', help="Sentence embedder for the text modality")
+    p.add_argument("-logits_store", "--logits_store", type=str, help="SQLite file to store the logits of every combination and seed in, see questmf.logits_store")
+    p.add_argument("-o", "--output", type=str, help="JSON file for the scores")
+    return p.parse_args()
+
+def checkpoint_prefix(args, combo):
+    """Prefix of the per-question checkpoints of a combination, None when not given."""
+    mods = COMBOS[combo][2]
+    return getattr(args, MODALITY_CKPT[mods[0]] if len(mods) == 1 else combo.lower() + '_checkpoint_path')
+
+def source_combo(combos):
+    """Smallest combination with every modality of combos, whose script loads the features."""
+    needed = {m for c in combos for m in COMBOS[c][2]}
+    return min((c for c in COMBOS if needed <= set(COMBOS[c][2])), key=lambda c: len(COMBOS[c][2]))
+
+def select_inputs(batches, source_mods, mods):
+    """The batches with the (embedding, mask) pairs of mods, in their order, and the label."""
+    index = [source_mods.index(m) for m in mods]
+    n = 2 * len(source_mods)
+    return [[t for i in index for t in batch[2 * i:2 * i + 2]] + batch[n:] for batch in batches]
+
+if __name__ == '__main__':
+
+    args = cmdline_args()
+    os.environ["TOKENIZERS_PARALLELISM"] = "false"
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    combos = args.combos or [c for c in COMBOS if checkpoint_prefix(args, c)]
+    if not combos:
+        raise SystemExit("No checkpoints given, pass -t_ckpt, -a_ckpt, -v_ckpt, -ta_ckpt, -tv_ckpt, -av_ckpt or -tav_ckpt")
+    for combo in combos:
+        missing = [m for m in COMBOS[combo][2] if not getattr(args, MODALITY_CKPT[m])] + ([] if checkpoint_prefix(args, combo) else [combo])
+        if missing:
+            raise SystemExit(f"{combo} needs the checkpoint prefix of {', '.join(missing)}")
+    source = source_combo(combos)
+    print(f"# {' '.join(combos)} on {device}, seeds {' '.join(map(str, args.seeds))}, features loaded by the {source} script")
+
+    start = time.perf_counter()
+    module = eval_script(source, device, args.embedder)
+    data = module.dds(args.split, args.data_path, args.label_path, args.missing_video_files, args.workers, cache_dir=args.cache_dir)
+    batches = materialize(data, args.batch_size)
+    totals = torch.cat([b[2 * len(COMBOS[source][2])] for b in batches]).double()
+    loaded = time.perf_counter()
+    print(f"# {len(data)} {args.split} sessions loaded in {loaded - start:.1f} s")
+
+    results, seconds = {}, {}
+    for combo in combos:
+        t0 = time.perf_counter()
+        mods = COMBOS[combo][2]
+        ckpt = checkpoint_prefix(args, combo)
+        encoder_ckpts = {m: getattr(args, MODALITY_CKPT[m]) for m in mods}
+        kwargs = dict({'fused_attn': args.fused_attn} if len(mods) > 1 else {}, head=args.head)
+        logits, _ = evaluate_seeds(combo, ckpt, encoder_ckpts, args.seeds, select_inputs(batches, COMBOS[source][2], mods),
+                                   device, args.procs, args.threads, args.bf16, **kwargs)
+        results[combo] = seed_report(logits, totals)
+        seconds[combo] = time.perf_counter() - t0
+        if args.logits_store:
+            for seed, l in logits.items():
+                files = [ckpt + '-phq' + str(q) + '-seed-' + str(seed) + '-ccc.pt' for q in range(1, len(ITEMS) + 1)]
+                save_logits(args.logits_store, combo, args.split, seed, data, l, files, head=args.head, bf16=args.bf16)
+
+    several = len(args.seeds) > 1
+    width = 13 if several else 7
+    print(f"{'Combo':<5} | {'CCC':>{width}} | {'RMSE':>{width}} | {'MAE':>{width}}" + (f" | {'Ens CCC':>7} | {'Ens RMSE':>8} | {'Ens MAE':>7}" if several else "") + f" | {'Time s':>6}")
+    print("-"*(31 + 3 * width + (31 if several else 0)))
+    for combo, r in results.items():
+        cells = [f"{r['mean'][k]:.3f}±{r['std'][k]:.3f}" if several else f"{r['mean'][k]:.3f}" for k in ('ccc', 'rmse', 'mae')]
+        ens = f" | {r['ensemble']['ccc']:>7.3f} | {r['ensemble']['rmse']:>8.3f} | {r['ensemble']['mae']:>7.3f}" if several else ""
+        print(f"{combo:<5} | " + " | ".join(f"{c:>{width}}" for c in cells) + ens + f" | {seconds[combo]:>6.1f}")
+    print(f"# Features in {loaded - start:.1f} s, models in {sum(seconds.values()):.1f} s")
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'split': args.split, 'seeds': args.seeds, 'source': source, 'scores': results,
+                       'seconds': dict(seconds, features=loaded - start)}, f, indent=1)
+        print(f"# Scores written to {args.output}")
@@ -0,0 +1,58 @@
+import os
+import numpy as np
+import pandas as pd
+import scipy.io as sio
+
+# One-time conversion of the OpenSMILE eGeMAPS CSVs and ResNet .mat files to float32 .npy files.
+# The .npy files are memory mapped, so epochs never go through the CSV parser.
+
+def egemaps_cache(csv_file, cache_dir):
+    """Return the path of the float32 .npy copy of an eGeMAPS CSV, converting it if needed.
+
+    The copy is rebuilt when the CSV is newer than it. The name and frameTime columns are dropped.
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    npy_file = os.path.join(cache_dir, os.path.basename(csv_file)[:-len('.csv')] + '.npy')
+    if os.path.exists(npy_file) and os.path.getmtime(npy_file) >= os.path.getmtime(csv_file):
+        return npy_file
+    df_speech = pd.read_csv(csv_file, sep=";")
+    feat = np.ascontiguousarray(df_speech.iloc[:,2:].to_numpy(dtype=np.float32))
+    # Write then rename, so that concurrent readers never see a partial file
+    tmp_file = f"{npy_file}.{os.getpid()}.tmp.npy"
+    np.save(tmp_file, feat)
+    os.replace(tmp_file, npy_file)
+    return npy_file
+
+def resnet_cache(mat_file, cache_dir):
+    """Return the path of the float32 .npy copy of a ResNet feature .mat file, converting it if needed.
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    npy_file = os.path.join(cache_dir, os.path.basename(mat_file)[:-len('.mat')] + '.npy')
+    if os.path.exists(npy_file) and os.path.getmtime(npy_file) >= os.path.getmtime(mat_file):
+        return npy_file
+    feat = np.ascontiguousarray(sio.loadmat(mat_file)['feature'], dtype=np.float32)
+    tmp_file = f"{npy_file}.{os.getpid()}.tmp.npy"
+    np.save(tmp_file, feat)
+    os.replace(tmp_file, npy_file)
+    return npy_file
+
+def open_features(npy_file):
+    """Memory map a cached feature matrix (frames x features)."""
+    return np.load(npy_file, mmap_mode='r')
+
+def segment_means(feat, start_times, end_times):
+    """Mean of feat[start:end] for every segment, from a running sum over the frames.
+
+    Only the frames up to the last segment end are read. Empty segments give NaN, as the mean of an
+    empty slice does.
+    """
+    n = len(feat)
+    start_times = np.clip(np.asarray(start_times, dtype=np.int64), 0, n)
+    end_times = np.clip(np.asarray(end_times, dtype=np.int64), 0, n)
+    end_times = np.maximum(end_times, start_times)
+    last = int(end_times.max()) if len(end_times) else 0
+    csum = np.zeros((last + 1, feat.shape[1]), dtype=np.float64)
+    np.cumsum(feat[:last], axis=0, dtype=np.float64, out=csum[1:])
+    counts = (end_times - start_times)[:, None]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return ((csum[end_times] - csum[start_times]) / counts).astype(np.float32)
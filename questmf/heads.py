@@ -0,0 +1,76 @@
+import torch
+import torch.nn as nn
+
+# Classification heads of the QuestMF models. 'flatten' is the original head, an MLP over the
+# flattened (120 x dim) turn features: Linear(12000,256) for the encoders and Linear(24000,256) or
+# Linear(72000,256) for the fusion models. The pooling heads pool the turns first, ignoring the
+# padded ones, and run the same MLP on the pooled vector, so they work for any number of turns:
+#   'meanmax'  masked mean and masked max over the turns, concatenated
+#   'attn'     masked attention pooling with a learned scoring vector
+# The fusion models concatenate one stream per modality along the features. Every stream is
+# pooled on its own, with the padding mask of the modality whose turns it runs over.
+
+HEADS = ['flatten', 'meanmax', 'attn']
+
+def _valid(key_padding_mask):
+    # (batch, turns, 1) weights of the real turns, a session without any counts all its turns
+    valid = ~key_padding_mask
+    valid = valid | ~valid.any(dim=1, keepdim=True)
+    return valid.unsqueeze(2)
+
+class pooled_head(nn.Module):
+    """Masked pooling over the turns of each stream followed by the MLP of the flatten head.
+
+    Indexing reaches the MLP, like the nn.Sequential it replaces, e.g. head[-1] is the output layer.
+    """
+    def __init__(self, kind, dim, n_streams, dropout1, hidden, dropout2, n_classes):
+        super(pooled_head, self).__init__()
+        self.kind = kind
+        self.n_streams = n_streams
+        if kind == 'attn':
+            self.score = nn.ModuleList([nn.Linear(dim, 1) for _ in range(n_streams)])
+        width = n_streams * dim * (2 if kind == 'meanmax' else 1)
+        self.mlp = nn.Sequential(nn.Dropout(dropout1),
+                                nn.Linear(width,hidden),
+                                nn.ReLU(),
+                                nn.Dropout(dropout2),
+                                nn.Linear(hidden,n_classes))
+
+    def forward(self, x, key_padding_masks):
+        if torch.is_tensor(key_padding_masks):
+            key_padding_masks = (key_padding_masks,)
+        pooled = []
+        for i, (c, mask) in enumerate(zip(x.chunk(self.n_streams, dim=2), key_padding_masks)):
+            valid = _valid(mask)
+            if self.kind == 'meanmax':
+                mean = (c * valid).sum(dim=1) / valid.sum(dim=1)
+                top = c.masked_fill(~valid, float('-inf')).amax(dim=1)
+                pooled += [mean, top]
+            else:
+                w = torch.softmax(self.score[i](c).masked_fill(~valid, float('-inf')), dim=1)
+                pooled.append((w * c).sum(dim=1))
+        return self.mlp(torch.cat(pooled, dim=1))
+
+    def __getitem__(self, i):
+        return self.mlp[i]
+
+    def __setitem__(self, i, module):
+        self.mlp[i] = module
+
+def make_head(kind, mlp, n_streams=1):
+    """The head of a model given its flatten head mlp (nn.Sequential as in the scripts).
+
+    'flatten' keeps mlp, so existing checkpoints load unchanged. The pooling heads take its
+    dropouts, hidden size and number of classes; the features per turn are split into n_streams.
+    """
+    assert kind in HEADS, kind
+    if kind == 'flatten':
+        return mlp
+    turns_x_dim, hidden, n_classes = mlp[2].in_features, mlp[2].out_features, mlp[5].out_features
+    return pooled_head(kind, turns_x_dim // 120 // n_streams, n_streams, mlp[1].p, hidden, mlp[4].p, n_classes)
+
+def apply_head(mlp, x, key_padding_masks):
+    """Run a head on (batch, turns, features), the flatten head ignores the masks."""
+    if isinstance(mlp, pooled_head):
+        return mlp(x, key_padding_masks)
+    return mlp(x)
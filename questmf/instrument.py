@@ -0,0 +1,95 @@
+import json
+import resource
+import time
+from contextlib import contextmanager
+import numpy as np
+import torch
+
+class stage_timer:
+    """Per-stage wall clock timing for the training and evaluation loops.
+
+    Stages are timed with time.perf_counter. On CUDA the device is synchronised at the
+    stage boundaries so that asynchronous kernels are charged to the stage that launched them.
+    Summaries are printed per epoch and appended to a JSONL file when metrics_path is set.
+    """
+    def __init__(self, device, metrics_path=None, phase='train'):
+        self.device = torch.device(device)
+        self.metrics_path = metrics_path
+        self.phase = phase
+        self.reset()
+
+    def reset(self):
+        self.times = {}
+        self.samples = 0
+        self.loop_s = None
+        if self.device.type == 'cuda':
+            torch.cuda.reset_peak_memory_stats(self.device)
+        self.t0 = time.perf_counter()
+
+    def end_loop(self):
+        # Throughput is measured over the batch loop only, not over evaluation and checkpointing
+        self.loop_s = time.perf_counter() - self.t0
+
+    def _sync(self):
+        if self.device.type == 'cuda':
+            torch.cuda.synchronize(self.device)
+
+    def record(self, name, seconds):
+        self.times.setdefault(name, []).append(seconds)
+
+    @contextmanager
+    def stage(self, name):
+        self._sync()
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self._sync()
+            self.record(name, time.perf_counter() - t0)
+
+    def loader(self, dataloader, name='data_wait'):
+        # Time spent waiting for the next batch from the DataLoader
+        it = iter(dataloader)
+        while True:
+            t0 = time.perf_counter()
+            try:
+                batch = next(it)
+            except StopIteration:
+                return
+            self.record(name, time.perf_counter() - t0)
+            yield batch
+
+    def add_samples(self, n):
+        self.samples += int(n)
+
+    def summary(self, epoch=None, **extra):
+        wall = time.perf_counter() - self.t0
+        loop = self.loop_s if self.loop_s is not None else wall
+        stages = {}
+        for name, times in self.times.items():
+            ms = np.asarray(times) * 1000
+            p50, p90, p99 = np.percentile(ms, [50, 90, 99])
+            stages[name] = {'count': len(ms), 'total_s': float(ms.sum() / 1000), 'share': float(ms.sum() / 1000 / wall) if wall > 0 else 0.0,
+                            'mean_ms': float(ms.mean()), 'p50_ms': float(p50), 'p90_ms': float(p90), 'p99_ms': float(p99), 'max_ms': float(ms.max())}
+        record = {'phase': self.phase, 'epoch': epoch, 'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'wall_s': wall,
+                  'loop_s': loop,
+                  'samples': self.samples, 'samples_per_sec': self.samples / loop if loop > 0 else 0.0, 'stages': stages,
+                  # ru_maxrss (KB on Linux) is the peak of the whole process so far, the CUDA peak is per epoch
+                  'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024}
+        if self.device.type == 'cuda':
+            record['cuda_peak_mb'] = torch.cuda.max_memory_allocated(self.device) / 2 ** 20
+        record.update(extra)
+        return record
+
+    def report(self, epoch=None, **extra):
+        """Print a one line breakdown, append it to the metrics file and reset the counters.
+        """
+        record = self.summary(epoch, **extra)
+        parts = [f"{name} {s['p50_ms']:.1f}/{s['p90_ms']:.1f}ms {100 * s['share']:.0f}%" for name, s in record['stages'].items()]
+        print(f"# {self.phase} stages (p50/p90, share): " + " | ".join(parts) + f" | {record['samples_per_sec']:.2f} samples/s"
+              + f" | peak {record.get('cuda_peak_mb', record['peak_rss_mb']):.0f} MB")
+        if self.metrics_path:
+            with open(self.metrics_path, 'a') as f:
+                f.write(json.dumps(record) + '\n')
+        self.reset()
+        return record
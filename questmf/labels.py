@@ -0,0 +1,97 @@
+import functools
+import hashlib
+import os
+import numpy as np
+import pandas as pd
+import torch
+
+# PHQ-8 item scores of every participant, read once from Detailed_PHQ8_Labels.csv and looked up
+# by participant id with a binary search, instead of filtering the DataFrame for every participant.
+# With a cache_dir, an int64 .npy copy is kept next to the feature caches, like those of
+# questmf.feature_cache:
+#
+#   labels = load_labels(label_path, cache_dir)
+#   labels.item(p_id, q_no)                   # score of one question
+#   labels.class_weights(train_ids, beta)     # (8, 4) ImbOLL weights of all questions
+
+ITEMS = ['PHQ_8NoInterest','PHQ_8Depressed','PHQ_8Sleep','PHQ_8Tired','PHQ_8Appetite','PHQ_8Failure','PHQ_8Concentrating','PHQ_8Moving']
+N_CLASSES = 4
+
+class label_table:
+    """Item scores (participants, 8) with the participant ids sorted."""
+
+    def __init__(self, p_ids, items):
+        order = np.argsort(p_ids, kind='stable')
+        self.p_ids = np.asarray(p_ids, dtype=np.int64)[order]
+        self.scores = np.asarray(items, dtype=np.int64)[order]
+
+    def rows(self, p_ids):
+        p_ids = np.asarray(p_ids, dtype=np.int64)
+        index = np.searchsorted(self.p_ids, p_ids).clip(max=max(0, len(self.p_ids) - 1))
+        found = self.p_ids[index] == p_ids if len(self.p_ids) else np.zeros(len(p_ids), dtype=bool)
+        if not found.all():
+            raise KeyError(f"no item scores for participants {p_ids[~found].tolist()}")
+        return index
+
+    def items(self, p_ids):
+        """(len(p_ids), 8) item scores."""
+        return self.scores[self.rows(p_ids)]
+
+    def item(self, p_id, q_no):
+        """Score of question q_no (1-8) of one participant."""
+        return int(self.scores[self.rows([p_id])[0], q_no - 1])
+
+    def class_counts(self, p_ids):
+        """(8, 4) number of participants with each score, for every question at once."""
+        scores = self.items(p_ids)
+        flat = (np.arange(len(ITEMS)) * N_CLASSES + scores).ravel()
+        return np.bincount(flat, minlength=len(ITEMS) * N_CLASSES).reshape(len(ITEMS), N_CLASSES)
+
+    def class_weights(self, p_ids, beta):
+        """(8, 4) ImbOLL weights (total / count) ** beta of every question.
+
+        A score no participant has gets weight 0. ImbOLL only uses the weight of the true class,
+        so it is never used in training.
+        """
+        counts = self.class_counts(p_ids)
+        empty = counts == 0
+        for q, c in zip(*np.nonzero(empty)):
+            print(f"# {ITEMS[q]}: no participant with score {c}, its class weight is 0")
+        # total / count in float32 as get_weights had it, the power in float64
+        w = (torch.tensor(counts.sum(axis=1, keepdims=True) / np.where(empty, 1, counts)).float().double() ** beta).float()
+        return w.masked_fill(torch.from_numpy(empty), 0.0)
+
+def _cache_file(csv_file, cache_dir):
+    # One copy per label file, the same file name can be in several label folders
+    tag = hashlib.sha1(os.path.abspath(csv_file).encode()).hexdigest()[:8]
+    return os.path.join(cache_dir, os.path.basename(csv_file)[:-len('.csv')] + '-' + tag + '.npy')
+
+@functools.lru_cache(maxsize=None)
+def _load(csv_file, mtime, cache_dir):
+    npy_file = _cache_file(csv_file, cache_dir) if cache_dir else None
+    if npy_file and os.path.exists(npy_file) and os.path.getmtime(npy_file) >= mtime:
+        table = np.load(npy_file)
+    else:
+        df_scores = pd.read_csv(csv_file)
+        table = np.ascontiguousarray(df_scores[['Participant_ID'] + ITEMS].to_numpy(dtype=np.int64))
+        if npy_file:
+            os.makedirs(cache_dir, exist_ok=True)
+            # Write then rename, so that concurrent readers never see a partial file
+            tmp_file = f"{npy_file}.{os.getpid()}.tmp.npy"
+            np.save(tmp_file, table)
+            os.replace(tmp_file, npy_file)
+    return label_table(table[:, 0], table[:, 1:])
+
+def load_labels(label_path, cache_dir=None):
+    """label_table of Detailed_PHQ8_Labels.csv, read once per process and file version."""
+    csv_file = label_path + 'Detailed_PHQ8_Labels.csv'
+    return _load(csv_file, os.path.getmtime(csv_file), cache_dir)
+
+def split_ids(label_path, split):
+    """Participant ids of the train, val (dev) or test split."""
+    name = {'train': 'train_split.csv', 'val': 'dev_split.csv', 'test': 'test_split.csv'}[split]
+    return pd.read_csv(label_path + name)['Participant_ID'].to_numpy(dtype=np.int64)
+
+def class_weights(label_path, beta, cache_dir=None):
+    """(8, 4) ImbOLL weights of every question from the train split."""
+    return load_labels(label_path, cache_dir).class_weights(split_ids(label_path, 'train'), beta)
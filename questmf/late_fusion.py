@@ -0,0 +1,133 @@
+import argparse
+import itertools
+import json
+import time
+import numpy as np
+import torch
+
+from questmf.labels import ITEMS, load_labels
+from questmf.logits_store import N_CLASSES, N_QUESTIONS, RULES, connect, list_runs, load_run, scores
+from questmf.scripts import COMBOS
+
+# Per-question modality selection and late fusion of the stored logits of several combinations
+# (see questmf.logits_store). For every PHQ-8 question, the combination, or the weighted mix of
+# the combinations' class probabilities, that fits the item scores of the dev split best is
+# chosen and then applied to the test split. No model runs, everything is NumPy on the stored
+# logits:
+#
+#   python -m questmf.late_fusion logits.db -l_path ... -mode best
+#   python -m questmf.late_fusion logits.db -l_path ... -mode mix -step 0.1 -o fusion.json
+#
+# The store needs a dev (val) and a test run of each combination, e.g. from the evaluation
+# scripts with -logits_store logits.db -store_splits val test. The latest run of each is used.
+
+def cmdline_args():
+    # Make parser object
+    p = argparse.ArgumentParser()
+    p.add_argument("store", type=str, help="Logits store written by the evaluation scripts with -logits_store")
+    p.add_argument("-l_path", "--label_path", type=str, required=True, help="Path to labels, with the item scores of the dev split")
+    p.add_argument("-combos", "--combos", nargs='+', choices=list(COMBOS), help="Combinations to select from (default: all in the store)")
+    p.add_argument("-s", "--seed", type=int, help="Only the runs of this seed")
+    p.add_argument("-mode", "--mode", type=str, default='best', choices=['best', 'mix'], help="One combination per question, or a weighted mix of them")
+    p.add_argument("-step", "--step", type=float, default=0.1, help="Grid step of the mixing weights")
+    p.add_argument("-objective", "--objective", type=str, default='nll', choices=['nll', 'mae', 'error'], help="Item-level loss on the dev split: negative log-likelihood of the item score, MAE of the expected score, or error rate")
+    p.add_argument("-rule", "--rule", type=str, default='argmax', choices=list(RULES), help="Rule that turns the fused probabilities into a total score")
+    p.add_argument("-dev_split", "--dev_split", type=str, default='val', help="Split to select on")
+    p.add_argument("-test_split", "--test_split", type=str, default='test', help="Split to apply the selection to")
+    p.add_argument("-o", "--output", type=str, help="JSON file for the selected weights and the scores")
+    return p.parse_args()
+
+def latest_runs(conn, split, seed=None, combos=None):
+    """Latest run of every combination for a split, combination -> run id, in COMBOS order."""
+    runs = {r['combo']: r['run_id'] for r in list_runs(conn, split) if seed is None or r['seed'] == seed}
+    return {c: runs[c] for c in COMBOS if c in runs and (combos is None or c in combos)}
+
+def softmax(x):
+    e = np.exp(x - x.max(axis=-1, keepdims=True))
+    return e / e.sum(axis=-1, keepdims=True)
+
+def stack(conn, run_ids):
+    """p_ids common to the runs, their (runs, sessions, 8, 4) probabilities and the total scores."""
+    runs = [load_run(conn, r) for r in run_ids]
+    common = np.asarray(sorted(set.intersection(*(set(p.tolist()) for p, _, _ in runs))), dtype=np.int64)
+    probs = np.stack([softmax(logits.double().numpy()[np.searchsorted(p_ids, common)]) for p_ids, logits, _ in runs])
+    _, _, totals = runs[0]
+    return common, probs, totals.double().numpy()[np.searchsorted(runs[0][0], common)]
+
+def item_labels(label_path, p_ids):
+    return load_labels(label_path).items(p_ids)
+
+def item_loss(probs, items, objective):
+    """Loss per question of (..., sessions, 8, 4) probabilities against the (sessions, 8) item scores."""
+    if objective == 'nll':
+        p = np.take_along_axis(probs, np.broadcast_to(items[..., None], probs.shape[:-1] + (1,)), axis=-1)[..., 0]
+        return -np.log(p + 1e-12).mean(axis=-2)
+    if objective == 'mae':
+        return np.abs((probs * np.arange(N_CLASSES)).sum(axis=-1) - items).mean(axis=-2)
+    return (probs.argmax(axis=-1) != items).mean(axis=-2)
+
+def simplex_grid(n, step):
+    """All weight vectors of n entries, multiples of step, that sum to 1."""
+    m = int(round(1 / step))
+    # Stars and bars: the positions of the n-1 bars among m+n-1 slots
+    bars = np.asarray(list(itertools.combinations(range(m + n - 1), n - 1)), dtype=np.int64).reshape(-1, n - 1)
+    edges = np.concatenate([np.full((len(bars), 1), -1), bars, np.full((len(bars), 1), m + n - 1)], axis=1)
+    return (np.diff(edges, axis=1) - 1) / m
+
+def select(probs, items, objective='nll', mode='best', step=0.1, chunk=1024):
+    """(8, combos) weights that minimise the item loss of every question, and that loss."""
+    n = probs.shape[0]
+    grid = np.eye(n) if mode == 'best' else simplex_grid(n, step)
+    losses = np.concatenate([item_loss(np.einsum('kc,cnqj->knqj', grid[i:i + chunk], probs), items, objective)
+                             for i in range(0, len(grid), chunk)])
+    best = losses.argmin(axis=0)
+    return grid[best], losses[best, np.arange(N_QUESTIONS)]
+
+def fuse(probs, weights):
+    """(sessions, 8, 4) probabilities mixed with per-question weights."""
+    return np.einsum('qc,cnqj->nqj', weights, probs)
+
+def total_scores(probs, totals, rule):
+    return scores(RULES[rule](torch.from_numpy(probs)).double(), torch.from_numpy(totals))
+
+if __name__ == '__main__':
+
+    args = cmdline_args()
+    conn = connect(args.store)
+    dev_runs = latest_runs(conn, args.dev_split, args.seed, args.combos)
+    test_runs = latest_runs(conn, args.test_split, args.seed, args.combos)
+    combos = [c for c in dev_runs if c in test_runs]
+    if not combos:
+        raise SystemExit(f"No combination has both a {args.dev_split} and a {args.test_split} run in {args.store}")
+
+    start = time.perf_counter()
+    dev_ids, dev_probs, dev_totals = stack(conn, [dev_runs[c] for c in combos])
+    test_ids, test_probs, test_totals = stack(conn, [test_runs[c] for c in combos])
+    items = item_labels(args.label_path, dev_ids)
+    loaded = time.perf_counter()
+    weights, losses = select(dev_probs, items, args.objective, args.mode, args.step)
+    single = item_loss(dev_probs, items, args.objective)
+    searched = time.perf_counter()
+    print(f"# {len(combos)} combinations ({' '.join(combos)}), {len(dev_ids)} {args.dev_split} and {len(test_ids)} {args.test_split} sessions, loaded in {(loaded - start) * 1000:.1f} ms, searched in {(searched - loaded) * 1000:.1f} ms")
+
+    print(f"{'Question':<20} | {'Selection':<40} | {'Dev ' + args.objective:>9} | {'Best single':>16}")
+    print("-"*95)
+    for q, item in enumerate(ITEMS):
+        selection = ', '.join(f"{c} {w:.2f}" for c, w in zip(combos, weights[q]) if w > 0)
+        best = single[:, q].argmin()
+        print(f"{item:<20} | {selection:<40} | {losses[q]:>9.3f} | {combos[best] + ' ' + format(single[best, q], '.3f'):>16}")
+
+    print(f"{'Model':<20} | {'Dev CCC':>8} | {'Dev RMSE':>8} | {'Dev MAE':>8} | {'Test CCC':>8} | {'Test RMSE':>9} | {'Test MAE':>8}")
+    print("-"*87)
+    rows = [(c, np.eye(len(combos))[[i] * N_QUESTIONS]) for i, c in enumerate(combos)] + [(f'per-question {args.mode}', weights)]
+    results = {}
+    for name, w in rows:
+        dev, test = total_scores(fuse(dev_probs, w), dev_totals, args.rule), total_scores(fuse(test_probs, w), test_totals, args.rule)
+        results[name] = {args.dev_split: dev, args.test_split: test}
+        print(f"{name:<20} | {dev['ccc']:>8.3f} | {dev['rmse']:>8.3f} | {dev['mae']:>8.3f} | {test['ccc']:>8.3f} | {test['rmse']:>9.3f} | {test['mae']:>8.3f}")
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'combos': combos, 'dev_runs': dev_runs, 'test_runs': test_runs, 'mode': args.mode, 'objective': args.objective, 'rule': args.rule,
+                       'weights': {item: dict(zip(combos, weights[q].tolist())) for q, item in enumerate(ITEMS)}, 'scores': results}, f, indent=1)
+        print(f"# Selection written to {args.output}")
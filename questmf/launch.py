@@ -0,0 +1,103 @@
+import argparse
+import json
+import os
+import shlex
+import subprocess
+import time
+
+from questmf.threads import parse_cores, format_cores
+
+# Run several QuestMF jobs side by side, each on its own slice of the cores.
+# The command is a template where {q} is replaced by the question number:
+#
+#   python -m questmf.launch -j 8 -pin -qno 1 2 3 4 5 6 7 8 -- \
+#       python Text+Audio+Video/TAV-questMF.py -qno {q} -s 1 ... -train
+#
+# Every job gets -cores, -threads and -metrics appended. When all jobs are done the
+# throughput of each one is read back from its metrics file.
+
+def cmdline_args():
+    # Make parser object
+    p = argparse.ArgumentParser()
+    p.add_argument("-j", "--jobs", type=int, default=8, help="Number of jobs running at the same time")
+    p.add_argument("-cores", "--cores", type=str, default=None, help="Cores to share out, e.g. 0-63 (default: all cores available)")
+    p.add_argument("-pin", "--pin", action='store_true', help="Pin every job to its cores")
+    p.add_argument("-qno", "--question_numbers", nargs='+', type=int, default=list(range(1, 9)), help="Question numbers to run the command for")
+    p.add_argument("-out", "--output_dir", type=str, default='runs', help="Directory for the logs and metrics of every job")
+    p.add_argument("cmd", nargs=argparse.REMAINDER, help="Command template, {q} is replaced by the question number")
+    return p.parse_args()
+
+def core_slots(cores, n_slots):
+    """Split cores into n_slots disjoint, contiguous and nearly equal slices."""
+    cores = sorted(cores)
+    n_slots = max(1, min(n_slots, len(cores)))
+    size, extra = divmod(len(cores), n_slots)
+    slots, i = [], 0
+    for k in range(n_slots):
+        n = size + (1 if k < extra else 0)
+        slots.append(cores[i:i + n])
+        i += n
+    return slots
+
+def throughput(metrics_file):
+    """Mean samples/sec and total loop time per phase from a stage_timer metrics file."""
+    phases = {}
+    if not os.path.exists(metrics_file):
+        return phases
+    with open(metrics_file) as f:
+        for line in f:
+            record = json.loads(line)
+            p = phases.setdefault(record['phase'], {'samples': 0, 'loop_s': 0.0})
+            p['samples'] += record['samples']
+            p['loop_s'] += record['loop_s']
+    for p in phases.values():
+        p['samples_per_sec'] = p['samples'] / p['loop_s'] if p['loop_s'] > 0 else 0.0
+    return phases
+
+def run(template, questions, slots, output_dir, pin):
+    """Run one job per question, at most one per core slot at a time, and return their records."""
+    os.makedirs(output_dir, exist_ok=True)
+    pending = list(questions)
+    free = list(range(len(slots)))
+    running = {}
+    done = []
+    while pending or running:
+        while pending and free:
+            q, slot = pending.pop(0), free.pop(0)
+            cores = format_cores(slots[slot])
+            metrics_file = os.path.join(output_dir, f"q{q}.jsonl")
+            if os.path.exists(metrics_file):
+                os.remove(metrics_file)
+            cmd = [a.replace('{q}', str(q)) for a in template] + ['-cores', cores, '-threads', str(len(slots[slot])), '-metrics', metrics_file] + (['-pin'] if pin else [])
+            env = dict(os.environ, OMP_NUM_THREADS=str(len(slots[slot])), MKL_NUM_THREADS=str(len(slots[slot])))
+            log = open(os.path.join(output_dir, f"q{q}.log"), 'w')
+            print(f"# q{q} on cores {cores}: {shlex.join(cmd)}")
+            proc = subprocess.Popen(cmd, stdout=log, stderr=subprocess.STDOUT, env=env)
+            running[proc] = {'q': q, 'slot': slot, 'cores': cores, 'metrics': metrics_file, 'log': log, 't0': time.perf_counter()}
+        time.sleep(0.5)
+        for proc in [p for p in running if p.poll() is not None]:
+            job = running.pop(proc)
+            job['log'].close()
+            free.append(job['slot'])
+            done.append({'q': job['q'], 'cores': job['cores'], 'returncode': proc.returncode,
+                         'wall_s': time.perf_counter() - job['t0'], 'phases': throughput(job['metrics'])})
+    return sorted(done, key=lambda r: r['q'])
+
+def report(results):
+    print(f"{'Job':^5} | {'Cores':^12} | {'Exit':^4} | {'Wall (s)':^9} | {'Train samples/s':^15} | {'Eval samples/s':^14}")
+    print("-"*75)
+    for r in results:
+        tr = r['phases'].get('train', {}).get('samples_per_sec')
+        ev = r['phases'].get('eval', {}).get('samples_per_sec')
+        print(f"{'q' + str(r['q']):^5} | {r['cores']:^12} | {r['returncode']:^4} | {r['wall_s']:^9.1f} | {tr if tr is None else round(tr, 2)!s:^15} | {ev if ev is None else round(ev, 2)!s:^14}")
+
+if __name__ == '__main__':
+
+    args = cmdline_args()
+    template = args.cmd[1:] if args.cmd[:1] == ['--'] else args.cmd
+    cores = parse_cores(args.cores) if args.cores else sorted(os.sched_getaffinity(0))
+    slots = core_slots(cores, args.jobs)
+    results = run(template, args.question_numbers, slots, args.output_dir, args.pin)
+    report(results)
+    with open(os.path.join(args.output_dir, 'launch.json'), 'w') as f:
+        json.dump(results, f, indent=1)
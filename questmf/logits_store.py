@@ -0,0 +1,172 @@
+import argparse
+import hashlib
+import json
+import os
+import sqlite3
+import time
+import numpy as np
+import torch
+
+from questmf.metrics import regression_metrics, summary, paired, format_interval
+
+# SQLite store of the per-question logits the evaluation scripts compute, one run per
+# evaluation of a split, with the checkpoints it used. Scores, aggregation rules and ensembles
+# across runs are then recomputed from the store without running the models again:
+#
+#   python Audio/A-questMF-eval.py ... -logits_store logits.db -store_splits val test
+#   python -m questmf.logits_store logits.db                          # list the runs and score them
+#   python -m questmf.logits_store logits.db -runs 1 4 -ensemble      # average of runs 1 and 4
+#   python -m questmf.logits_store logits.db -bootstrap 2000          # with 95% confidence intervals
+#   python -m questmf.logits_store logits.db -compare 1 4             # is run 4 better than run 1?
+#
+# Evaluating the same checkpoints (path, size and modification time) again replaces the run.
+
+N_CLASSES = 4
+N_QUESTIONS = 8
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    run_id INTEGER PRIMARY KEY,
+    combo TEXT NOT NULL,
+    split TEXT NOT NULL,
+    seed INTEGER,
+    checkpoints TEXT NOT NULL,
+    info TEXT NOT NULL,
+    fingerprint TEXT NOT NULL UNIQUE,
+    created REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS logits (
+    run_id INTEGER NOT NULL REFERENCES runs(run_id) ON DELETE CASCADE,
+    p_id INTEGER NOT NULL,
+    question INTEGER NOT NULL,
+    l0 REAL, l1 REAL, l2 REAL, l3 REAL,
+    PRIMARY KEY (run_id, p_id, question)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS logits_p_id ON logits (p_id);
+CREATE TABLE IF NOT EXISTS totals (
+    split TEXT NOT NULL,
+    p_id INTEGER NOT NULL,
+    total REAL NOT NULL,
+    PRIMARY KEY (split, p_id)
+);
+"""
+
+def cmdline_args():
+    # Make parser object
+    p = argparse.ArgumentParser()
+    p.add_argument("store", type=str, help="Logits store written by the evaluation scripts with -logits_store")
+    p.add_argument("-runs", "--runs", nargs='+', type=int, help="Runs to score (default: all)")
+    p.add_argument("-split", "--split", type=str, help="Only the runs of this split")
+    p.add_argument("-combo", "--combo", type=str, help="Only the runs of this modality combination")
+    p.add_argument("-rules", "--rules", nargs='+', default=['argmax', 'expected'], help="Rules that turn the logits into a total score")
+    p.add_argument("-ensemble", "--ensemble", action='store_true', help="Also score the average of the selected runs")
+    p.add_argument("-bootstrap", "--bootstrap", type=int, default=0, help="Bootstrap resamples for 95%% confidence intervals (e.g. 2000)")
+    p.add_argument("-compare", "--compare", nargs=2, type=int, metavar=('A', 'B'), help="Paired bootstrap comparison of two runs of the same split")
+    return p.parse_args()
+
+def connect(path):
+    conn = sqlite3.connect(path)
+    conn.execute('PRAGMA foreign_keys = ON')
+    conn.executescript(SCHEMA)
+    return conn
+
+def provenance(paths):
+    """Path, size and modification time of every checkpoint file."""
+    return [[os.path.abspath(p), os.path.getsize(p), os.path.getmtime(p)] for p in paths]
+
+def save_logits(path, combo, split, seed, data, logits, checkpoints, **info):
+    """Store the (sessions, 8, 4) logits of an evaluation of data, in the order of its sessions.
+
+    checkpoints are the files the models were loaded from, info e.g. the head and bf16.
+    Returns the run id.
+    """
+    sessions = data.data
+    logits = logits.float().cpu().numpy()
+    assert logits.shape == (len(sessions), N_QUESTIONS, N_CLASSES), logits.shape
+    checkpoints = provenance(checkpoints)
+    fingerprint = hashlib.sha1(json.dumps([combo, split, seed, checkpoints, info], sort_keys=True).encode()).hexdigest()
+    conn = connect(path)
+    with conn:
+        conn.execute('DELETE FROM runs WHERE fingerprint = ?', (fingerprint,))
+        run_id = conn.execute('INSERT INTO runs (combo, split, seed, checkpoints, info, fingerprint, created) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                              (combo, split, seed, json.dumps(checkpoints), json.dumps(info, sort_keys=True), fingerprint, time.time())).lastrowid
+        conn.executemany('INSERT INTO logits VALUES (?, ?, ?, ?, ?, ?, ?)',
+                         [(run_id, s.p_id, q + 1, *map(float, logits[i, q])) for i, s in enumerate(sessions) for q in range(N_QUESTIONS)])
+        conn.executemany('INSERT OR REPLACE INTO totals VALUES (?, ?, ?)', [(split, s.p_id, float(s.label)) for s in sessions])
+    conn.close()
+    print(f"# Logits of {len(sessions)} {split} sessions stored as run {run_id} in {path}")
+    return run_id
+
+def list_runs(conn, split=None, combo=None):
+    query = 'SELECT run_id, combo, split, seed, checkpoints, info, created FROM runs WHERE (? IS NULL OR split = ?) AND (? IS NULL OR combo = ?) ORDER BY run_id'
+    keys = ('run_id', 'combo', 'split', 'seed', 'checkpoints', 'info', 'created')
+    runs = [dict(zip(keys, row)) for row in conn.execute(query, (split, split, combo, combo))]
+    for run in runs:
+        run['checkpoints'] = json.loads(run['checkpoints'])
+        run['info'] = json.loads(run['info'])
+    return runs
+
+def load_run(conn, run_id):
+    """p_ids, (sessions, 8, 4) logits and total scores of a run, ordered by p_id."""
+    rows = conn.execute('SELECT p_id, l0, l1, l2, l3 FROM logits WHERE run_id = ? ORDER BY p_id, question', (run_id,)).fetchall()
+    rows = np.asarray(rows, dtype=np.float64).reshape(-1, N_QUESTIONS, 1 + N_CLASSES)
+    p_ids = rows[:, 0, 0].astype(np.int64)
+    split, = conn.execute('SELECT split FROM runs WHERE run_id = ?', (run_id,)).fetchone()
+    totals = dict(conn.execute('SELECT p_id, total FROM totals WHERE split = ?', (split,)))
+    return p_ids, torch.from_numpy(rows[:, :, 1:]).float(), torch.tensor([totals[p] for p in p_ids.tolist()])
+
+def probabilities(conn, run_ids):
+    """p_ids common to all runs and the mean of their per-question class probabilities."""
+    runs = [load_run(conn, r) for r in run_ids]
+    common = sorted(set.intersection(*(set(p.tolist()) for p, _, _ in runs)))
+    probs = []
+    for p_ids, logits, totals in runs:
+        index = torch.from_numpy(np.searchsorted(p_ids, common))
+        probs.append(torch.softmax(logits[index], dim=2))
+    return np.asarray(common), torch.stack(probs).mean(dim=0), totals[index]
+
+# Total score from the (sessions, 8, 4) class probabilities
+RULES = {
+    'argmax': lambda probs: probs.argmax(dim=2).sum(dim=1).float(),    # as the evaluation scripts
+    'expected': lambda probs: (probs * torch.arange(N_CLASSES)).sum(dim=2).sum(dim=1),
+}
+
+def scores(preds, totals):
+    return {k: float(v) for k, v in regression_metrics(preds, totals).items()}
+
+if __name__ == '__main__':
+
+    args = cmdline_args()
+    conn = connect(args.store)
+    runs = list_runs(conn, args.split, args.combo)
+    if args.runs:
+        runs = [r for r in runs if r['run_id'] in args.runs]
+    if not runs:
+        raise SystemExit(f"No runs in {args.store}")
+    if args.ensemble and len({r['split'] for r in runs}) > 1:
+        raise SystemExit("-ensemble needs runs of a single split, select one with -split")
+    if args.compare:
+        a, b = args.compare
+        p_ids, probs_a, totals = probabilities(conn, [a])
+        p_ids_b, probs_b, _ = probabilities(conn, [b])
+        if not np.array_equal(p_ids, p_ids_b):
+            raise SystemExit(f"Runs {a} and {b} do not have the same participants")
+        for rule in args.rules:
+            result = paired(RULES[rule](probs_a), RULES[rule](probs_b), totals, n_resamples=args.bootstrap or 2000)
+            for k, r in result.items():
+                print(f"{rule:<8} {k:<5} | run {a} {float(r['a']):.3f} | run {b} {float(r['b']):.3f} | diff {float(r['diff']):+.3f} [{float(r['low']):+.3f}, {float(r['high']):+.3f}] | p {float(r['p']):.4f}")
+        raise SystemExit(0)
+    width = 23 if args.bootstrap else 7
+    print(f"{'Run':>4} | {'Combo':<5} | {'Split':<5} | {'Seed':>4} | {'Checkpoints':<32} | {'Rule':<8} | {'N':>4} | {'CCC':>{width}} | {'RMSE':>{width}} | {'MAE':>{width}}")
+    print("-"*(87 + 3 * width))
+    start = time.perf_counter()
+    selections = [([r['run_id']], f"{r['run_id']:>4} | {r['combo']:<5} | {r['split']:<5} | {r['seed']:>4} | {os.path.commonprefix([c[0] for c in r['checkpoints']])[-32:]:<32}") for r in runs]
+    if args.ensemble and len(runs) > 1:
+        mean_of = ('mean of runs ' + ' '.join(str(r['run_id']) for r in runs))[:32]
+        selections.append(([r['run_id'] for r in runs], f"{'ens':>4} | {'ens':<5} | {runs[0]['split']:<5} | {'':>4} | {mean_of:<32}"))
+    for run_ids, label in selections:
+        p_ids, probs, totals = probabilities(conn, run_ids)
+        for rule in args.rules:
+            s = summary(RULES[rule](probs), totals, n_resamples=args.bootstrap)['total']
+            print(f"{label} | {rule:<8} | {len(p_ids):>4} | {format_interval(s['ccc']):>{width}} | {format_interval(s['rmse']):>{width}} | {format_interval(s['mae']):>{width}}")
+    print(f"# Scored in {(time.perf_counter() - start) * 1000:.1f} ms")
@@ -0,0 +1,122 @@
+import torch
+
+# Metrics of the PHQ-8 predictions: CCC, RMSE and MAE of the total score, and accuracy and
+# micro/macro/weighted F1 of the item scores. Every metric works on the last dimension
+# (the sessions), and any leading dimensions are computed in the same ops. That is how
+# the per-item metrics and the bootstrap run: thousands of resamples are just one more leading
+# dimension of a gathered tensor.
+#
+#   summary(total_preds, totals, item_preds, items, n_resamples=2000)
+#   paired(total_preds_a, total_preds_b, totals, n_resamples=2000)
+
+N_CLASSES = 4
+
+def ccc(prediction, ground_truth):
+    """Concordance correlation coefficient, as 1 - ccc_loss of the scripts."""
+    mean_pred, mean_gt = prediction.mean(-1), ground_truth.mean(-1)
+    v_pred = prediction - mean_pred.unsqueeze(-1)
+    v_gt = ground_truth - mean_gt.unsqueeze(-1)
+    cor = (v_pred * v_gt).sum(-1) / (v_pred.pow(2).sum(-1).sqrt() * v_gt.pow(2).sum(-1).sqrt())
+    return 2 * cor * ground_truth.std(-1) * prediction.std(-1) / (ground_truth.var(-1) + prediction.var(-1) + (mean_gt - mean_pred) ** 2)
+
+def rmse(prediction, ground_truth):
+    return (prediction - ground_truth).pow(2).mean(-1).sqrt()
+
+def mae(prediction, ground_truth):
+    return (prediction - ground_truth).abs().mean(-1)
+
+def regression_metrics(prediction, ground_truth):
+    prediction, ground_truth = prediction.double(), ground_truth.double()
+    return {'ccc': ccc(prediction, ground_truth), 'rmse': rmse(prediction, ground_truth), 'mae': mae(prediction, ground_truth)}
+
+def classification_metrics(prediction, ground_truth, n_classes=N_CLASSES):
+    """Accuracy and micro/macro/weighted F1 of class indices.
+
+    Like torcheval's multiclass_f1_score, the macro average is over the classes that occur in the
+    predictions or the targets, and the weighted average is by the support of the targets.
+    """
+    pred = torch.nn.functional.one_hot(prediction.long(), n_classes).double()
+    true = torch.nn.functional.one_hot(ground_truth.long(), n_classes).double()
+    # (..., classes) counts over the sessions
+    tp = (pred * true).sum(-2)
+    fp = pred.sum(-2) - tp
+    support = true.sum(-2)
+    seen = (tp + fp + support) > 0
+    f1 = torch.where(seen, 2 * tp / (2 * tp + fp + (support - tp)).clamp(min=1), torch.zeros_like(tp))
+    accuracy = tp.sum(-1) / support.sum(-1)
+    return {'accuracy': accuracy, 'micro_f1': accuracy, 'macro_f1': f1.sum(-1) / seen.sum(-1),
+            'weighted_f1': (f1 * support).sum(-1) / support.sum(-1)}
+
+def item_metrics(item_preds, items):
+    """Classification and regression metrics of (..., sessions, 8) item scores, each (..., 8)."""
+    item_preds, items = item_preds.transpose(-1, -2), items.transpose(-1, -2)
+    return dict(classification_metrics(item_preds, items), **regression_metrics(item_preds, items))
+
+def all_metrics(total_preds, totals, item_preds=None, items=None):
+    """Metrics of the total score, and of the items when both are given, in one pass."""
+    metrics = {'total': regression_metrics(total_preds, totals)}
+    if item_preds is not None and items is not None:
+        metrics['items'] = item_metrics(item_preds, items)
+    return metrics
+
+def resample_indices(n, n_resamples, seed=0, device=None):
+    """(n_resamples, n) indices of sessions drawn with replacement."""
+    generator = torch.Generator().manual_seed(seed)
+    return torch.randint(n, (n_resamples, n), generator=generator).to(device)
+
+def _resample(x, index):
+    # (sessions, ...) -> (resamples, sessions, ...)
+    return x[index]
+
+def _map(f, *trees):
+    if isinstance(trees[0], dict):
+        return {k: _map(f, *(t[k] for t in trees)) for k in trees[0]}
+    return f(*trees)
+
+def _interval(point, samples, alpha):
+    # samples has the resamples first, CCC is NaN for resamples of constant scores
+    q = torch.tensor([alpha / 2, 1 - alpha / 2], dtype=samples.dtype)
+    low, high = torch.nanquantile(samples, q, dim=0)
+    return {'value': point, 'low': low, 'high': high}
+
+def summary(total_preds, totals, item_preds=None, items=None, n_resamples=2000, alpha=0.05, seed=0):
+    """all_metrics with percentile bootstrap confidence intervals at level 1 - alpha.
+
+    Every metric becomes {'value', 'low', 'high'}, per item for the item metrics.
+    """
+    point = all_metrics(total_preds, totals, item_preds, items)
+    if not n_resamples:
+        return _map(lambda v: {'value': v}, point)
+    index = resample_indices(len(totals), n_resamples, seed, totals.device)
+    args = [None if x is None else _resample(x, index) for x in (total_preds, totals, item_preds, items)]
+    # Resamples of the items are (resamples, sessions, 8), the metrics (resamples, 8)
+    samples = all_metrics(*args)
+    return _map(lambda p, s: _interval(p, s, alpha), point, samples)
+
+def paired(preds_a, preds_b, ground_truth, metrics=regression_metrics, n_resamples=2000, alpha=0.05, seed=0):
+    """Paired bootstrap of metrics(preds_b) - metrics(preds_a) on the same resamples.
+
+    Returns {'a', 'b', 'diff', 'low', 'high', 'p'} per metric, p being the two-sided
+    bootstrap p-value of no difference.
+    """
+    index = resample_indices(len(ground_truth), n_resamples, seed, ground_truth.device)
+    point_a, point_b = metrics(preds_a, ground_truth), metrics(preds_b, ground_truth)
+    sample_a = metrics(_resample(preds_a, index), _resample(ground_truth, index))
+    sample_b = metrics(_resample(preds_b, index), _resample(ground_truth, index))
+    q = torch.tensor([alpha / 2, 1 - alpha / 2], dtype=torch.float64)
+    out = {}
+    for k in point_a:
+        diff = sample_b[k] - sample_a[k]
+        diff = diff[~diff.isnan()]
+        if len(diff):
+            low, high = torch.quantile(diff, q)
+            p = (2 * torch.minimum((diff <= 0).double().mean(), (diff >= 0).double().mean())).clamp(max=1)
+        else:
+            low = high = p = torch.tensor(float('nan'))
+        out[k] = {'a': point_a[k], 'b': point_b[k], 'diff': point_b[k] - point_a[k], 'low': low, 'high': high, 'p': p}
+    return out
+
+def format_interval(m):
+    if 'low' not in m:
+        return f"{float(m['value']):.3f}"
+    return f"{float(m['value']):.3f} [{float(m['low']):.3f}, {float(m['high']):.3f}]"
@@ -0,0 +1,155 @@
+import argparse
+import json
+import multiprocessing
+import os
+import time
+import torch
+from torch.utils.data import DataLoader
+
+from questmf.heads import HEADS
+from questmf.logits_store import save_logits
+from questmf.metrics import regression_metrics
+from questmf.multitask import ITEMS, MODALITY_CKPT, eval_script, forward_items, load_ensemble
+from questmf.precision import autocast
+from questmf.scripts import COMBOS, load_script, bind
+
+# Evaluation of the checkpoints of several seeds of one combination. The dataset of the split is
+# built and its features read once, then the eight per-question models of every seed are loaded
+# and run on the same batches in parallel worker processes:
+#
+#   python -m questmf.multi_seed -combo A -seeds 1 2 3 4 5 -d_path ... -l_path ... -a_ckpt ckpt/a
+#   python -m questmf.multi_seed -combo TAV -seeds 1 2 3 4 5 -d_path ... -l_path ... -t_ckpt ckpt/t -a_ckpt ckpt/a -v_ckpt ckpt/v -ckpt ckpt/tav
+#
+# Prints the CCC, RMSE and MAE of every seed as the evaluation scripts compute them, their mean and
+# standard deviation, and the scores of the seed ensemble, which averages the logits of all seeds.
+
+def cmdline_args():
+    # Make parser object
+    p = argparse.ArgumentParser()
+    p.add_argument("-combo", "--combo", type=str, default='TAV', choices=list(COMBOS), help="Modality combination of the models")
+    p.add_argument("-seeds", "--seeds", nargs='+', type=int, default=[1, 2, 3, 4, 5], help="Seeds of the checkpoints to evaluate")
+    p.add_argument("-d_path", "--data_path", type=str, help="Path to data files (text transcripts, audio files, video features)")
+    p.add_argument("-l_path", "--label_path", type=str, help="Path to labels, i.e., PHQ-8 scores")
+    p.add_argument("-ckpt", "--checkpoint_path", type=str, help="Checkpoint prefix of the fusion model, e.g. the -tav_ckpt of the scripts")
+    p.add_argument("-t_ckpt", "--text_checkpoint_path", type=str, help="Checkpoint prefix of the text model")
+    p.add_argument("-a_ckpt", "--audio_checkpoint_path", type=str, help="Checkpoint prefix of the audio model")
+    p.add_argument("-v_ckpt", "--video_checkpoint_path", type=str, help="Checkpoint prefix of the video model")
+    p.add_argument("-m_files", "--missing_video_files", nargs='+', type=int, default=[], help="List of file numbers for incomplete video files")
+    p.add_argument("-split", "--split", type=str, default='test', choices=['train','val','test'], help="Split to evaluate")
+    p.add_argument("-procs", "--procs", type=int, help="Worker processes, one seed at a time each (default: one per seed, up to the number of cores)")
+    p.add_argument("-threads", "--threads", type=int, help="Threads per worker (default: the cores divided among the workers)")
+    p.add_argument("-bs", "--batch_size", type=int, default=10, help="Batch size")
+    p.add_argument("-head", "--head", type=str, default='flatten', choices=HEADS, help="Classification head of the models")
+    p.add_argument("-fused_attn", "--fused_attn", action='store_true', help="Fused attention blocks (fusion models)")
+    p.add_argument("-bf16", "--bf16", action='store_true', help="Run the forward passes under bf16 autocast")
+    p.add_argument("-workers", "--workers", type=int, default=8, help="Number of workers for reading the participant files")
+    p.add_argument("-cache_dir", "--cache_dir", type=str, default='cache', help="Directory for the feature and sentence embedding caches")
+    p.add_argument("-embedder", "--embedder", type=str, default='sentence-transformers/all-distilroberta-v1', help="Sentence embedder for the text modality")
+    p.add_argument("-logits_store", "--logits_store", type=str, help="SQLite file to store the logits of every seed in, see questmf.logits_store")
+    p.add_argument("-o", "--output", type=str, help="JSON file for the scores")
+    return p.parse_args()
+
+def checkpoint_prefixes(args, combo):
+    """Prefix of the per-question checkpoints and of the encoders of every modality."""
+    mods = COMBOS[combo][2]
+    encoder_ckpts = {m: getattr(args, MODALITY_CKPT[m]) for m in mods}
+    return (encoder_ckpts[mods[0]] if len(mods) == 1 else args.checkpoint_path), encoder_ckpts
+
+def materialize(data, batch_size):
+    """The batches of a dataset, read once and shared by every seed."""
+    return list(DataLoader(data, batch_size=batch_size))
+
+def seed_logits(module, combo, ckpt, encoder_ckpts, seed, batches, device, bf16=False, **kwargs):
+    """(sessions, 8, 4) logits of the eight per-question models of a seed."""
+    models = load_ensemble(module, combo, ckpt, encoder_ckpts, seed, device, **kwargs)
+    for model in models:
+        model.eval()
+    n_inputs = 2 * len(COMBOS[combo][2])
+    logits = []
+    with torch.no_grad(), autocast(device, bf16):
+        for batch in batches:
+            logits.append(forward_items(models, [t.to(device) for t in batch[:n_inputs]]).float().cpu())
+    return torch.cat(logits)
+
+# State of a worker process, set once by _init_worker
+_worker = {}
+
+def _init_worker(state):
+    torch.set_num_threads(state['threads'])
+    device = torch.device(state['device'])
+    _worker.update(state, module=bind(load_script(state['combo'], 'eval'), device), device=device)
+
+def _run_seed(seed):
+    w = _worker
+    start = time.perf_counter()
+    logits = seed_logits(w['module'], w['combo'], w['ckpt'], w['encoder_ckpts'], seed, w['batches'], w['device'], w['bf16'], **w['kwargs'])
+    return seed, logits, time.perf_counter() - start
+
+def evaluate_seeds(combo, ckpt, encoder_ckpts, seeds, batches, device, procs=1, threads=None, bf16=False, **kwargs):
+    """Logits of every seed, seed -> (sessions, 8, 4), and the time each seed took."""
+    threads = threads or max(1, (os.cpu_count() or 1) // procs)
+    state = {'combo': combo, 'ckpt': ckpt, 'encoder_ckpts': encoder_ckpts, 'batches': batches, 'device': str(device),
+             'threads': threads, 'bf16': bf16, 'kwargs': kwargs}
+    if procs == 1:
+        _init_worker(state)
+        results = [_run_seed(seed) for seed in seeds]
+    else:
+        # Forked workers share the batches without copying them, CUDA needs fresh processes
+        ctx = multiprocessing.get_context('spawn' if device.type == 'cuda' or 'fork' not in multiprocessing.get_all_start_methods() else 'fork')
+        with ctx.Pool(procs, initializer=_init_worker, initargs=(state,)) as pool:
+            results = pool.map(_run_seed, seeds, chunksize=1)
+    return {seed: logits for seed, logits, _ in results}, {seed: t for seed, _, t in results}
+
+def total_preds(logits):
+    # Sum of the predicted classes, as the evaluation scripts
+    return logits.argmax(dim=2).sum(dim=1).double()
+
+def seed_report(logits, totals):
+    """Scores of every seed, their mean and standard deviation, and of the seed ensemble."""
+    per_seed = {seed: {k: float(v) for k, v in regression_metrics(total_preds(l), totals).items()} for seed, l in logits.items()}
+    stacked = {k: torch.tensor([s[k] for s in per_seed.values()], dtype=torch.float64) for k in ('ccc', 'rmse', 'mae')}
+    ensemble = torch.stack(list(logits.values())).mean(dim=0)
+    return {'seeds': per_seed,
+            'mean': {k: float(v.mean()) for k, v in stacked.items()},
+            'std': {k: float(v.std()) if len(v) > 1 else 0.0 for k, v in stacked.items()},
+            'ensemble': {k: float(v) for k, v in regression_metrics(total_preds(ensemble), totals).items()}}
+
+def print_report(report, times=None):
+    print(f"{'Seed':<10} | {'CCC':>7} | {'RMSE':>7} | {'MAE':>7}" + (f" | {'Time s':>7}" if times else ""))
+    print("-"*(40 + (10 if times else 0)))
+    for seed, s in report['seeds'].items():
+        print(f"{seed:<10} | {s['ccc']:>7.3f} | {s['rmse']:>7.3f} | {s['mae']:>7.3f}" + (f" | {times[seed]:>7.1f}" if times else ""))
+    m, s = report['mean'], report['std']
+    print(f"{'mean ± std':<10} | " + " | ".join(f"{m[k]:.3f}±{s[k]:.3f}" for k in ('ccc', 'rmse', 'mae')))
+    print(f"{'ensemble':<10} | " + " | ".join(f"{report['ensemble'][k]:>7.3f}" for k in ('ccc', 'rmse', 'mae')))
+
+if __name__ == '__main__':
+
+    args = cmdline_args()
+    os.environ["TOKENIZERS_PARALLELISM"] = "false"
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    procs = args.procs or (1 if device.type == 'cuda' else min(len(args.seeds), os.cpu_count() or 1))
+    ckpt, encoder_ckpts = checkpoint_prefixes(args, args.combo)
+    kwargs = dict({'fused_attn': args.fused_attn} if len(COMBOS[args.combo][2]) > 1 else {}, head=args.head)
+    print(f"# {args.combo} on {device}, seeds {' '.join(map(str, args.seeds))}, {procs} worker process(es)")
+
+    start = time.perf_counter()
+    module = eval_script(args.combo, device, args.embedder)
+    data = module.dds(args.split, args.data_path, args.label_path, args.missing_video_files, args.workers, cache_dir=args.cache_dir)
+    batches = materialize(data, args.batch_size)
+    totals = torch.cat([b[2 * len(COMBOS[args.combo][2])] for b in batches]).double()
+    loaded = time.perf_counter()
+    logits, times = evaluate_seeds(args.combo, ckpt, encoder_ckpts, args.seeds, batches, device, procs, args.threads, args.bf16, **kwargs)
+    done = time.perf_counter()
+
+    report = seed_report(logits, totals)
+    print_report(report, times)
+    print(f"# {len(data)} {args.split} sessions, data in {loaded - start:.1f} s, {len(args.seeds)} seeds in {done - loaded:.1f} s")
+    if args.logits_store:
+        for seed, l in logits.items():
+            files = [ckpt + '-phq' + str(q) + '-seed-' + str(seed) + '-ccc.pt' for q in range(1, len(ITEMS) + 1)]
+            save_logits(args.logits_store, args.combo, args.split, seed, data, l, files, head=args.head, bf16=args.bf16)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(dict(report, combo=args.combo, split=args.split, seconds={str(k): v for k, v in times.items()}), f, indent=1)
+        print(f"# Scores written to {args.output}")
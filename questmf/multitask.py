@@ -0,0 +1,324 @@
+import argparse
+import functools
+import json
+import os
+import time
+import numpy as np
+import torch
+import torch.nn as nn
+from torch.utils.data import Dataset, DataLoader
+
+from questmf.config import scale_lr
+from questmf.heads import HEADS
+from questmf.instrument import stage_timer
+from questmf.labels import ITEMS, load_labels, class_weights
+from questmf.metrics import all_metrics
+from questmf.precision import autocast
+from questmf.prune import load_checkpoint
+from questmf.scripts import COMBOS, load_script, bind, uses_text
+
+# Shared-backbone variant of QuestMF. Instead of eight full models, one per PHQ-8 item, a single
+# model of the same architecture runs once per sample and feeds eight per-item heads. The heads
+# replace the last Linear(256,4) of the model, everything up to the 256-d hidden layer is shared.
+# It is trained jointly, with the ImbOLL weights of every item, and can be compared against the
+# eight-model ensemble of the evaluation scripts on accuracy, parameters and latency:
+#
+#   python -m questmf.multitask -combo A -s 1 -b 1 -a 1 -d_path ... -l_path ... -ckpt ckpt/a -train -compare
+#   python -m questmf.multitask -combo TAV -s 1 -b 1 -a 1 -d_path ... -l_path ... -t_ckpt ckpt/t -a_ckpt ckpt/a -v_ckpt ckpt/v -ckpt ckpt/tav -train -compare
+#
+# Fusion models take their encoders from the multitask checkpoints of the single modalities.
+# The multitask checkpoints are <ckpt>-multitask-seed-<seed>.pt (lowest validation loss) and
+# <ckpt>-multitask-seed-<seed>-ccc.pt (highest validation CCC of the total score).
+
+MODALITY_CKPT = {'txt': 'text_checkpoint_path', 'aud': 'audio_checkpoint_path', 'vid': 'video_checkpoint_path'}
+
+def cmdline_args():
+    # Make parser object
+    p = argparse.ArgumentParser()
+    p.add_argument("-combo", "--combo", type=str, default='TAV', choices=list(COMBOS), help="Modality combination of the model")
+    p.add_argument("-s", "--seed", type=int, default=1, help="Set a random seed")
+    p.add_argument("-b", "--beta", type=float, default=1.0, help="The beta value used in weights for ImbOLL")
+    p.add_argument("-a", "--alpha", type=float, default=1.0, help="The alpha value used in distance for ImbOLL")
+    p.add_argument("-d_path", "--data_path", type=str, help="Path to data files (text transcripts, audio files, video features)")
+    p.add_argument("-l_path", "--label_path", type=str, help="Path to labels, i.e., PHQ-8 scores")
+    p.add_argument("-ckpt", "--checkpoint_path", type=str, help="Checkpoint prefix of the model of -combo, e.g. the -tav_ckpt of the scripts")
+    p.add_argument("-t_ckpt", "--text_checkpoint_path", type=str, help="Checkpoint prefix of the text model (fusion models)")
+    p.add_argument("-a_ckpt", "--audio_checkpoint_path", type=str, help="Checkpoint prefix of the audio model (fusion models)")
+    p.add_argument("-v_ckpt", "--video_checkpoint_path", type=str, help="Checkpoint prefix of the video model (fusion models)")
+    p.add_argument("-m_files", "--missing_video_files", nargs='+', type=int, default=[], help="List of file numbers for incomplete video files")
+    p.add_argument("-train", "--train_model", action='store_true', help="Train the multitask model")
+    p.add_argument("-compare", "--compare", action='store_true', help="Compare against the eight per-question models")
+    p.add_argument("-bs", "--batch_size", type=int, default=10, help="Batch size")
+    p.add_argument("-epochs", "--epochs", type=int, default=20, help="Number of training epochs")
+    p.add_argument("-lr", "--lr", type=float, default=5e-4, help="Learning rate at batch size 10")
+    p.add_argument("-lr_scale", "--lr_scale", type=str, default='none', choices=['none','linear','sqrt'], help="Scale -lr with the batch size relative to 10")
+    p.add_argument("-fused_attn", "--fused_attn", action='store_true', help="Fused attention blocks (fusion models)")
+    p.add_argument("-head", "--head", type=str, default='flatten', choices=HEADS, help="Classification head of the models, see questmf.heads")
+    p.add_argument("-bf16", "--bf16", action='store_true', help="Run the forward passes under bf16 autocast")
+    p.add_argument("-workers", "--workers", type=int, default=8, help="Number of workers for reading the participant files")
+    p.add_argument("-cache_dir", "--cache_dir", type=str, default='cache', help="Directory for the feature and sentence embedding caches")
+    p.add_argument("-embedder", "--embedder", type=str, default='sentence-transformers/all-distilroberta-v1', help="Sentence embedder for the text modality")
+    p.add_argument("-metrics", "--metrics_path", type=str, help="JSONL file for per-stage timing metrics")
+    p.add_argument("-o", "--output", type=str, help="JSON file for the comparison")
+    return p.parse_args()
+
+class multitask(nn.Module):
+    """A QuestMF model with its last Linear(256,4) replaced by one 4-class head per PHQ-8 item.
+
+    forward returns logits of shape (batch, items, 4).
+    """
+    def __init__(self, backbone, n_items=len(ITEMS)):
+        super(multitask, self).__init__()
+        last = backbone.mlp[-1]
+        backbone.mlp[-1] = nn.Identity()
+        self.backbone = backbone
+        self.heads = nn.ModuleList([nn.Linear(last.in_features, last.out_features) for _ in range(n_items)])
+
+    def forward(self, *inputs):
+        h = self.backbone(*inputs)
+        return torch.stack([head(h) for head in self.heads], dim=1)
+
+class item_scores(Dataset):
+    """Samples of an evaluation script dataset with the eight item scores appended."""
+    def __init__(self, data, label_path, cache_dir=None):
+        super(item_scores, self).__init__()
+        self.data = data
+        self.items = torch.tensor(load_labels(label_path, cache_dir).items([s.p_id for s in data.data]), dtype=torch.float32)
+
+    def __getitem__(self, index):
+        return self.data[index] + [self.items[index]]
+
+    def __len__(self):
+        return len(self.data)
+
+def checkpoint_name(prefix, seed, ccc=False, tag='multitask'):
+    return prefix + '-' + tag + '-seed-' + str(seed) + ('-ccc' if ccc else '') + '.pt'
+
+@functools.lru_cache(maxsize=None)
+def _embedder(name, device):
+    from transformers import AutoTokenizer, AutoModel
+    return AutoTokenizer.from_pretrained(name), AutoModel.from_pretrained(name).to(device)
+
+def eval_script(combo, device, embedder='sentence-transformers/all-distilroberta-v1'):
+    """The evaluation script of a combination, with the sentence embedder loaded when it uses text."""
+    module = load_script(combo, 'eval')
+    if uses_text(combo):
+        return bind(module, device, *_embedder(embedder, device))
+    return bind(module, device)
+
+def splits(eval_module, args):
+    """Train and validation sets with the item scores, and the test set with the total score only."""
+    dds = lambda split: eval_module.dds(split, args.data_path, args.label_path, args.missing_video_files, args.workers, cache_dir=args.cache_dir)
+    return item_scores(dds('train'), args.label_path, args.cache_dir), item_scores(dds('val'), args.label_path, args.cache_dir), dds('test')
+
+def build_multitask(module, combo, encoder_ckpts=None, seed=1, head='flatten', **kwargs):
+    """Multitask model of a combination, built from the classes of its training script.
+
+    Fusion models load their encoders from the multitask checkpoints in encoder_ckpts
+    (modality -> prefix). The encoders' own heads are not used by the fusion model.
+    """
+    mods = COMBOS[combo][2]
+    if len(mods) == 1:
+        return multitask(module.lstm_regressor(head=head))
+    encoders = []
+    for m in mods:
+        encoder = getattr(module, 'lstm_regressor_' + m)(head=head)
+        state = torch.load(checkpoint_name(encoder_ckpts[m], seed), map_location='cpu')
+        missing, unexpected = encoder.load_state_dict({k[len('backbone.'):]: v for k, v in state.items() if k.startswith('backbone.')}, strict=False)
+        assert all(k.startswith('mlp.') for k in missing) and not unexpected, (missing, unexpected)
+        encoders.append(encoder)
+    return multitask(module.lstm_regressor(*encoders, head=head, **kwargs))
+
+def load_ensemble(module, combo, ckpt, encoder_ckpts, seed, device, head='flatten', **kwargs):
+    """The eight per-question models, loaded the way the evaluation scripts do."""
+    mods = COMBOS[combo][2]
+    models = []
+    for q in range(1, len(ITEMS) + 1):
+        if len(mods) == 1:
+            model = module.lstm_regressor(head=head)
+        else:
+            encoders = []
+            for m in mods:
+                encoder = getattr(module, 'lstm_regressor_' + m)(head=head)
+                load_checkpoint(encoder, encoder_ckpts[m] + '-phq' + str(q) + '-seed-' + str(seed) + '.pt', map_location='cpu')
+                encoders.append(encoder)
+            model = module.lstm_regressor(*encoders, head=head, **kwargs)
+        load_checkpoint(model, ckpt + '-phq' + str(q) + '-seed-' + str(seed) + '-ccc.pt', map_location='cpu')
+        models.append(model.to(device))
+    return models
+
+def n_params(models):
+    """Number of distinct parameters of a list of models."""
+    seen = {}
+    for model in models:
+        for p in model.parameters():
+            seen[id(p)] = p.numel()
+    return sum(seen.values())
+
+def item_loss(module, logits, weights, items, alpha):
+    """Mean of the per-item ImbOLL losses, each with the weights of its item."""
+    return sum(module.ImbOLL(logits[:, q], weights[q], items[:, q], alpha) for q in range(len(weights))) / len(weights)
+
+def forward_items(models, inputs):
+    """(batch, items, 4) logits of one multitask model or of the eight per-question models."""
+    if len(models) == 1:
+        return models[0](*inputs)
+    return torch.stack([model(*inputs) for model in models], dim=1)
+
+def predict(models, loader, n_inputs, device, bf16=False):
+    """Item predictions (N, 8) of one multitask model or of the eight per-question models.
+
+    Also returns the total scores, the item scores when the loader has them, and the forward
+    time of every batch in milliseconds.
+    """
+    for model in models:
+        model.eval()
+    preds, totals, items, times = [], [], [], []
+    for batch in loader:
+        inputs = [t.to(device) for t in batch[:n_inputs]]
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+        t0 = time.perf_counter()
+        with torch.no_grad(), autocast(device, bf16):
+            logits = forward_items(models, inputs)
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+        times.append((time.perf_counter() - t0) * 1000)
+        preds.append(logits.float().argmax(dim=2).cpu())
+        totals.append(batch[n_inputs])
+        if len(batch) > n_inputs + 1:
+            items.append(batch[n_inputs + 1])
+    return torch.cat(preds), torch.cat(totals), torch.cat(items) if items else None, times
+
+def scores(preds, totals, items=None):
+    """CCC, RMSE and MAE of the total score as in the evaluation scripts, plus per-item accuracy and macro F1."""
+    metrics = all_metrics(preds.sum(dim=1), totals, *((preds, items) if items is not None else ()))
+    result = {k: float(v) for k, v in metrics['total'].items()}
+    if items is not None:
+        result['item_accuracy'] = float(metrics['items']['accuracy'].mean() * 100)
+        result['item_macro_f1'] = float(metrics['items']['macro_f1'].mean())
+    return result
+
+def train(model, module, train_dataloader, val_dataloader, n_inputs, weights, alpha, ckpt_prefix, seed, epochs, lr, device, bf16=False, metrics_path=None, loss_fn=None, tag='multitask'):
+    """Train the multitask model on all eight items at once and keep the best checkpoints.
+
+    loss_fn(logits, batch) replaces the item loss in training, e.g. for distillation.
+    The validation loss is always the item loss.
+    """
+    optimizer = torch.optim.AdamW(model.parameters(), lr=lr, eps=1e-8, weight_decay=1e-3)
+    timer = stage_timer(device, metrics_path, phase='train')
+    best_val_loss, best_val_ccc = float('inf'), -100
+    print(f"{'Epoch':^7} | {'Train Loss':^12} | {'Val Loss':^10} | {'Val CCC':^9} | {'Item acc':^9} | {'Elapsed':^9}")
+    print("-"*70)
+    for epoch_i in range(epochs):
+        t0_epoch = time.time()
+        model.train()
+        timer.reset()
+        total_loss = 0
+        for batch in timer.loader(train_dataloader):
+            with timer.stage('h2d'):
+                batch = [t.to(device) for t in batch]
+            inputs, items = batch[:n_inputs], batch[n_inputs + 1]
+            timer.add_samples(items.shape[0])
+            model.zero_grad()
+            with timer.stage('forward'), autocast(device, bf16):
+                logits = model(*inputs).float()
+            with timer.stage('loss'):
+                loss = loss_fn(logits, batch) if loss_fn else item_loss(module, logits, weights, items, alpha)
+            total_loss += loss.item() * items.shape[0]
+            with timer.stage('backward'):
+                loss.backward()
+            with timer.stage('clip_grad'):
+                torch.nn.utils.clip_grad_norm_(model.parameters(), 1.0)
+            with timer.stage('optimizer_step'):
+                optimizer.step()
+        timer.end_loop()
+
+        # Validation loss of all items and the scores of the summed prediction
+        model.eval()
+        val_loss, preds, totals, items = 0, [], [], []
+        with torch.no_grad():
+            for batch in val_dataloader:
+                batch = [t.to(device) for t in batch]
+                with autocast(device, bf16):
+                    logits = model(*batch[:n_inputs]).float()
+                val_loss += item_loss(module, logits, weights, batch[n_inputs + 1], alpha).item() * batch[0].shape[0]
+                preds.append(logits.argmax(dim=2).cpu())
+                totals.append(batch[n_inputs].cpu())
+                items.append(batch[n_inputs + 1].cpu())
+        val_loss /= len(val_dataloader.dataset)
+        val = scores(torch.cat(preds), torch.cat(totals), torch.cat(items))
+        if val_loss < best_val_loss:
+            best_val_loss = val_loss
+            with timer.stage('checkpoint'):
+                torch.save(model.state_dict(), checkpoint_name(ckpt_prefix, seed, tag=tag))
+        # CCC is undefined (nan) while all predictions are equal, so the first epoch is always kept
+        if epoch_i == 0 or val['ccc'] > best_val_ccc:
+            best_val_ccc = val['ccc']
+            with timer.stage('checkpoint'):
+                torch.save(model.state_dict(), checkpoint_name(ckpt_prefix, seed, ccc=True, tag=tag))
+        print(f"{epoch_i + 1:^7} | {total_loss / len(train_dataloader.dataset):^12.6f} | {val_loss:^10.6f} | {val['ccc']:^9.4f} | {val['item_accuracy']:^9.2f} | {time.time() - t0_epoch:^9.2f}")
+        timer.report(epoch_i + 1, train_loss=total_loss / len(train_dataloader.dataset), val_loss=val_loss)
+    print("Training complete!")
+
+def compare(module, multitask_model, ensemble, val_dataloader, test_dataloader, n_inputs, device, bf16=False):
+    """Scores, parameters and forward latency of the multitask model and the ensemble."""
+    report = {}
+    for name, models in (('ensemble', ensemble), ('multitask', [multitask_model])):
+        r = {'params': n_params(models)}
+        r.update({'val_' + k: v for k, v in scores(*predict(models, val_dataloader, n_inputs, device, bf16)[:3]).items()})
+        preds, totals, _, times = predict(models, test_dataloader, n_inputs, device, bf16)
+        r.update({'test_' + k: v for k, v in scores(preds, totals).items()})
+        # The first batch includes one-off allocations
+        times = times[1:] or times
+        r['ms_per_batch'] = float(np.median(times))
+        report[name] = r
+    print(f"{'Model':^10} | {'Params':^11} | {'ms/batch':^9} | {'Val item acc':^12} | {'Val CCC':^8} | {'Test CCC':^8} | {'Test RMSE':^9} | {'Test MAE':^8}")
+    print("-"*98)
+    for name, r in report.items():
+        print(f"{name:^10} | {r['params']:^11,} | {r['ms_per_batch']:^9.2f} | {r['val_item_accuracy']:^12.2f} | {r['val_ccc']:^8.4f} | {r['test_ccc']:^8.4f} | {r['test_rmse']:^9.4f} | {r['test_mae']:^8.4f}")
+    e, m = report['ensemble'], report['multitask']
+    print(f"# Multitask: {e['params'] / m['params']:.1f}x fewer parameters, {e['ms_per_batch'] / m['ms_per_batch']:.1f}x faster forward")
+    return report
+
+if __name__ == '__main__':
+
+    args = cmdline_args()
+    torch.manual_seed(args.seed)
+    np.random.seed(args.seed)
+    os.environ["TOKENIZERS_PARALLELISM"] = "false"
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    print(f"# Using device: {device}")
+
+    mods = COMBOS[args.combo][2]
+    n_inputs = 2 * len(mods)
+    encoder_ckpts = {m: getattr(args, MODALITY_CKPT[m]) for m in mods}
+    kwargs = dict({'fused_attn': args.fused_attn} if len(mods) > 1 else {}, head=args.head)
+
+    # Model classes and ImbOLL from the training script, datasets with the total score from the evaluation script
+    train_module = bind(load_script(args.combo, 'train'), device)
+    data_train, data_val, data_test = splits(eval_script(args.combo, device, args.embedder), args)
+    train_dataloader = DataLoader(data_train, batch_size=args.batch_size, shuffle=True)
+    val_dataloader = DataLoader(data_val, batch_size=args.batch_size)
+    test_dataloader = DataLoader(data_test, batch_size=args.batch_size)
+
+    if args.train_model:
+        model = build_multitask(train_module, args.combo, encoder_ckpts, args.seed, **kwargs).to(device)
+        # ImbOLL weights of every item
+        weights = list(class_weights(args.label_path, args.beta, args.cache_dir))
+        train(model, train_module, train_dataloader, val_dataloader, n_inputs, weights, args.alpha, args.checkpoint_path, args.seed,
+              args.epochs, scale_lr(args.lr, args.batch_size, args.lr_scale), device, args.bf16, args.metrics_path)
+
+    # Best checkpoint by validation CCC, as the evaluation scripts use
+    model = build_multitask(train_module, args.combo, encoder_ckpts, args.seed, **kwargs)
+    model.load_state_dict(torch.load(checkpoint_name(args.checkpoint_path, args.seed, ccc=True), map_location='cpu'))
+    model.to(device)
+    if args.compare:
+        ensemble = load_ensemble(train_module, args.combo, args.checkpoint_path, encoder_ckpts, args.seed, device, **kwargs)
+        report = compare(train_module, model, ensemble, val_dataloader, test_dataloader, n_inputs, device, args.bf16)
+        if args.output:
+            with open(args.output, 'w') as f:
+                json.dump(dict(report, combo=args.combo, seed=args.seed, batch_size=args.batch_size, device=str(device)), f, indent=1)
+    else:
+        preds, totals, _, _ = predict([model], test_dataloader, n_inputs, device, args.bf16)
+        print(scores(preds, totals))
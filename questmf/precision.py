@@ -0,0 +1,31 @@
+from contextlib import nullcontext
+import torch
+
+# bf16 mixed precision. Under autocast the matmuls, LSTMs and attention run in bfloat16 while the
+# parameters, gradients and AdamW state stay float32 (the master weights), so no loss scaling
+# is needed. Logits are cast back to float32 before the loss.
+
+def autocast(device, enabled):
+    """bf16 autocast on device when enabled, else a no-op context."""
+    if not enabled:
+        return nullcontext()
+    return torch.autocast(device_type=torch.device(device).type, dtype=torch.bfloat16)
+
+def check_bf16(device):
+    # Without native bf16 (AVX512-BF16/AMX) CPUs emulate it, which is slower than float32
+    if torch.device(device).type == 'cpu' and not torch.ops.mkldnn._is_mkldnn_bf16_supported():
+        print("# This CPU has no native bf16 support, -bf16 will be slower than float32")
+    elif torch.device(device).type == 'cuda' and not torch.cuda.is_bf16_supported():
+        print("# This GPU has no bf16 support")
+
+def parity_report(names, fp32, bf16):
+    """Print the metrics of a float32 and a bf16 run side by side with their differences."""
+    print(f"{'Metric':^12} | {'float32':^10} | {'bf16':^10} | {'Abs diff':^10} | {'Rel diff':^9}")
+    print("-"*62)
+    report = {}
+    for name, a, b in zip(names, fp32, bf16):
+        a, b = float(a), float(b)
+        rel = abs(a - b) / abs(a) if a != 0 else float('nan')
+        print(f"{name:^12} | {a:^10.4f} | {b:^10.4f} | {abs(a - b):^10.4f} | {rel:^9.2%}")
+        report[name] = {'fp32': a, 'bf16': b, 'abs_diff': abs(a - b), 'rel_diff': rel}
+    return report
@@ -0,0 +1,54 @@
+import functools
+import os
+import torch
+from torch.profiler import ProfilerActivity, profile, record_function, schedule, tensorboard_trace_handler
+
+class null_profiler:
+    # Stand-in with the same start/step/stop interface when profiling is off
+    def start(self):
+        pass
+    def step(self):
+        pass
+    def stop(self):
+        pass
+
+def profile_range(name):
+    """Decorator that labels every call of a function as a torch.profiler range.
+    """
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with record_function(name):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def make_profiler(trace_dir=None, wait=1, warmup=1, active=5, row_limit=30):
+    """torch.profiler over a window of steps, or a no-op profiler if trace_dir is None.
+
+    The first `wait` steps are skipped, the next `warmup` steps are traced but discarded and the
+    following `active` steps are recorded. When the window closes, a Chrome/TensorBoard trace
+    (*.pt.trace.json) and a table of the top ops by self CPU time are written to trace_dir.
+    """
+    if trace_dir is None:
+        return null_profiler()
+    os.makedirs(trace_dir, exist_ok=True)
+    activities = [ProfilerActivity.CPU]
+    if torch.cuda.is_available():
+        activities.append(ProfilerActivity.CUDA)
+    save_trace = tensorboard_trace_handler(trace_dir)
+
+    def on_trace_ready(prof):
+        save_trace(prof)
+        sort_by = 'self_cuda_time_total' if ProfilerActivity.CUDA in activities else 'self_cpu_time_total'
+        table = prof.key_averages().table(sort_by=sort_by, row_limit=row_limit)
+        with open(os.path.join(trace_dir, f'top_ops_step{prof.step_num}.txt'), 'w') as f:
+            f.write(table)
+        print(table)
+        print(f"# Profiler traces written to {trace_dir}")
+
+    return profile(activities=activities,
+                   schedule=schedule(wait=wait, warmup=warmup, active=active, repeat=1),
+                   on_trace_ready=on_trace_ready,
+                   record_shapes=True,
+                   profile_memory=True)
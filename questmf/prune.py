@@ -0,0 +1,288 @@
+import argparse
+import os
+import statistics
+import time
+import warnings
+import torch
+import torch.nn as nn
+import torch.nn.utils.prune as torch_prune
+from torch.utils.data import DataLoader
+
+from questmf.config import scale_lr
+from questmf.heads import HEADS
+from questmf.scripts import COMBOS, load_script, bind, build_model, random_inputs, uses_text
+
+# Post-training pruning of the heads of trained QuestMF models. The Linear layers of every
+# model's mlp, e.g. the Linear(72000,256) of the TAV flatten head, are pruned by magnitude and
+# the per-question checkpoints are written again under a new prefix, in a compact format:
+#
+#   python -m questmf.prune -combo A -ckpt ckpt/a -o ckpt/a-pruned -sparsity 0.9
+#   python -m questmf.prune -combo TAV -ckpt ckpt/tav -o ckpt/tav-pruned -sparsity 0.95 -finetune 3 -d_path ... -l_path ...
+#
+# Unstructured pruning zeroes the smallest weights of each layer. Layers that end up sparse
+# enough are stored as CSR (int32 indices and the kept values) and run as sparse matmuls, which
+# is faster than the dense layer on CPU from about 80% sparsity. Structured pruning (-structured)
+# drops the hidden units of each mlp with the smallest incoming weights, so the layers stay
+# dense and just get smaller. -finetune runs a few epochs of the training script's own train
+# loop on the pruned model, with the pruned weights held at zero.
+#
+# The evaluation scripts load both formats, so the new prefix can be passed to them as it is.
+
+# Layers at most this dense are stored and run as CSR
+SPARSE_MAX_DENSITY = 0.3
+SPARSE_FORMAT = 'questmf-sparse-1'
+
+warnings.filterwarnings('ignore', message='Sparse CSR tensor support is in beta state')
+
+def cmdline_args():
+    # Make parser object
+    p = argparse.ArgumentParser()
+    p.add_argument("-combo", "--combo", type=str, default='TAV', choices=list(COMBOS), help="Modality combination of the model")
+    p.add_argument("-s", "--seed", type=int, default=1, help="Seed of the checkpoints")
+    p.add_argument("-ckpt", "--checkpoint_path", type=str, required=True, help="Checkpoint prefix of the model of -combo, e.g. the -tav_ckpt of the scripts")
+    p.add_argument("-o", "--output_path", type=str, required=True, help="Checkpoint prefix of the pruned models")
+    p.add_argument("-qno", "--question_numbers", nargs='+', type=int, default=list(range(1, 9)), help="Questions to prune")
+    p.add_argument("-sparsity", "--sparsity", type=float, default=0.9, help="Fraction of the weights (or of the hidden units with -structured) to remove")
+    p.add_argument("-structured", "--structured", action='store_true', help="Remove whole hidden units instead of single weights")
+    p.add_argument("-min_size", "--min_size", type=int, default=65536, help="Leave Linear layers with fewer weights dense")
+    p.add_argument("-finetune", "--finetune", type=int, default=0, help="Epochs of fine-tuning after pruning (needs -d_path and -l_path)")
+    p.add_argument("-b", "--beta", type=float, default=1.0, help="The beta value used in weights for ImbOLL")
+    p.add_argument("-a", "--alpha", type=float, default=1.0, help="The alpha value used in distance for ImbOLL")
+    p.add_argument("-d_path", "--data_path", type=str, help="Path to data files, to report validation metrics and to fine-tune")
+    p.add_argument("-l_path", "--label_path", type=str, help="Path to labels, i.e., PHQ-8 scores")
+    p.add_argument("-m_files", "--missing_video_files", nargs='+', type=int, default=[], help="List of file numbers for incomplete video files")
+    p.add_argument("-bs", "--batch_size", type=int, default=10, help="Batch size")
+    p.add_argument("-lr", "--lr", type=float, default=1e-4, help="Fine-tuning learning rate at batch size 10")
+    p.add_argument("-lr_scale", "--lr_scale", type=str, default='none', choices=['none','linear','sqrt'], help="Scale -lr with the batch size relative to 10")
+    p.add_argument("-head", "--head", type=str, default='flatten', choices=HEADS, help="Classification head the checkpoints were trained with")
+    p.add_argument("-bench", "--bench", action='store_true', help="Time the forward pass of the dense and the pruned model")
+    p.add_argument("-workers", "--workers", type=int, default=8, help="Number of workers for reading the participant files")
+    p.add_argument("-pool", "--pool", type=str, default='thread', choices=['thread','process'], help="Pool used to read the participant files")
+    p.add_argument("-cache_dir", "--cache_dir", type=str, default='cache', help="Directory for the feature and sentence embedding caches")
+    p.add_argument("-embedder", "--embedder", type=str, default='sentence-transformers/all-distilroberta-v1', help="Sentence embedder for the text modality")
+    return p.parse_args()
+
+class sparse_linear(nn.Module):
+    """Linear layer with a CSR weight, for inference."""
+    def __init__(self, in_features, out_features, nnz=0):
+        super(sparse_linear, self).__init__()
+        self.in_features = in_features
+        self.out_features = out_features
+        self.register_buffer('crow_indices', torch.zeros(out_features + 1, dtype=torch.int32))
+        self.register_buffer('col_indices', torch.zeros(nnz, dtype=torch.int32))
+        self.register_buffer('values', torch.zeros(nnz))
+        self.register_buffer('bias', torch.zeros(out_features))
+
+    def _load_from_state_dict(self, state_dict, prefix, *args):
+        # The number of kept weights is only known from the checkpoint
+        for name in ('col_indices', 'values'):
+            if prefix + name in state_dict:
+                setattr(self, name, torch.empty_like(state_dict[prefix + name]))
+        super(sparse_linear, self)._load_from_state_dict(state_dict, prefix, *args)
+
+    def forward(self, x):
+        weight = torch.sparse_csr_tensor(self.crow_indices, self.col_indices, self.values, (self.out_features, self.in_features))
+        # Sparse matmuls are not autocast
+        y = torch.sparse.addmm(self.bias.unsqueeze(1), weight, x.reshape(-1, self.in_features).t().to(self.values.dtype)).t()
+        return y.reshape(*x.shape[:-1], self.out_features).to(x.dtype)
+
+    def extra_repr(self):
+        return f'in_features={self.in_features}, out_features={self.out_features}, nnz={self.values.numel()}'
+
+def to_sparse(linear):
+    weight = linear.weight.detach().to_sparse_csr()
+    layer = sparse_linear(linear.in_features, linear.out_features, weight.values().numel()).to(linear.weight.device)
+    layer.crow_indices = weight.crow_indices().int()
+    layer.col_indices = weight.col_indices().int()
+    layer.values = weight.values()
+    if linear.bias is not None:
+        layer.bias = linear.bias.detach().clone()
+    return layer
+
+def _set(model, name, module):
+    parent, _, child = name.rpartition('.')
+    setattr(model.get_submodule(parent), child, module)
+
+def head_layers(model, min_size=0):
+    """(name, layer) of the Linear layers in the mlp of the model and of its encoders."""
+    return [(name, m) for name, m in model.named_modules()
+            if isinstance(m, (nn.Linear, sparse_linear)) and 'mlp' in name.split('.') and m.in_features * m.out_features >= min_size]
+
+def hidden_pairs(model):
+    """(first, second) names of the consecutive Linear layers of every mlp."""
+    pairs = []
+    for name, m in model.named_modules():
+        if isinstance(m, nn.Sequential) and name.split('.')[-1] == 'mlp':
+            linears = [i for i, layer in m.named_children() if isinstance(layer, nn.Linear)]
+            pairs += [(f'{name}.{a}', f'{name}.{b}') for a, b in zip(linears, linears[1:])]
+    return pairs
+
+def prune_unstructured(model, sparsity, min_size):
+    """Mask the smallest weights of every large head layer, the masks hold while fine-tuning."""
+    layers = head_layers(model, min_size)
+    for _, layer in layers:
+        w = layer.weight.detach().abs().flatten()
+        mask = torch.zeros_like(w)
+        mask[w.topk(w.numel() - int(round(sparsity * w.numel()))).indices] = 1
+        torch_prune.custom_from_mask(layer, 'weight', mask.view_as(layer.weight))
+    return [name for name, _ in layers]
+
+def prune_structured(model, sparsity, min_size):
+    """Remove the hidden units with the smallest incoming weights from every large mlp."""
+    pruned = []
+    for first, second in hidden_pairs(model):
+        fc1, fc2 = model.get_submodule(first), model.get_submodule(second)
+        if fc1.weight.numel() < min_size:
+            continue
+        keep = fc1.weight.detach().norm(dim=1).topk(max(1, fc1.out_features - int(round(sparsity * fc1.out_features)))).indices.sort().values
+        new1 = nn.Linear(fc1.in_features, len(keep)).to(fc1.weight.device)
+        new2 = nn.Linear(len(keep), fc2.out_features).to(fc2.weight.device)
+        with torch.no_grad():
+            new1.weight.copy_(fc1.weight[keep])
+            new1.bias.copy_(fc1.bias[keep])
+            new2.weight.copy_(fc2.weight[:, keep])
+            new2.bias.copy_(fc2.bias)
+        _set(model, first, new1)
+        _set(model, second, new2)
+        pruned += [first, second]
+    return pruned
+
+def make_permanent(model):
+    for _, layer in head_layers(model):
+        if torch_prune.is_pruned(layer):
+            torch_prune.remove(layer, 'weight')
+    return model
+
+def compact(model, max_density=SPARSE_MAX_DENSITY):
+    """Swap the head layers that are sparse enough for sparse_linear, in place."""
+    for name, layer in head_layers(model):
+        if isinstance(layer, nn.Linear) and layer.weight.count_nonzero().item() <= max_density * layer.weight.numel():
+            _set(model, name, to_sparse(layer))
+    return model
+
+def save_checkpoint(model, path):
+    torch.save({'format': SPARSE_FORMAT, 'state_dict': compact(make_permanent(model)).state_dict()}, path)
+
+def load_checkpoint(model, path, map_location=None):
+    """Load a dense or a pruned checkpoint into a model built by a script.
+
+    Pruned checkpoints first reshape the model: sparse layers become sparse_linear and
+    the layers of structured pruning get the size of their saved weights.
+    """
+    state = torch.load(path, map_location=map_location)
+    if state.get('format') == SPARSE_FORMAT:
+        state = state['state_dict']
+        for name, layer in list(model.named_modules()):
+            if not isinstance(layer, nn.Linear):
+                continue
+            if name + '.values' in state:
+                out_features = state[name + '.crow_indices'].numel() - 1
+                _set(model, name, sparse_linear(layer.in_features, out_features).to(layer.weight.device))
+            elif name + '.weight' in state and state[name + '.weight'].shape != layer.weight.shape:
+                _set(model, name, nn.Linear(state[name + '.weight'].shape[1], state[name + '.weight'].shape[0]).to(layer.weight.device))
+    model.load_state_dict(state)
+    return model
+
+def checkpoint_files(prefix, q, seed):
+    """Suffixes of the per-question checkpoints, lowest validation loss and highest CCC."""
+    return {suffix: prefix + '-phq' + str(q) + '-seed-' + str(seed) + suffix for suffix in ('.pt', '-ccc.pt')}
+
+def head_weights(model):
+    """Nonzero weights of the head layers."""
+    return sum(l.values.numel() if isinstance(l, sparse_linear) else l.weight.count_nonzero().item() for _, l in head_layers(model))
+
+def forward_ms(model, inputs, reps=10):
+    model.eval()
+    times = []
+    with torch.no_grad():
+        model(*inputs)
+        for _ in range(reps):
+            start = time.perf_counter()
+            model(*inputs)
+            times.append((time.perf_counter() - start) * 1000)
+    return statistics.median(times)
+
+def prune(model, args):
+    if args.structured:
+        return prune_structured(model, args.sparsity, args.min_size)
+    return prune_unstructured(model, args.sparsity, args.min_size)
+
+def validate(module, model, data, w, alpha):
+    data_val, val_dataloader = data
+    _, acc, _, ma_f1, _, ccc, rmse, mae = module.evaluate(model, data_val, val_dataloader, w, alpha)
+    return f"acc {float(acc):.1f}%, macro F1 {float(ma_f1):.3f}, CCC {float(ccc):.3f}, RMSE {float(rmse):.3f}"
+
+if __name__ == '__main__':
+
+    args = cmdline_args()
+    if args.finetune and not args.data_path:
+        raise SystemExit("-finetune needs -d_path and -l_path")
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    module = load_script(args.combo, 'train')
+    if args.data_path and uses_text(args.combo):
+        from transformers import AutoTokenizer, AutoModel
+        bind(module, device, AutoTokenizer.from_pretrained(args.embedder), AutoModel.from_pretrained(args.embedder).to(device))
+    else:
+        bind(module, device)
+    kwargs = {'head': args.head}
+    if os.path.dirname(args.output_path):
+        os.makedirs(os.path.dirname(args.output_path), exist_ok=True)
+    print(f"# {args.combo}: {'structured' if args.structured else 'unstructured'} pruning at {args.sparsity:.0%}, {args.checkpoint_path} -> {args.output_path}")
+
+    for q in args.question_numbers:
+        sources = {s: p for s, p in checkpoint_files(args.checkpoint_path, q, args.seed).items() if os.path.exists(p)}
+        targets = checkpoint_files(args.output_path, q, args.seed)
+        if not sources:
+            print(f"phq{q}: no checkpoints at {args.checkpoint_path}-phq{q}-seed-{args.seed}*")
+            continue
+        data = None
+        if args.data_path:
+            data_val = module.dds('val', args.data_path, args.label_path, q, args.missing_video_files, args.workers, args.pool, args.cache_dir)
+            data = (data_val, DataLoader(data_val, batch_size=args.batch_size))
+            w = module.get_weights(q, args.label_path, args.beta, args.cache_dir)
+
+        if args.finetune:
+            # Fine-tune the model the evaluation scripts use, train writes both checkpoints
+            source = sources.get('-ccc.pt', sources.get('.pt'))
+            model = load_checkpoint(build_model(module, args.combo, **kwargs), source, map_location='cpu').to(device)
+            before = head_weights(model)
+            print(f"phq{q}: dense  | {validate(module, model, data, w, args.alpha)}")
+            pruned = prune(model, args)
+            print(f"phq{q}: pruned | {validate(module, model, data, w, args.alpha)}")
+            data_train = module.dds('train', args.data_path, args.label_path, q, args.missing_video_files, args.workers, args.pool, args.cache_dir)
+            module.optimizer = torch.optim.AdamW(model.parameters(), lr=scale_lr(args.lr, args.batch_size, args.lr_scale), eps=1e-8, weight_decay=1e-3)
+            start = time.time()
+            module.train(model, module.train_loader(data_train, args.batch_size, args.seed), data_train, data[0], args.output_path + '-phq' + str(q), args.seed, w, args.alpha, data[1], epochs=args.finetune, evaluation=True)
+            last = model.state_dict()
+            for suffix, target in targets.items():
+                # The best epochs as saved by train, else the last one, each into a fresh masked model:
+                # save_checkpoint compacts the model it is given
+                model = load_checkpoint(build_model(module, args.combo, **kwargs), source, map_location='cpu').to(device)
+                prune(model, args)
+                fresh = os.path.exists(target) and os.path.getmtime(target) >= start
+                model.load_state_dict(torch.load(target, map_location='cpu') if fresh else last)
+                save_checkpoint(model, target)
+            print(f"phq{q}: tuned  | {validate(module, model, data, w, args.alpha)}")
+        else:
+            for suffix, source in sources.items():
+                model = load_checkpoint(build_model(module, args.combo, **kwargs), source, map_location='cpu').to(device)
+                before = head_weights(model)
+                if data and suffix == '-ccc.pt':
+                    print(f"phq{q}: dense  | {validate(module, model, data, w, args.alpha)}")
+                pruned = prune(model, args)
+                save_checkpoint(model, targets[suffix])
+                if data and suffix == '-ccc.pt':
+                    print(f"phq{q}: pruned | {validate(module, model, data, w, args.alpha)}")
+
+        sizes = [(os.path.getsize(sources[s]), os.path.getsize(targets[s])) for s in sources if os.path.exists(targets[s])]
+        print(f"phq{q}: {len(pruned)} layers pruned, head weights {before / 1e6:.2f}M -> {head_weights(model) / 1e6:.2f}M, " + ", ".join(f"{a / 2 ** 20:.1f} -> {b / 2 ** 20:.1f} MB" for a, b in sizes))
+
+    if args.bench:
+        q = args.question_numbers[0]
+        source = checkpoint_files(args.checkpoint_path, q, args.seed)['-ccc.pt']
+        target = checkpoint_files(args.output_path, q, args.seed)['-ccc.pt']
+        inputs = random_inputs(args.combo, args.batch_size, device)
+        dense = load_checkpoint(build_model(module, args.combo, **kwargs), source, map_location='cpu').to(device)
+        sparse = load_checkpoint(build_model(module, args.combo, **kwargs), target, map_location='cpu').to(device)
+        a, b = forward_ms(dense, inputs), forward_ms(sparse, inputs)
+        print(f"# Forward of phq{q} at batch size {args.batch_size}: dense {a:.1f} ms, pruned {b:.1f} ms ({a / b:.2f}x)")
@@ -0,0 +1,56 @@
+import sys
+import numpy as np
+import pandas as pd
+
+class session:
+    """What preprocessing needs for one participant.
+
+    Turn boundaries are kept as int32 arrays and the audio/video features as paths to the
+    memory mapped float32 caches. The transcript strings are kept until their sentence
+    embeddings are cached in txt_file.
+    """
+    __slots__ = ('p_id','label','txt','txt_file','aud_file','aud_start','aud_end','vid_file','vid_start','vid_end')
+
+    def __init__(self, p_id, label, txt=None, aud_file=None, aud_start=None, aud_end=None, vid_file=None, vid_start=None, vid_end=None):
+        self.p_id = int(p_id)
+        self.label = label
+        self.txt = None if txt is None else tuple(txt)
+        self.txt_file = None
+        self.aud_file = aud_file
+        self.aud_start = None if aud_start is None else np.asarray(aud_start, dtype=np.int32)
+        self.aud_end = None if aud_end is None else np.asarray(aud_end, dtype=np.int32)
+        self.vid_file = vid_file
+        self.vid_start = None if vid_start is None else np.asarray(vid_start, dtype=np.int32)
+        self.vid_end = None if vid_end is None else np.asarray(vid_end, dtype=np.int32)
+
+def deep_size(obj, seen=None):
+    """Approximate resident size of obj in bytes, following containers, DataFrames and slotted objects.
+
+    Memory mapped arrays only count their header.
+    """
+    if seen is None:
+        seen = set()
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    if isinstance(obj, (pd.DataFrame, pd.Series)):
+        return int(obj.memory_usage(deep=True).sum() if isinstance(obj, pd.DataFrame) else obj.memory_usage(deep=True))
+    if isinstance(obj, np.ndarray):
+        # getsizeof includes the buffer only when the array owns it
+        return sys.getsizeof(obj) + (deep_size(obj.base, seen) if obj.base is not None and not isinstance(obj.base, np.memmap) and not isinstance(obj, np.memmap) else 0)
+    size = sys.getsizeof(obj)
+    if isinstance(obj, (list, tuple, set)):
+        size += sum(deep_size(x, seen) for x in obj)
+    elif isinstance(obj, dict):
+        size += sum(deep_size(k, seen) + deep_size(v, seen) for k, v in obj.items())
+    elif hasattr(obj, '__slots__'):
+        size += sum(deep_size(getattr(obj, a, None), seen) for a in obj.__slots__)
+    elif hasattr(obj, '__dict__'):
+        size += deep_size(obj.__dict__, seen)
+    return size
+
+def memory_report(split, data):
+    """Print the resident size of a split's samples."""
+    size = deep_size(data)
+    print(f"# {split}: {len(data)} sessions, {size / 2 ** 20:.2f} MB resident ({size / max(1, len(data)) / 1024:.1f} KB per session)")
+    return size
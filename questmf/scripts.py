@@ -0,0 +1,69 @@
+import importlib.util
+import os
+import torch
+import torch.nn as nn
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Maximum number of turns and feature size of each modality
+MAX_TURNS = 120
+FEAT_DIMS = {'txt': 768, 'aud': 23, 'vid': 2048}
+
+# Training script, evaluation script and input modalities (in forward order) of each combination
+COMBOS = {
+    'T': ('Text/T-questMF.py', 'Text/T-questMF-eval.py', ['txt']),
+    'A': ('Audio/A-questMF.py', 'Audio/A-questMF-eval.py', ['aud']),
+    'V': ('Video/V-questMF.py', 'Video/V-questMF-eval.py', ['vid']),
+    'TA': ('Text+Audio/TA-questMF.py', 'Text+Audio/TA-questMF-eval.py', ['txt', 'aud']),
+    'TV': ('Text+Video/TV-questMF.py', 'Text+Video/TV-questMF-eval.py', ['txt', 'vid']),
+    'AV': ('Audio+Video/AV-questMF.py', 'Audio+Video/AV-questMF-eval.py', ['vid', 'aud']),
+    'TAV': ('Text+Audio+Video/TAV-questMF.py', 'Text+Audio+Video/TAV-questMF-eval.py', ['txt', 'aud', 'vid']),
+}
+
+def load_script(combo, kind='train'):
+    """Import a QuestMF script as a module without running its __main__ block.
+    """
+    train_path, eval_path, _ = COMBOS[combo]
+    path = os.path.join(ROOT, train_path if kind == 'train' else eval_path)
+    name = os.path.basename(path)[:-3].replace('-', '_').replace('+', '_')
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+def bind(module, device, tokenizer=None, embedder=None):
+    """Set the globals that a script otherwise creates in its __main__ block.
+    """
+    module.device = device
+    module.loss_fn_mse = nn.MSELoss()
+    module.ccc_loss_fn = module.ccc_loss()
+    module.mae_loss_fn = nn.L1Loss()
+    if tokenizer is not None:
+        # Text-only scripts and fusion scripts use different names
+        module.tokenizer = module.tokenizer_txt = tokenizer
+        module.embedder = module.embedder_txt = embedder
+    return module
+
+def uses_text(combo):
+    return 'txt' in COMBOS[combo][2]
+
+def build_model(module, combo, head='flatten', **kwargs):
+    """Instantiate the model of a script with freshly initialised encoders.
+    head goes to every model, kwargs to the fusion model, e.g. fused_attn=True.
+    """
+    mods = COMBOS[combo][2]
+    if len(mods) == 1:
+        return module.lstm_regressor(head=head)
+    encoders = [getattr(module, 'lstm_regressor_' + m)(head=head) for m in mods]
+    return module.lstm_regressor(*encoders, head=head, **kwargs)
+
+def random_inputs(combo, batch_size, device, generator=None):
+    """Random padded features and key padding masks in the order expected by forward.
+    """
+    inputs = []
+    for m in COMBOS[combo][2]:
+        feats = torch.randn(batch_size, MAX_TURNS, FEAT_DIMS[m], generator=generator)
+        lengths = torch.randint(MAX_TURNS // 4, MAX_TURNS + 1, (batch_size,), generator=generator)
+        mask = torch.arange(MAX_TURNS).unsqueeze(0) >= lengths.unsqueeze(1)
+        inputs += [feats.to(device), mask.to(device)]
+    return inputs
@@ -0,0 +1,209 @@
+import argparse
+import io
+import itertools
+import json
+import os
+import random
+import tarfile
+import time
+import torch
+import torch.distributed as dist
+from torch.utils.data import IterableDataset, get_worker_info
+
+from questmf.labels import load_labels
+from questmf.scripts import COMBOS
+
+# Preprocessed samples of a split in sharded tar archives, and a dataset that streams them. The
+# writer runs the evaluation script's dataset of a combination once and stores the tensors of
+# every session, its total score and its eight item scores:
+#
+#   python -m questmf.shards -combo TAV -split train -d_path ... -l_path ... -o shards/train -per_shard 64
+#   python Audio/A-questMF.py ... -shards shards/train/index.json -shuffle_buffer 256
+#
+# shard_dataset reads one shard at a time and keeps at most shuffle_buffer samples, so its memory
+# does not grow with the corpus. The shards are shuffled every epoch with seed + epoch, then split
+# across the data parallel ranks and the DataLoader workers of each rank. Shards of any combination
+# serve the combinations with a subset of its modalities.
+
+SHARD_FORMAT = 'questmf-shards-1'
+
+def cmdline_args():
+    # Make parser object
+    p = argparse.ArgumentParser()
+    p.add_argument("-combo", "--combo", type=str, default='TAV', choices=list(COMBOS), help="Combination whose evaluation script preprocesses the samples")
+    p.add_argument("-split", "--split", type=str, default='train', choices=['train','val','test'], help="Split to write")
+    p.add_argument("-d_path", "--data_path", type=str, help="Path to data files (text transcripts, audio files, video features)")
+    p.add_argument("-l_path", "--label_path", type=str, help="Path to labels, i.e., PHQ-8 scores")
+    p.add_argument("-m_files", "--missing_video_files", nargs='+', type=int, default=[], help="List of file numbers for incomplete video files")
+    p.add_argument("-o", "--output", type=str, required=True, help="Directory for the shards and their index.json")
+    p.add_argument("-per_shard", "--per_shard", type=int, default=64, help="Sessions per shard")
+    p.add_argument("-workers", "--workers", type=int, default=8, help="Number of workers for reading the participant files")
+    p.add_argument("-cache_dir", "--cache_dir", type=str, default='cache', help="Directory for the feature and sentence embedding caches")
+    p.add_argument("-embedder", "--embedder", type=str, default='sentence-transformers/all-distilroberta-v1', help="Sentence embedder for the text modality")
+    return p.parse_args()
+
+def _add(tar, name, payload):
+    info = tarfile.TarInfo(name)
+    info.size = len(payload)
+    info.mtime = int(time.time())
+    tar.addfile(info, io.BytesIO(payload))
+
+def write_shards(data, mods, out_dir, per_shard=64, items=None, **info):
+    """Write the samples of a dataset to out_dir/shard-NNNNN.tar, with an index.json.
+
+    Every sample of data is [embedding, mask, ...] of mods plus the total score; items maps a
+    participant to its (8,) item scores. The samples are preprocessed one at a time.
+    Returns the path of the index.
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    shards = []
+    tar = None
+    for i, s in enumerate(data.data):
+        if i % per_shard == 0:
+            if tar is not None:
+                tar.close()
+            shards.append({'file': f"shard-{len(shards):05d}.tar", 'n': 0})
+            tar = tarfile.open(os.path.join(out_dir, shards[-1]['file']), 'w')
+        sample = data[i]
+        buffer = io.BytesIO()
+        torch.save({'p_id': s.p_id, 'inputs': [t.contiguous() for t in sample[:-1]], 'total': float(sample[-1]),
+                    'items': None if items is None else torch.as_tensor(items[s.p_id], dtype=torch.int64)}, buffer)
+        _add(tar, f"{s.p_id}.pt", buffer.getvalue())
+        shards[-1]['n'] += 1
+    if tar is not None:
+        tar.close()
+    index = dict(info, format=SHARD_FORMAT, mods=list(mods), items=items is not None, n_samples=sum(s['n'] for s in shards), shards=shards)
+    # Write then rename, so that readers never see a partial index
+    index_file = os.path.join(out_dir, 'index.json')
+    with open(index_file + '.tmp', 'w') as f:
+        json.dump(index, f, indent=1)
+    os.replace(index_file + '.tmp', index_file)
+    return index_file
+
+def read_index(index_file):
+    with open(index_file) as f:
+        index = json.load(f)
+    if index.get('format') != SHARD_FORMAT:
+        raise ValueError(f"{index_file} is not a shard index ({index.get('format')})")
+    return index
+
+def read_shard(path):
+    """Samples of a shard, read as a stream one member at a time."""
+    with tarfile.open(path, 'r|') as tar:
+        for member in tar:
+            if member.isfile():
+                yield torch.load(io.BytesIO(tar.extractfile(member).read()), map_location='cpu', weights_only=True)
+
+class shard_dataset(IterableDataset):
+    """Samples of the shards of an index, streamed as [embedding, mask, ..., label].
+
+    The label is the score of question (1-8), or the total score when question is None. mods
+    selects and orders the modalities, e.g. ['vid', 'aud'] for AV. With a shuffle_buffer of 0,
+    the samples of each shard come in the order they were written.
+
+    A DataLoader with several workers needs set_batching with its batch size and workers, so that
+    every rank runs the same number of steps.
+    """
+    def __init__(self, index_file, question=None, mods=None, shuffle_buffer=0, seed=0, shuffle=True, rank=None, world_size=None):
+        super(shard_dataset, self).__init__()
+        index = read_index(index_file)
+        root = os.path.dirname(os.path.abspath(index_file))
+        self.files = [os.path.join(root, s['file']) for s in index['shards']]
+        self.counts = [s['n'] for s in index['shards']]
+        if question is not None and not index['items']:
+            raise ValueError(f"{index_file} has no item scores, only the total score can be the label")
+        mods = mods or index['mods']
+        missing = [m for m in mods if m not in index['mods']]
+        if missing:
+            raise ValueError(f"{index_file} has no {', '.join(missing)} inputs, only {', '.join(index['mods'])}")
+        self.inputs = [j for m in mods for j in (2 * index['mods'].index(m), 2 * index['mods'].index(m) + 1)]
+        self.question = question
+        self.shuffle_buffer = shuffle_buffer
+        self.seed = seed
+        self.shuffle = shuffle
+        initialized = dist.is_available() and dist.is_initialized()
+        self.rank = rank if rank is not None else (dist.get_rank() if initialized else 0)
+        self.world_size = world_size or (dist.get_world_size() if initialized else 1)
+        if len(self.files) < self.world_size:
+            raise ValueError(f"{len(self.files)} shards for {self.world_size} ranks, write smaller shards")
+        self.epoch = 0
+        self.batch_size = 1
+        self.num_workers = 0
+
+    def set_batching(self, batch_size, num_workers):
+        self.batch_size = batch_size
+        self.num_workers = num_workers
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def _order(self):
+        # The same order on every rank and worker
+        if not self.shuffle:
+            return list(range(len(self.files)))
+        return torch.randperm(len(self.files), generator=torch.Generator().manual_seed(self.seed + self.epoch)).tolist()
+
+    def _rank_shards(self):
+        order = self._order()
+        return [order[r::self.world_size] for r in range(self.world_size)]
+
+    def _quotas(self, n_workers):
+        """Samples of every worker slot, the same on every rank.
+
+        Each worker batches its own samples, so with several workers the quotas are whole batches:
+        every rank then runs the same number of steps, and the all-reduces stay in step.
+        """
+        rank_shards = self._rank_shards()
+        quotas = [min(sum(self.counts[i] for i in shards[w::n_workers]) for shards in rank_shards) for w in range(n_workers)]
+        if n_workers > 1:
+            quotas = [q - q % self.batch_size for q in quotas]
+        return quotas
+
+    def __len__(self):
+        return sum(self._quotas(max(1, self.num_workers)))
+
+    def _sample(self, sample):
+        label = int(sample['items'][self.question - 1]) if self.question is not None else sample['total']
+        return [sample['inputs'][j] for j in self.inputs] + [label]
+
+    def __iter__(self):
+        shards = self._rank_shards()[self.rank]
+        worker = get_worker_info()
+        n_workers, worker_id = (worker.num_workers, worker.id) if worker is not None else (1, 0)
+        quota = self._quotas(n_workers)[worker_id]
+        rng = random.Random(f"{self.seed}-{self.epoch}-{self.rank}-{worker_id}")
+        stream = itertools.chain.from_iterable(read_shard(self.files[i]) for i in shards[worker_id::n_workers])
+        buffer = []
+        for sample in itertools.islice(stream, quota):
+            if self.shuffle_buffer <= 1:
+                yield self._sample(sample)
+            elif len(buffer) < self.shuffle_buffer:
+                buffer.append(sample)
+            else:
+                # Yield a random sample of the buffer and put the new one in its place
+                j = rng.randrange(len(buffer))
+                buffer[j], sample = sample, buffer[j]
+                yield self._sample(sample)
+        rng.shuffle(buffer)
+        for sample in buffer:
+            yield self._sample(sample)
+
+if __name__ == '__main__':
+
+    from questmf.multitask import eval_script
+    args = cmdline_args()
+    os.environ["TOKENIZERS_PARALLELISM"] = "false"
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    start = time.perf_counter()
+    module = eval_script(args.combo, device, args.embedder)
+    data = module.dds(args.split, args.data_path, args.label_path, args.missing_video_files, args.workers, cache_dir=args.cache_dir)
+    try:
+        p_ids = [s.p_id for s in data.data]
+        items = dict(zip(p_ids, load_labels(args.label_path, args.cache_dir).items(p_ids)))
+    except (KeyError, FileNotFoundError) as e:
+        print(f"# No item scores, the shards only have the total score: {e}")
+        items = None
+    index_file = write_shards(data, COMBOS[args.combo][2], args.output, args.per_shard, items, combo=args.combo, split=args.split)
+    index = read_index(index_file)
+    size = sum(os.path.getsize(os.path.join(args.output, s['file'])) for s in index['shards'])
+    print(f"# {index['n_samples']} {args.split} sessions in {len(index['shards'])} shards ({size / 2 ** 20:.1f} MB) in {time.perf_counter() - start:.1f} s, index {index_file}")
@@ -0,0 +1,70 @@
+import os
+import wave
+import numpy as np
+import pandas as pd
+import scipy.io as sio
+
+Q_LIST = ['PHQ_8NoInterest','PHQ_8Depressed','PHQ_8Sleep','PHQ_8Tired','PHQ_8Appetite','PHQ_8Failure','PHQ_8Concentrating','PHQ_8Moving']
+
+WORDS = ['yeah', 'i', 'think', 'that', 'was', 'really', 'hard', 'for', 'me', 'um', 'sleep', 'work', 'family', 'okay', 'tired', 'good']
+
+def write_session(data_path, p_id, n_turns, turn_sec, vid_fps, rng):
+    """Write the transcript, audio, eGeMAPS and ResNet files of one synthetic session.
+    """
+    p_dir = data_path + str(p_id) + '_P/'
+    os.makedirs(p_dir + 'features/', exist_ok=True)
+    duration = n_turns * turn_sec
+
+    # Transcript with one turn every turn_sec seconds
+    starts = np.arange(n_turns) * turn_sec + rng.uniform(0, 0.2, n_turns)
+    ends = starts + rng.uniform(0.5, turn_sec - 0.2, n_turns)
+    texts = [' '.join(rng.choice(WORDS, rng.integers(1, 40))) for _ in range(n_turns)]
+    pd.DataFrame({'Start_Time': starts.round(3), 'End_Time': ends.round(3), 'Text': texts,
+                  'Confidence': rng.uniform(0.5, 1, n_turns).round(3)}).to_csv(p_dir + str(p_id) + '_Transcript.csv', index=False)
+
+    # Silent audio, only its duration is used
+    sr = 1000
+    with wave.open(p_dir + str(p_id) + '_AUDIO.wav', 'wb') as f:
+        f.setnchannels(1)
+        f.setsampwidth(2)
+        f.setframerate(sr)
+        f.writeframes(bytes(2 * int(duration * sr)))
+
+    # eGeMAPS low level descriptors at 100 frames per second
+    n_frames = int(duration * 100)
+    df_speech = pd.DataFrame(rng.standard_normal((n_frames, 23)).astype(np.float32), columns=[f'lld_{k}' for k in range(23)])
+    df_speech.insert(0, 'frameTime', (np.arange(n_frames) / 100).round(2))
+    df_speech.insert(0, 'name', "'unknown'")
+    df_speech.to_csv(p_dir + 'features/' + str(p_id) + '_OpenSMILE2.3.0_egemaps.csv', sep=';', index=False)
+
+    # ResNet features
+    feature = rng.standard_normal((int(duration * vid_fps), 2048)).astype(np.float32)
+    sio.savemat(p_dir + 'features/' + str(p_id) + '_CNN_ResNet.mat', {'feature': feature})
+
+def write_corpus(root, n_train=8, n_val=4, n_test=4, n_turns=140, turn_sec=2.0, vid_fps=5, seed=0):
+    """Write a small corpus with the E-DAIC directory layout and label files.
+
+    Returns the data path and label path, both with a trailing separator as the scripts expect.
+    """
+    rng = np.random.default_rng(seed)
+    data_path = os.path.join(root, 'data') + '/'
+    label_path = os.path.join(root, 'labels') + '/'
+    os.makedirs(data_path, exist_ok=True)
+    os.makedirs(label_path, exist_ok=True)
+
+    splits = {'train_split.csv': n_train, 'dev_split.csv': n_val, 'test_split.csv': n_test}
+    p_id = 300
+    rows = []
+    for split_file, n in splits.items():
+        ids = []
+        for k in range(n):
+            write_session(data_path, p_id, n_turns, turn_sec, vid_fps, rng)
+            # Cycle through the classes so that every class is present in the training split
+            item_scores = [(k + q) % 4 for q in range(len(Q_LIST))]
+            rows.append([p_id] + item_scores + [sum(item_scores)])
+            ids.append(p_id)
+            p_id += 1
+        totals = [r[-1] for r in rows[-n:]]
+        pd.DataFrame({'Participant_ID': ids, 'PHQ_Score': totals}).to_csv(label_path + split_file, index=False)
+    pd.DataFrame(rows, columns=['Participant_ID'] + Q_LIST + ['PHQ_8Total']).to_csv(label_path + 'Detailed_PHQ8_Labels.csv', index=False)
+    return data_path, label_path
@@ -0,0 +1,80 @@
+import hashlib
+import os
+import time
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+# Sentence embeddings of the transcript turns, computed once per corpus and cached as .npy files.
+# Only the turns that survive the MAX_TURNS cut are embedded. Turns of all sessions are sorted by
+# token length and run through the embedder in batches of a fixed token budget, so that padding
+# stays small.
+
+MAX_TURNS = 120
+
+# Mean Pooling - Take attention mask into account for correct averaging
+def mean_pooling(model_output, attention_mask):
+    token_embeddings = model_output[0] #First element of model_output contains all token embeddings
+    input_mask_expanded = attention_mask.unsqueeze(-1).expand(token_embeddings.size()).float()
+    return torch.sum(token_embeddings * input_mask_expanded, 1) / torch.clamp(input_mask_expanded.sum(1), min=1e-9)
+
+def embed_turns(turn_lists, tokenizer, embedder, device, token_budget=None):
+    """L2 normalised sentence embedding of every turn, as one (turns x hidden) array per session.
+
+    A batch holds as many turns of similar length as fit in token_budget padded tokens. Large
+    batches pay off on GPU; on CPU smaller ones stay in cache and run faster.
+    """
+    if token_budget is None:
+        token_budget = 16384 if torch.device(device).type == 'cuda' else 2048
+    flat = [(i, j) for i, turns in enumerate(turn_lists) for j in range(len(turns))]
+    texts = [turn_lists[i][j] for i, j in flat]
+    lengths = [len(ids) for ids in tokenizer(texts, truncation=True)['input_ids']]
+    hidden = embedder.config.hidden_size
+    out = [np.zeros((len(turns), hidden), dtype=np.float32) for turns in turn_lists]
+
+    def run(batch):
+        encoded_input = tokenizer([texts[b] for b in batch], padding=True, truncation=True, return_tensors='pt').to(device)
+        with torch.no_grad():
+            embeddings = mean_pooling(embedder(**encoded_input), encoded_input['attention_mask'])
+        embeddings = F.normalize(embeddings, p=2, dim=1).float().cpu().numpy()
+        for b, e in zip(batch, embeddings):
+            out[flat[b][0]][flat[b][1]] = e
+
+    batch = []
+    # Ascending length, so the last turn of a batch sets its padded length
+    for b in sorted(range(len(flat)), key=lambda b: lengths[b]):
+        if batch and lengths[b] * (len(batch) + 1) > token_budget:
+            run(batch)
+            batch = []
+        batch.append(b)
+    if batch:
+        run(batch)
+    return out
+
+def text_cache_file(cache_dir, p_id, turns, embedder):
+    # The name depends on the embedder and the turns, so edited transcripts are embedded again
+    digest = hashlib.sha1(getattr(embedder.config, '_name_or_path', '').encode())
+    for turn in turns:
+        digest.update(b'\x1f' + str(turn).encode())
+    return os.path.join(cache_dir, f"{p_id}_txt_{digest.hexdigest()[:16]}.npy")
+
+def precompute_text(data, cache_dir, tokenizer, embedder, device, token_budget=None):
+    """Embed the first MAX_TURNS turns of every session missing from the cache and point the
+    records at the cached files. The transcript strings are dropped from the records afterwards.
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    todo = []
+    for s in data:
+        s.txt_file = text_cache_file(cache_dir, s.p_id, s.txt[:MAX_TURNS], embedder)
+        if not os.path.exists(s.txt_file):
+            todo.append(s)
+    if todo:
+        t0 = time.perf_counter()
+        embeddings = embed_turns([s.txt[:MAX_TURNS] for s in todo], tokenizer, embedder, device, token_budget)
+        for s, e in zip(todo, embeddings):
+            tmp_file = f"{s.txt_file}.{os.getpid()}.tmp.npy"
+            np.save(tmp_file, e)
+            os.replace(tmp_file, s.txt_file)
+        print(f"# Embedded {sum(len(e) for e in embeddings)} turns of {len(todo)} sessions in {time.perf_counter() - t0:.1f}s")
+    for s in data:
+        s.txt = None
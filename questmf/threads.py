@@ -0,0 +1,41 @@
+import os
+import torch
+
+def parse_cores(spec):
+    """'0-3,8,10-11' -> [0, 1, 2, 3, 8, 10, 11]"""
+    cores = []
+    for part in spec.split(','):
+        if '-' in part:
+            a, b = part.split('-')
+            cores += range(int(a), int(b) + 1)
+        elif part:
+            cores.append(int(part))
+    return cores
+
+def format_cores(cores):
+    """[0, 1, 2, 3, 8] -> '0-3,8'"""
+    parts = []
+    for c in sorted(cores):
+        if parts and c == parts[-1][1] + 1:
+            parts[-1][1] = c
+        else:
+            parts.append([c, c])
+    return ','.join(f"{a}-{b}" if a != b else f"{a}" for a, b in parts)
+
+def set_thread_budget(threads=None, interop_threads=None, cores=None, pin=False):
+    """Limit the threads PyTorch uses and optionally pin the process to a set of cores.
+
+    With a core list (e.g. '0-7') the intra-op threads default to one per core. Has to run before
+    the first parallel op, since the inter-op pool can only be sized once.
+    """
+    cores = parse_cores(cores) if cores else None
+    if threads is None and cores:
+        threads = len(cores)
+    if pin and cores:
+        os.sched_setaffinity(0, cores)
+    if threads:
+        torch.set_num_threads(threads)
+    if interop_threads:
+        torch.set_num_interop_threads(interop_threads)
+    if threads or interop_threads or (pin and cores):
+        print(f"# Threads: {torch.get_num_threads()} intra-op" + (f", {interop_threads} inter-op" if interop_threads else "") + (f", pinned to cores {format_cores(cores)}" if pin and cores else ""))